@@ -0,0 +1,235 @@
+# Microbenchmarks for the request hot paths
+# Times authentication, conflict checks, the lesson and timetable pages, the
+# lesson edit and delete fan-out and mock lesson generation against mock
+# schools 1x, 10x and 100x the size of the default seed, and prints how each
+# one scales
+# Results can be saved as a baseline; later runs compared against it fail
+# when a benchmark slows down by more than the threshold
+# Run from the repository root: python benchmarks/bench_hot_paths.py
+import argparse
+import asyncio
+import contextlib
+import io
+import json
+import statistics
+import sys
+import time
+from pathlib import Path
+from types import SimpleNamespace
+
+ROOT = Path(__file__).parent.parent
+sys.path.insert(0, str(ROOT / "src"))
+
+from fastapi.testclient import TestClient  # noqa: E402
+
+import main  # noqa: E402
+import mock_data  # noqa: E402
+from models import LessonCreate  # noqa: E402
+
+# Size of the default seed, multiplied by each scale
+BASE_SCHOOL = {
+    "teachers": 5, "students": 2, "year_groups": 5, "classrooms": 20
+    }
+DEFAULT_SCALES = (1, 10, 100)
+
+# Seconds each timing sample should roughly take
+SAMPLE_SECONDS = 0.2
+
+# Replaces the app's data with a mock school scale times the default seed
+def load_school(scale: int):
+    main.users_db.clear()
+    main.session_cache.clear()
+    main.feed_cache.clear()
+    main.render_cache.clear()
+    school = {key: value * scale for key, value in BASE_SCHOOL.items()}
+    mock_data.initialise_mock_data(
+        teachers=school["teachers"],
+        students=school["students"],
+        max_lessons=0,
+        random_seed=42,
+        year_groups=range(7, 7 + school["year_groups"]),
+        classrooms=[f"Room {n}" for n in range(1, school["classrooms"] + 1)]
+        )
+    return school
+
+# Returns the access token cookie for a seeded account
+def login_cookie(username: str) -> dict:
+    user = main.users_db.get_by_username(username)
+    token = main.create_access_token(
+        data={"sub": user.username, "role": user.role}
+        )
+    return {"access_token": f"Bearer {token}"}
+
+# Builds the benchmarks for the currently loaded school
+# Each is a function that performs one operation
+# Repeat requests are answered from the session and render caches, so the
+# pages are also timed with both caches emptied first, which is what a
+# request after a write or from a new session costs
+def build_benchmarks(client: TestClient) -> dict:
+    loop = asyncio.new_event_loop()
+    admin = login_cookie("admin")
+    teacher = login_cookie("teacher1")
+    student = login_cookie("student1")
+    request = SimpleNamespace(cookies=admin)
+    lesson = next(iter(main.global_lessons_db))
+    candidate = LessonCreate(
+        subject="Math", teacher="teacher1", classroom="Room 1",
+        day_of_week="Monday", start_time="09:00", end_time="10:00",
+        year_group=7
+        )
+    edit_form = {
+        "subject": lesson.subject,
+        "teacher": lesson.teacher,
+        "classroom": lesson.classroom,
+        "day_of_week": lesson.day_of_week,
+        "start_time": lesson.start_time.strftime("%H:%M"),
+        "year_group": lesson.year_group
+        }
+
+    def get(path, cookies):
+        return lambda: client.get(path, cookies=cookies)
+
+    def clear_caches():
+        main.session_cache.clear()
+        main.render_cache.clear()
+
+    def get_uncached(path, cookies):
+        def uncached():
+            clear_caches()
+            return client.get(path, cookies=cookies)
+        return uncached
+
+    def get_current_user_uncached():
+        main.session_cache.clear()
+        return loop.run_until_complete(main.get_current_user(request))
+
+    def delete_and_restore():
+        removed = main.remove_lesson_record(lesson.id)
+        main.add_lesson_record(removed)
+
+    return {
+        "get_current_user": lambda: loop.run_until_complete(
+            main.get_current_user(request)
+            ),
+        "get_current_user uncached": get_current_user_uncached,
+        "check_lesson_conflict": lambda: main.check_lesson_conflict(candidate),
+        "list_lessons admin": get("/lessons/", admin),
+        "list_lessons admin uncached": get_uncached("/lessons/", admin),
+        "list_lessons teacher": get("/lessons/", teacher),
+        "list_lessons teacher uncached": get_uncached("/lessons/", teacher),
+        "view_timetable student": get("/timetable/", student),
+        "view_timetable student uncached": get_uncached("/timetable/",
+                                                        student),
+        "view_timetable admin": get("/timetable/", admin),
+        "view_timetable admin uncached": get_uncached("/timetable/", admin),
+        "admin_timetables": get("/admin/timetables", admin),
+        "admin_timetables uncached": get_uncached("/admin/timetables",
+                                                  admin),
+        "lesson_edit": lambda: client.post(
+            f"/lessons/{lesson.id}/edit", data=edit_form, cookies=admin,
+            allow_redirects=False
+            ),
+        "lesson_delete": delete_and_restore,
+        }
+
+# Returns the median time of one call in milliseconds
+def time_call(func, repeat: int) -> float:
+    func()  # warm up
+    started = time.perf_counter()
+    func()
+    once = max(time.perf_counter() - started, 1e-6)
+    number = max(1, min(10000, int(SAMPLE_SECONDS / once)))
+    samples = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        for _ in range(number):
+            func()
+        samples.append((time.perf_counter() - started) / number)
+    return statistics.median(samples) * 1000
+
+def run(scales, repeat: int) -> dict:
+    results = {}
+    client = TestClient(main.app)
+    for scale in scales:
+        print(f"Loading {scale}x school...", flush=True)
+        with contextlib.redirect_stdout(io.StringIO()):
+            school = load_school(scale)
+            timings = {"create_mock_lessons": time_call(
+                lambda school=school: mock_data.create_mock_lessons(
+                    0,
+                    range(7, 7 + school["year_groups"]),
+                    [f"Room {n}" for n in range(1, school["classrooms"] + 1)]
+                    ),
+                repeat
+                )}
+            # Regenerating the lessons leaves the timetables behind
+            mock_data.create_mock_timetables()
+            for name, func in build_benchmarks(client).items():
+                timings[name] = time_call(func, repeat)
+        results[str(scale)] = {
+            "school": dict(school, lessons=len(main.global_lessons_db),
+                           users=len(main.users_db)),
+            "timings_ms": {name: round(ms, 4) for name, ms in timings.items()}
+            }
+    return results
+
+# Prints each benchmark's time at every scale and its growth from 1x
+def print_curves(results: dict):
+    scales = list(results)
+    names = list(results[scales[0]]["timings_ms"])
+    print()
+    print(f"{'benchmark':<34}" + "".join(f"{s + 'x ms':>12}" for s in scales)
+          + "   growth")
+    for name in names:
+        times = [results[s]["timings_ms"][name] for s in scales]
+        growth = " ".join(
+            f"{t / times[0]:.1f}x" if times[0] else "-" for t in times[1:]
+            )
+        print(f"{name:<34}" + "".join(f"{t:>12.3f}" for t in times)
+              + f"   {growth}")
+
+# Returns the benchmarks that are slower than the baseline by more than
+# the threshold, as (scale, name, baseline ms, current ms)
+def find_regressions(results: dict, baseline: dict, threshold: float):
+    regressions = []
+    for scale, result in results.items():
+        base_timings = baseline.get(scale, {}).get("timings_ms", {})
+        for name, current in result["timings_ms"].items():
+            previous = base_timings.get(name)
+            if previous and current > previous * threshold:
+                regressions.append((scale, name, previous, current))
+    return regressions
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Benchmark the request hot paths at growing school sizes")
+    parser.add_argument("--scales", default=",".join(map(str, DEFAULT_SCALES)),
+                        help="comma separated multiples of the default seed")
+    parser.add_argument("--repeat", type=int, default=5,
+                        help="timing samples per benchmark")
+    parser.add_argument("--output", default="benchmark_results.json",
+                        help="file the JSON results are written to")
+    parser.add_argument("--baseline",
+                        help="results file to compare against")
+    parser.add_argument("--threshold", type=float, default=1.5,
+                        help="fail if a benchmark is this many times slower "
+                             "than the baseline")
+    args = parser.parse_args()
+
+    run_results = run([int(s) for s in args.scales.split(",")], args.repeat)
+    print_curves(run_results)
+    with open(args.output, "w", encoding="utf-8") as output:
+        json.dump(run_results, output, indent=2)
+    print(f"\nResults written to {args.output}")
+
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as baseline_file:
+            baseline_results = json.load(baseline_file)
+        slower = find_regressions(run_results, baseline_results,
+                                  args.threshold)
+        for slow_scale, slow_name, before, after in slower:
+            print(f"REGRESSION {slow_name} at {slow_scale}x: "
+                  f"{before:.3f} ms -> {after:.3f} ms")
+        if slower:
+            sys.exit(1)
+        print(f"No regressions beyond {args.threshold}x the baseline")
@@ -0,0 +1,70 @@
+# Benchmark for the timetable scheduler
+# Schedules a 100-teacher, 60-classroom school and checks that the result
+# is conflict-free
+# Run from the repository root: python benchmarks/bench_scheduler.py
+import argparse
+import random
+import sys
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).parent.parent / "src"))
+
+from scheduler import CURRICULUM, SchedulingProblem, solve  # noqa: E402
+
+# Builds a school where every teacher can teach two or three subjects
+def build_problem(teachers: int, classrooms: int, year_groups: int,
+                  seed: int) -> SchedulingProblem:
+    rng = random.Random(seed)
+    subjects = list(CURRICULUM)
+    return SchedulingProblem(
+        teachers={
+            f"teacher{i + 1}": rng.sample(subjects, rng.randint(2, 3))
+            for i in range(teachers)
+            },
+        classrooms=[f"Room {number}" for number in range(1, classrooms + 1)],
+        year_groups=range(1, year_groups + 1)
+        )
+
+# Raises AssertionError if any teacher, classroom or year group is
+# booked twice in the same hour
+def check_conflict_free(placements):
+    for field in ("teacher", "classroom", "year_group"):
+        booked = set()
+        for placement in placements:
+            key = (getattr(placement, field), placement.day_of_week,
+                   placement.hour)
+            assert key not in booked, f"{field} double-booked: {key}"
+            booked.add(key)
+
+def run(teachers: int, classrooms: int, year_groups: int, seed: int,
+        workers: int, repeat: int):
+    problem = build_problem(teachers, classrooms, year_groups, seed)
+    required = len(problem.year_groups) * sum(problem.curriculum.values())
+    print(f"{teachers} teachers, {classrooms} classrooms, {year_groups} "
+          f"year groups: {required} lesson hours to schedule")
+    timings = []
+    for attempt in range(repeat):
+        schedule = solve(problem, seed=seed + attempt, workers=workers)
+        check_conflict_free(schedule.placements)
+        timings.append(schedule.seconds)
+        print(f"  run {attempt + 1}: {len(schedule.placements)} lessons in "
+              f"{schedule.seconds:.3f} s, {schedule.attempts} attempt(s), "
+              f"{schedule.backtracks} backtracks, "
+              f"complete={schedule.complete}")
+    print(f"  best {min(timings):.3f} s, worst {max(timings):.3f} s")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Benchmark the timetable scheduler")
+    parser.add_argument("--teachers", type=int, default=100)
+    parser.add_argument("--classrooms", type=int, default=60)
+    parser.add_argument("--year-groups", type=int, default=50,
+                        help="classes to timetable, each with the full "
+                             "curriculum")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--workers", type=int, default=1,
+                        help="processes running restarts in parallel")
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+    run(args.teachers, args.classrooms, args.year_groups, args.seed,
+        args.workers, args.repeat)
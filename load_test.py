@@ -0,0 +1,299 @@
+# Load test for the LMS application
+# Starts the app with a synthetic school, or targets a running server,
+# logs in student, teacher and admin virtual users and replays a weighted
+# mix of their routes for a while, then reports request counts, errors and
+# latency percentiles per route and writes them as JSON
+# Run from the repository root: python load_test.py --duration 30
+import argparse
+import concurrent.futures
+import json
+import os
+import random
+import subprocess
+import sys
+import threading
+import time
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+import requests
+
+# Routes each kind of virtual user requests, with their relative weights
+# "lesson_edit" re-saves one of the user's lessons through the edit form
+ROUTE_MIX = {
+    "student": {"/dashboard": 3, "/timetable/": 4, "/lessons/": 3},
+    "teacher": {"/dashboard": 2, "/timetable/": 3, "/lessons/": 3,
+                "lesson_edit": 2},
+    "admin": {"/dashboard": 1, "/lessons/": 2, "/admin/timetables": 2,
+              "lesson_edit": 1},
+}
+
+# Credentials of the accounts seeded at startup
+# Mock users are teacher2, teacher3, ... and student2, student3, ...
+TEST_ACCOUNTS = {
+    "admin": [("admin", "adminpass")],
+    "teacher": [("teacher1", "teacherpass")],
+    "student": [("student1", "studentpass")],
+}
+MOCK_PASSWORD = "password"
+
+# Returns the given percentile of a sorted list of timings (nearest rank)
+def percentile(sorted_timings: List[float], percent: float) -> float:
+    if not sorted_timings:
+        return 0.0
+    rank = max(1, int(round(percent / 100 * len(sorted_timings))))
+    return sorted_timings[min(rank, len(sorted_timings)) - 1]
+
+# Collects the latency of every request, per route, across threads
+class LatencyRecorder:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.timings: Dict[str, List[float]] = {}
+        self.errors: Dict[str, int] = {}
+
+    def record(self, route: str, seconds: float, ok: bool):
+        with self._lock:
+            self.timings.setdefault(route, []).append(seconds * 1000)
+            if not ok:
+                self.errors[route] = self.errors.get(route, 0) + 1
+
+    # Returns count, errors and latency percentiles in ms for each route
+    def summary(self, elapsed: float) -> Dict[str, dict]:
+        routes = {}
+        for route, timings in sorted(self.timings.items()):
+            ordered = sorted(timings)
+            routes[route] = {
+                "count": len(ordered),
+                "errors": self.errors.get(route, 0),
+                "requests_per_second": round(len(ordered) / elapsed, 1),
+                "mean_ms": round(sum(ordered) / len(ordered), 2),
+                "p50_ms": round(percentile(ordered, 50), 2),
+                "p95_ms": round(percentile(ordered, 95), 2),
+                "p99_ms": round(percentile(ordered, 99), 2),
+                "max_ms": round(ordered[-1], 2),
+            }
+        return routes
+
+# Starts the app under uvicorn with a synthetic school of the given size
+# Login throttling is relaxed, since every virtual user logs in from the
+# same address
+def start_server(port: int, teachers: int, students: int,
+                 seed: int) -> subprocess.Popen:
+    env = dict(
+        os.environ,
+        SEED_TEACHERS=str(teachers),
+        SEED_STUDENTS=str(students),
+        SEED_RANDOM_SEED=str(seed),
+        LOGIN_IP_LIMIT="1000000",
+        LOGIN_USERNAME_LIMIT="1000000",
+    )
+    root = Path(__file__).parent
+    return subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "main:app", "--app-dir", "src",
+         "--port", str(port), "--log-level", "warning"],
+        cwd=root, env=env,
+    )
+
+# Waits until the server answers, or raises RuntimeError after timeout
+def wait_for_server(base_url: str, timeout: float = 120) -> None:
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            if requests.get(base_url, timeout=2).status_code == 200:
+                return
+        except requests.RequestException:
+            pass
+        time.sleep(0.5)
+    raise RuntimeError(f"Server at {base_url} did not start in {timeout} s")
+
+# Returns the credentials of the virtual users: the test accounts first,
+# then the seeded mock accounts, cycling if there are more users than
+# accounts
+def build_accounts(role: str, count: int,
+                   seeded: int) -> List[Tuple[str, str]]:
+    accounts = list(TEST_ACCOUNTS[role])
+    if role != "admin":
+        accounts += [
+            (f"{role}{i}", MOCK_PASSWORD) for i in range(2, seeded + 1)
+        ]
+    return [accounts[i % len(accounts)] for i in range(count)]
+
+# Logs a virtual user in, returning its session with the access token cookie
+def login(base_url: str, username: str, password: str,
+          recorder: LatencyRecorder) -> Optional[requests.Session]:
+    session = requests.Session()
+    start = time.perf_counter()
+    try:
+        response = session.post(
+            f"{base_url}/login", allow_redirects=False,
+            data={"username": username, "password": password},
+        )
+        ok = response.status_code == 303 and "access_token" in session.cookies
+    except requests.RequestException:
+        ok = False
+    recorder.record("POST /login", time.perf_counter() - start, ok)
+    return session if ok else None
+
+# Maps each teacher to their lessons, from the admin lesson export
+def load_lessons(base_url: str,
+                 admin: requests.Session) -> Dict[str, List[dict]]:
+    response = admin.get(f"{base_url}/admin/export/lessons",
+                         params={"format": "ndjson"})
+    response.raise_for_status()
+    lessons: Dict[str, List[dict]] = {}
+    for line in response.text.splitlines():
+        lesson = json.loads(line)
+        lessons.setdefault(lesson["teacher"], []).append(lesson)
+    return lessons
+
+# Re-saves a lesson unchanged through the edit form
+def edit_lesson(base_url: str, session: requests.Session,
+                lesson: dict) -> requests.Response:
+    return session.post(
+        f"{base_url}/lessons/{lesson['id']}/edit", allow_redirects=False,
+        data={field: lesson[field] for field in (
+            "subject", "teacher", "classroom", "day_of_week", "start_time",
+            "year_group")},
+    )
+
+# Runs one virtual user until the deadline, picking routes from its mix
+def run_user(base_url: str, role: str, username: str,
+             session: requests.Session, lessons: Dict[str, List[dict]],
+             deadline: float, recorder: LatencyRecorder, seed: int) -> None:
+    rng = random.Random(seed)
+    mix = ROUTE_MIX[role]
+    # Admins may edit any lesson, others only their own
+    if role == "admin":
+        owned = [lesson for found in lessons.values() for lesson in found]
+    else:
+        owned = lessons.get(username, [])
+    if not owned:
+        mix = {route: weight for route, weight in mix.items()
+               if route != "lesson_edit"}
+    routes, weights = list(mix), list(mix.values())
+    while time.time() < deadline:
+        route = rng.choices(routes, weights)[0]
+        # Failed requests are recorded under the same name as the rest
+        if route == "lesson_edit":
+            name = "POST /lessons/{id}/edit"
+        else:
+            name = f"GET {route}"
+        start = time.perf_counter()
+        try:
+            if route == "lesson_edit":
+                response = edit_lesson(base_url, session, rng.choice(owned))
+                ok = response.status_code == 303
+            else:
+                response = session.get(f"{base_url}{route}")
+                ok = response.status_code == 200
+        except requests.RequestException:
+            ok = False
+        recorder.record(name, time.perf_counter() - start, ok)
+
+def print_summary(routes: Dict[str, dict]) -> None:
+    print(f"\n{'Route':<28}{'Count':>8}{'Errors':>8}{'p50 ms':>10}"
+          f"{'p95 ms':>10}{'p99 ms':>10}{'req/s':>9}")
+    for route, stats in routes.items():
+        print(f"{route:<28}{stats['count']:>8}{stats['errors']:>8}"
+              f"{stats['p50_ms']:>10.1f}{stats['p95_ms']:>10.1f}"
+              f"{stats['p99_ms']:>10.1f}{stats['requests_per_second']:>9.1f}")
+
+def run_load_test(args) -> dict:
+    server = None
+    base_url = args.url
+    if not base_url:
+        base_url = f"http://127.0.0.1:{args.port}"
+        print(f"Starting server with {args.teachers} teachers and "
+              f"{args.students} students")
+        server = start_server(args.port, args.teachers, args.students,
+                              args.seed)
+    try:
+        wait_for_server(base_url)
+        recorder = LatencyRecorder()
+        mix = {"student": args.student_users, "teacher": args.teacher_users,
+               "admin": args.admin_users}
+        seeded = {"student": args.students, "teacher": args.teachers,
+                  "admin": 1}
+
+        print(f"Logging in {sum(mix.values())} virtual users")
+        users = []
+        with concurrent.futures.ThreadPoolExecutor(
+                max_workers=args.concurrency) as executor:
+            futures = {}
+            for role, count in mix.items():
+                for username, password in build_accounts(
+                        role, count, seeded[role]):
+                    future = executor.submit(login, base_url, username,
+                                             password, recorder)
+                    futures[future] = (role, username)
+            for future in concurrent.futures.as_completed(futures):
+                session = future.result()
+                if session is not None:
+                    users.append(futures[future] + (session,))
+
+        admin = login(base_url, *TEST_ACCOUNTS["admin"][0], recorder)
+        lessons = load_lessons(base_url, admin) if admin else {}
+
+        print(f"Running route mix for {args.duration} s with "
+              f"{len(users)} users")
+        started = time.time()
+        deadline = started + args.duration
+        with concurrent.futures.ThreadPoolExecutor(
+                max_workers=len(users) or 1) as executor:
+            runs = [
+                executor.submit(run_user, base_url, role, username, session,
+                                lessons, deadline, recorder, args.seed + index)
+                for index, (role, username, session) in enumerate(users)
+            ]
+            # Raises the first error a virtual user crashed with
+            for run in runs:
+                run.result()
+        elapsed = time.time() - started
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait()
+
+    routes = recorder.summary(elapsed)
+    print_summary(routes)
+    return {
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "base_url": base_url,
+        "config": {
+            "teachers": args.teachers,
+            "students": args.students,
+            "seed": args.seed,
+            "duration": args.duration,
+            "users": mix,
+            "logged_in": len(users),
+        },
+        "elapsed_seconds": round(elapsed, 2),
+        "routes": routes,
+    }
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Load test the LMS with logged in virtual users")
+    parser.add_argument("--url", help="test a running server instead of "
+                                      "starting one")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--teachers", type=int, default=50,
+                        help="mock teachers to seed")
+    parser.add_argument("--students", type=int, default=500,
+                        help="mock students to seed")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--student-users", type=int, default=30)
+    parser.add_argument("--teacher-users", type=int, default=10)
+    parser.add_argument("--admin-users", type=int, default=2)
+    parser.add_argument("--concurrency", type=int, default=10,
+                        help="parallel logins")
+    parser.add_argument("--duration", type=float, default=30,
+                        help="seconds to replay the route mix for")
+    parser.add_argument("--output", default="load_test_results.json",
+                        help="file the JSON results are written to")
+    args = parser.parse_args()
+
+    results = run_load_test(args)
+    with open(args.output, "w", encoding="utf-8") as output:
+        json.dump(results, output, indent=2)
+    print(f"\nResults written to {args.output}")
@@ -0,0 +1,393 @@
+# Admin routes for the LMS application
+# Timetables, exports, user import, statistics and the password
+# policy, mounted on the app by main
+
+# Standard library imports
+import asyncio
+import io
+from typing import List, Optional, Tuple
+
+# FastAPI and related imports
+from fastapi import (
+    APIRouter,
+    Depends,
+    File,
+    Form,
+    HTTPException,
+    Request,
+    UploadFile
+)
+from fastapi.responses import HTMLResponse, StreamingResponse
+
+# Local imports
+from auth import UserInDB, users_db
+from models import RegisterModel
+from app_state import (
+    BCRYPT_TARGET_MS,
+    apply_calibrated_password_policy,
+    check_admin,
+    create_user_timetable,
+    feed_cache,
+    get_current_user,
+    global_lessons_db,
+    lesson_list_page,
+    logger,
+    login_throttle,
+    password_pool,
+    render_cache,
+    render_scope,
+    session_cache,
+    timetable_grid_page,
+    timetables_db
+)
+from conditional import etag_headers, make_etag, not_modified
+from lesson_export import (
+    EXPORT_MEDIA_TYPES,
+    LESSON_FIELDS,
+    TIMETABLE_FIELDS,
+    iter_export,
+    lesson_row,
+    timetable_rows
+)
+from password_policy import current_bcrypt_rounds
+from token_blacklist import blacklisted_tokens
+from user_import import (
+    detect_format,
+    iter_batches,
+    iter_rows,
+    validate_batch
+)
+
+router = APIRouter()
+
+# Timetables shown per page of the admin view, and the most one page may hold
+TIMETABLE_PAGE_SIZE = 20
+TIMETABLE_PAGE_SIZE_MAX = 100
+
+# Returns the render cache key and context builder for a page of the admin
+# timetables view, which is the same for every admin
+def admin_timetables_page(
+    request: Request,
+    teacher: Optional[str] = None,
+    year_group: Optional[int] = None,
+    role: Optional[str] = None,
+    username: Optional[str] = None,
+    after: Optional[int] = None,
+    limit: int = TIMETABLE_PAGE_SIZE
+):
+    # The page shows owners' usernames, so users are versioned in too
+    key = (
+        str(request.base_url), request.url.query, timetables_db.version(),
+        users_db.version
+        )
+
+    def context() -> dict:
+        timetables, next_after = [], None
+        owner = users_db.get_by_username(username) if username else None
+        if not username or owner is not None:
+            timetables, next_after = timetables_db.page(
+                after,
+                limit=max(1, min(limit, TIMETABLE_PAGE_SIZE_MAX)),
+                teacher=teacher or None,
+                year_group=year_group,
+                role=role or None,
+                user_id=owner.id if owner is not None else None
+                )
+        owners = {}
+        for timetable in timetables:
+            user = users_db.get_by_id(timetable.user_id)
+            owners[timetable.id] = user.username if user is not None else None
+        return {
+            "request": request,
+            "timetables": timetables,
+            "owners": owners,
+            "teachers": timetables_db.teachers(),
+            "year_groups": timetables_db.year_groups(),
+            "roles": ["admin", "teacher", "student"],
+            "filters": {
+                "teacher": teacher or "",
+                "year_group": year_group or "",
+                "role": role or "",
+                "username": username or ""
+                },
+            "next_url": (
+                str(request.url.include_query_params(cursor=next_after))
+                if next_after is not None else None
+                )
+            }
+    return key, context
+
+# Renders the admin view of all timetables with optional filtering
+# Timetables are filtered through the timetable store's indexes and shown a
+# page at a time; the teacher and year group lists come from the same
+# indexes, so no lessons are scanned
+@router.get("/admin/timetables")
+async def admin_timetables(
+    request: Request,
+    current_user: UserInDB = Depends(get_current_user),
+    teacher: Optional[str] = None,
+    year_group: Optional[str] = None,
+    role: Optional[str] = None,
+    username: Optional[str] = None,
+    cursor: Optional[str] = None,
+    limit: int = TIMETABLE_PAGE_SIZE
+):
+    check_admin(current_user)
+
+    # The filter form submits empty fields for filters that are not set
+    try:
+        year_group = int(year_group) if year_group else None
+        after = int(cursor) if cursor else None
+    except ValueError as exc:
+        raise HTTPException(
+            status_code=400,
+            detail="Invalid year group or cursor"
+            ) from exc
+
+    # The page shows owners' usernames, so users are versioned in too
+    etag = make_etag(
+        "admin-timetables", timetables_db.version(), users_db.version,
+        current_user.id, request.url.query
+        )
+    unchanged = not_modified(request, etag)
+    if unchanged is not None:
+        return unchanged
+
+    key, context = admin_timetables_page(
+        request, teacher, year_group, role, username, after, limit
+        )
+    return HTMLResponse(
+        render_cache.render("admin_timetables.html", key, context),
+        headers=etag_headers(etag)
+        )
+
+# Yields the export rows of the timetables matching the admin filters
+# Timetables are read lazily, so the export starts with the first match
+def export_timetable_rows(teacher: Optional[str], year_group: Optional[int]):
+    for timetable in timetables_db.matching(
+        teacher=teacher or None, year_group=year_group or None
+        ):
+        owner = users_db.get_by_id(timetable.user_id)
+        yield from timetable_rows(
+            timetable, owner.username if owner is not None else None
+            )
+
+# Builds a streaming download of export rows in the requested format
+def export_response(rows, fmt: str, fields, name: str) -> StreamingResponse:
+    if fmt not in EXPORT_MEDIA_TYPES:
+        raise HTTPException(
+            status_code=400,
+            detail="Export format must be csv or ndjson"
+            )
+    return StreamingResponse(
+        iter_export(rows, fmt, fields),
+        media_type=EXPORT_MEDIA_TYPES[fmt],
+        headers={
+            "Content-Disposition": f'attachment; filename="{name}.{fmt}"'
+            }
+        )
+
+# Streams every lesson as CSV or NDJSON, in timetable order
+# Takes the same teacher and year group filters as the admin timetable view
+@router.get("/admin/export/lessons")
+async def export_lessons(
+    current_user: UserInDB = Depends(get_current_user),
+    format: str = "csv", # pylint: disable=redefined-builtin
+    teacher: Optional[str] = None,
+    year_group: Optional[int] = None
+):
+    check_admin(current_user)
+
+    rows = (
+        lesson_row(lesson) for lesson in global_lessons_db.iter_ordered(
+            teacher=teacher or None,
+            year_group=year_group or None
+            )
+        )
+    return export_response(rows, format, LESSON_FIELDS, "lessons")
+
+# Streams every timetable as CSV or NDJSON, one row per timetable lesson
+# Takes the same teacher and year group filters as the admin timetable view
+@router.get("/admin/export/timetables")
+async def export_timetables(
+    current_user: UserInDB = Depends(get_current_user),
+    format: str = "csv", # pylint: disable=redefined-builtin
+    teacher: Optional[str] = None,
+    year_group: Optional[int] = None
+):
+    check_admin(current_user)
+
+    rows = export_timetable_rows(teacher, year_group)
+    return export_response(rows, format, TIMETABLE_FIELDS, "timetables")
+
+# Adds the validated users of an import batch with their hashed passwords
+# and empty timetables, appending an error for each row that is rejected
+# Returns the number of users added
+def add_imported_users(
+    valid_rows: List[Tuple[int, RegisterModel]],
+    hashes: List[str],
+    errors: List[dict]
+    ) -> int:
+    added = 0
+    for (row_number, register_data), hashed_password in zip(
+        valid_rows, hashes
+        ):
+        # The username may have been registered during hashing
+        if register_data.username in users_db:
+            errors.append({
+                "row": row_number,
+                "error": "Username already registered"
+                })
+            continue
+        try:
+            new_user = UserInDB(
+                id=users_db.next_id(),
+                username=register_data.username,
+                email=register_data.email,
+                hashed_password=hashed_password,
+                role=register_data.role,
+                year_group=(
+                register_data.year_group
+                if register_data.role == "student"
+                else None
+                )
+            )
+        except ValueError as exc:
+            errors.append({"row": row_number, "error": str(exc)})
+            continue
+        users_db.add(new_user)
+        create_user_timetable(new_user)
+        added += 1
+    return added
+
+# Imports user accounts in bulk from a CSV or NDJSON upload
+# Rows are streamed from the upload and handled in batches: each batch is
+# validated like the registration form, its passwords are hashed across the
+# password pool, then its users and their empty timetables are inserted
+# Returns the number of users imported and an error for each rejected row
+@router.post("/admin/users/import")
+async def import_users(
+    file: UploadFile = File(...),
+    file_format: Optional[str] = Form(None),
+    current_user: UserInDB = Depends(get_current_user)
+    ):
+    check_admin(current_user)
+
+    fmt = detect_format(file.filename, file_format)
+    if fmt is None:
+        raise HTTPException(
+            status_code=400,
+            detail="Upload must be a .csv or .ndjson file"
+            )
+
+    imported = 0
+    errors = []
+    stream = io.TextIOWrapper(file.file, encoding="utf-8", newline="")
+    try:
+        for batch in iter_batches(iter_rows(stream, fmt)):
+            valid_rows, batch_errors = validate_batch(batch, users_db)
+            errors.extend(batch_errors)
+            try:
+                hashes = await password_pool.hash_batch(
+                    [register_data.password for _, register_data in valid_rows]
+                    )
+            except HTTPException:
+                # The password pool is too busy; earlier batches have
+                # already been imported
+                errors.append({
+                    "row": valid_rows[0][0],
+                    "error": "Server is busy, import stopped at this row"
+                    })
+                break
+            imported += add_imported_users(valid_rows, hashes, errors)
+    except UnicodeDecodeError:
+        # Rows before the undecodable text have already been imported
+        errors.append({
+            "row": None,
+            "error": "Upload must be UTF-8 encoded text, import stopped"
+            })
+    finally:
+        stream.detach()
+
+    return {"imported": imported, "errors": errors}
+
+# Returns runtime statistics for the in-memory caches
+@router.get("/admin/stats")
+async def admin_stats(current_user: UserInDB = Depends(get_current_user)):
+    check_admin(current_user)
+    return {
+        "session_cache": session_cache.stats(),
+        "feed_cache": feed_cache.stats(),
+        "password_pool": password_pool.stats(),
+        "token_blacklist": {"size": len(blacklisted_tokens)},
+        "login_throttle": login_throttle.stats(),
+        "render_cache": render_cache.stats()
+        }
+
+# Returns a GET request for another page of the site, on the same host as
+# request, so that page can be rendered with the right links
+def page_request(request: Request, route_name: str) -> Request:
+    path = request.app.url_path_for(route_name)
+    return Request(dict(
+        request.scope, method="GET", path=path, raw_path=path.encode(),
+        query_string=b""
+        ))
+
+# Yields render cache jobs for the first page of the lesson list, the
+# timetable grid and the admin timetables view, for every role scope
+def render_warm_jobs(request: Request):
+    lessons_request = page_request(request, "list_lessons")
+    scopes = {}
+    for user in users_db:
+        scopes.setdefault(render_scope(user), user)
+    for user in scopes.values():
+        teacher = user.username if user.role == "teacher" else None
+        year_group = user.year_group if user.role == "student" else None
+        yield ("lesson_list.html",) + lesson_list_page(
+            lessons_request, user.role, teacher, year_group
+            )
+        timetable = next(iter(timetables_db.for_user(user.id)), None)
+        if timetable is not None:
+            yield ("timetable_grid.html",) + timetable_grid_page(
+                user, timetable
+                )
+    yield ("admin_timetables.html",) + admin_timetables_page(
+        page_request(request, "admin_timetables")
+        )
+
+# Renders the pages every role scope sees first, e.g. after a deploy or a
+# bulk import, so the first visitors skip rendering too
+@router.post("/admin/render-cache/warm")
+async def warm_render_cache(
+    request: Request,
+    current_user: UserInDB = Depends(get_current_user)
+):
+    check_admin(current_user)
+    rendered = render_cache.warm(render_warm_jobs(request))
+    logger.info("Warmed the render cache with %d pages", rendered)
+    return {"rendered": rendered, "render_cache": render_cache.stats()}
+
+# Returns the current password hashing policy
+@router.get("/admin/password-policy")
+async def password_policy(current_user: UserInDB = Depends(get_current_user)):
+    check_admin(current_user)
+    return {
+        "bcrypt_rounds": current_bcrypt_rounds(),
+        "target_ms": BCRYPT_TARGET_MS
+        }
+
+# Recalibrates the bcrypt cost on this machine and applies it
+# The benchmark runs on a worker thread so other requests are not blocked
+@router.post("/admin/password-policy/calibrate")
+async def calibrate_password_policy(
+    current_user: UserInDB = Depends(get_current_user)
+    ):
+    check_admin(current_user)
+    result = await asyncio.get_running_loop().run_in_executor(
+        None, apply_calibrated_password_policy
+        )
+    return {
+        "bcrypt_rounds": result["rounds"],
+        "measured_ms": result["measured_ms"],
+        "target_ms": BCRYPT_TARGET_MS
+        }
@@ -0,0 +1,185 @@
+# Timetable analytics for the LMS application
+# Keeps a dense count of lessons per resource, day and hour for teachers,
+# classrooms and year groups, updated on every lesson write, so the admin
+# reports are NumPy reductions over an array instead of loops over lessons
+
+# Standard library imports
+from typing import Dict, Hashable, List, Optional, Set, Tuple
+
+# Third-party imports for array maths
+import numpy as np
+
+# Local imports
+from conflicts import DAY_INDEX, HOURS_PER_DAY, lesson_resources
+# The school week the percentages are measured against
+from scheduler import SCHOOL_DAYS, SCHOOL_HOURS
+
+# Resource kinds tracked, matching conflicts.lesson_resources
+RESOURCE_KINDS = ("teacher", "classroom", "year_group")
+
+# Rows allocated for a resource kind the first time it is used
+INITIAL_ROWS = 64
+
+# Returns the (day, first hour, last hour + 1) a lesson occupies
+# Uses the same hour rounding as the conflict grid
+def lesson_span(lesson) -> Optional[Tuple[int, int, int]]:
+    day = DAY_INDEX.get(lesson.day_of_week)
+    if day is None:
+        return None
+    first_hour = lesson.start_time.hour
+    last_hour = lesson.end_time.hour + (1 if lesson.end_time.minute else 0)
+    return day, first_hour, max(first_hour + 1, last_hour)
+
+
+# Lesson counts as a (resource, day, hour) array for each resource kind
+# Must be updated with add and remove whenever a lesson is written
+# A resource gets a row with its first lesson and loses it with its last,
+# unless it was registered, so reassigned teachers and rooms no longer in
+# use drop out of the reports
+class OccupancyTensor:
+    def __init__(self):
+        self._counts: Dict[str, np.ndarray] = {}
+        # kind -> resource key -> row, and the keys in row order
+        self._rows: Dict[str, Dict[Hashable, int]] = {}
+        self._keys: Dict[str, List[Hashable]] = {}
+        # kind -> resource key -> number of lessons, and registered keys
+        self._lessons: Dict[str, Dict[Hashable, int]] = {}
+        self._registered: Dict[str, Set[Hashable]] = {}
+        for kind in RESOURCE_KINDS:
+            self._counts[kind] = np.zeros(
+                (INITIAL_ROWS, len(DAY_INDEX), HOURS_PER_DAY), dtype=np.int32
+                )
+            self._rows[kind] = {}
+            self._keys[kind] = []
+            self._lessons[kind] = {}
+            self._registered[kind] = set()
+        # The school week is a contiguous block of days and hours, so it is
+        # sliced out as a view rather than copied
+        self._school_days = slice(
+            DAY_INDEX[SCHOOL_DAYS[0]], DAY_INDEX[SCHOOL_DAYS[-1]] + 1
+            )
+        self._school_hours = slice(SCHOOL_HOURS[0], SCHOOL_HOURS[-1] + 1)
+
+    # Makes a resource known, so it is reported even while it has no lessons
+    # Returns its row in the array
+    def register(self, kind: str, key: Hashable) -> int:
+        self._registered[kind].add(key)
+        return self._row(kind, key)
+
+    # Counts a lesson in the hours it occupies
+    def add(self, lesson):
+        self._shift(lesson, 1)
+
+    # Stops counting a lesson
+    def remove(self, lesson):
+        self._shift(lesson, -1)
+
+    # Forgets every lesson and resource
+    def clear(self):
+        for kind in RESOURCE_KINDS:
+            self._counts[kind][:] = 0
+            self._rows[kind].clear()
+            self._keys[kind].clear()
+            self._lessons[kind].clear()
+            self._registered[kind].clear()
+
+    # Returns the keys of the resources of a kind, in row order
+    def keys(self, kind: str) -> List[Hashable]:
+        return list(self._keys[kind])
+
+    # Returns each resource's share of school hours that are booked, as a
+    # percentage
+    def utilization(self, kind: str) -> Dict[Hashable, float]:
+        busy = self._school_week(kind) > 0
+        percent = busy.sum(axis=(1, 2)) * 100.0 / (
+            busy.shape[1] * busy.shape[2]
+            )
+        return dict(zip(self._keys[kind], np.round(percent, 1).tolist()))
+
+    # Returns the booked lesson hours of each resource over the whole week
+    def contact_hours(self, kind: str) -> Dict[Hashable, int]:
+        hours = self._used(kind).sum(axis=(1, 2))
+        return dict(zip(self._keys[kind], hours.tolist()))
+
+    # Returns the school hours with the most resources of a kind busy,
+    # busiest first, as dicts of day, hour, busy count and percentage
+    def peak_hours(self, kind: str, limit: int = 5) -> List[dict]:
+        busy = (self._school_week(kind) > 0).sum(axis=0)
+        order = np.argsort(-busy, axis=None, kind="stable")[:limit]
+        total = max(1, len(self._keys[kind]))
+        # Flat indices into the (day, hour) array
+        days, hours = divmod(order, busy.shape[1])
+        return [
+            {
+                "day": SCHOOL_DAYS[day],
+                "hour": SCHOOL_HOURS[hour],
+                "busy": int(busy[day, hour]),
+                "percent": round(float(busy[day, hour]) * 100.0 / total, 1)
+                }
+            for day, hour in zip(days.tolist(), hours.tolist())
+            ]
+
+    # Returns the resources with nothing booked, either in a given hour or,
+    # without one, for the whole school week
+    def idle(self, kind: str, day: Optional[str] = None,
+             hour: Optional[int] = None) -> List[Hashable]:
+        used = self._used(kind)
+        if day is not None and hour is not None:
+            busy = used[:, DAY_INDEX[day], hour] > 0
+        else:
+            busy = (self._school_week(kind) > 0).any(axis=(1, 2))
+        return [
+            self._keys[kind][row] for row in np.flatnonzero(~busy).tolist()
+            ]
+
+    # Returns the counts of the resources of a kind that have rows
+    def _used(self, kind: str) -> np.ndarray:
+        return self._counts[kind][:len(self._keys[kind])]
+
+    # Returns the counts restricted to school days and hours
+    def _school_week(self, kind: str) -> np.ndarray:
+        return self._used(kind)[:, self._school_days, self._school_hours]
+
+    # Returns the row of a resource, adding one at the end if it has none
+    def _row(self, kind: str, key: Hashable) -> int:
+        rows = self._rows[kind]
+        row = rows.get(key)
+        if row is None:
+            row = rows[key] = len(self._keys[kind])
+            self._keys[kind].append(key)
+            counts = self._counts[kind]
+            if row >= counts.shape[0]:
+                grown = np.zeros((counts.shape[0] * 2,) + counts.shape[1:],
+                                 dtype=counts.dtype)
+                grown[:counts.shape[0]] = counts
+                self._counts[kind] = grown
+        return row
+
+    # Removes a resource's row, moving the last row into its place so the
+    # used rows stay contiguous
+    def _drop(self, kind: str, key: Hashable):
+        rows, keys = self._rows[kind], self._keys[kind]
+        counts = self._counts[kind]
+        row = rows.pop(key)
+        last = len(keys) - 1
+        last_key = keys.pop()
+        if row != last:
+            keys[row] = last_key
+            rows[last_key] = row
+            counts[row] = counts[last]
+        counts[last] = 0
+
+    def _shift(self, lesson, step: int):
+        span = lesson_span(lesson)
+        if span is None:
+            return
+        day, first_hour, end_hour = span
+        for kind, key in lesson_resources(lesson):
+            row = self._row(kind, key)
+            self._counts[kind][row, day, first_hour:end_hour] += step
+            lessons = self._lessons[kind]
+            lessons[key] = lessons.get(key, 0) + step
+            if lessons[key] <= 0:
+                del lessons[key]
+                if key not in self._registered[kind]:
+                    self._drop(kind, key)
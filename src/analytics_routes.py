@@ -0,0 +1,83 @@
+# Admin analytics routes for the LMS application
+# Reports over the lesson occupancy array, mounted on the app by main
+
+# Standard library imports
+from typing import Optional
+
+# FastAPI and related imports
+from fastapi import APIRouter, Depends, HTTPException
+
+# Local imports
+from auth import UserInDB
+from analytics import SCHOOL_HOURS
+from app_state import (
+    check_analytics_request,
+    get_current_user,
+    lesson_occupancy
+)
+from conflicts import DAY_INDEX
+
+router = APIRouter()
+
+# Returns the percentage of school hours each resource is booked for
+@router.get("/admin/analytics/utilization")
+async def analytics_utilization(
+    kind: str = "classroom",
+    current_user: UserInDB = Depends(get_current_user)
+    ):
+    check_analytics_request(current_user, kind)
+    utilization = lesson_occupancy.utilization(kind)
+    return {
+        "kind": kind,
+        "utilization": utilization,
+        "average": (
+            round(sum(utilization.values()) / len(utilization), 1)
+            if utilization else 0.0
+            )
+        }
+
+# Returns the school hours when the most resources are busy
+@router.get("/admin/analytics/peak-hours")
+async def analytics_peak_hours(
+    kind: str = "classroom",
+    limit: int = 5,
+    current_user: UserInDB = Depends(get_current_user)
+    ):
+    check_analytics_request(current_user, kind)
+    return {
+        "kind": kind,
+        "peak_hours": lesson_occupancy.peak_hours(kind, max(1, limit))
+        }
+
+# Returns the classrooms free in a given hour, or all week if none is given
+@router.get("/admin/analytics/idle-rooms")
+async def analytics_idle_rooms(
+    day: Optional[str] = None,
+    hour: Optional[int] = None,
+    current_user: UserInDB = Depends(get_current_user)
+    ):
+    check_analytics_request(current_user, "classroom")
+    if (day is None) != (hour is None) or (
+        day is not None and (day not in DAY_INDEX or hour not in SCHOOL_HOURS)
+        ):
+        raise HTTPException(
+            status_code=400,
+            detail="Give both a school day and a school hour, or neither"
+            )
+    return {
+        "day": day,
+        "hour": hour,
+        "idle_rooms": lesson_occupancy.idle("classroom", day, hour)
+        }
+
+# Returns the weekly lesson hours of each teacher (or other resource)
+@router.get("/admin/analytics/contact-hours")
+async def analytics_contact_hours(
+    kind: str = "teacher",
+    current_user: UserInDB = Depends(get_current_user)
+    ):
+    check_analytics_request(current_user, kind)
+    return {
+        "kind": kind,
+        "contact_hours": lesson_occupancy.contact_hours(kind)
+        }
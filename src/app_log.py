@@ -0,0 +1,186 @@
+# Application logging for the LMS
+# Built on the standard logging module, with three additions for the hot
+# paths:
+# - Records are put on a queue by the request and written to the output by
+#   a background thread, so a request never waits on stdout
+# - Routine records of busy routes can be sampled, e.g. one login in a
+#   hundred is logged, while warnings and errors are always kept
+# - Messages use logging's lazy %-formatting, and LazyArg defers building an
+#   expensive argument, so a disabled record costs a level check and nothing
+#   else
+
+# Standard library imports
+import atexit
+import json
+import logging
+import queue
+import sys
+from contextvars import ContextVar
+from logging.handlers import QueueHandler, QueueListener
+from typing import Callable, Dict, Optional
+
+# Every application logger is a child of this one
+ROOT_LOGGER = "lms"
+
+# Path of the request being handled, "-" outside a request
+current_route: ContextVar[str] = ContextVar("current_route", default="-")
+
+# Holds the listener writing queued records to the output, once logging is
+# configured
+class _Output:
+    listener: Optional[QueueListener] = None
+
+
+# Returns the logger for a part of the application, e.g. get_logger("auth")
+def get_logger(name: str) -> logging.Logger:
+    return logging.getLogger(f"{ROOT_LOGGER}.{name}")
+
+
+# Defers a log argument until the record is actually formatted
+# log.debug("Users: %s", LazyArg(list, users_db)) never copies users_db
+# when debug logging is off
+class LazyArg:
+    def __init__(self, func: Callable, *args):
+        self.func = func
+        self.args = args
+
+    def __str__(self) -> str:
+        return str(self.func(*self.args))
+
+    __repr__ = __str__
+
+
+# Parses per-route sample rates from "path=rate,path=rate", e.g.
+# "/login=0.01,/timetables=0.1"
+# Raises ValueError if a rate is not a number between 0 and 1
+def parse_sample_rates(text: str) -> Dict[str, float]:
+    rates = {}
+    for item in text.split(","):
+        if not item.strip():
+            continue
+        path, _, rate = item.partition("=")
+        value = float(rate)
+        if not 0 <= value <= 1:
+            raise ValueError(f"Sample rate out of range: {item}")
+        rates[path.strip()] = value
+    return rates
+
+
+# Keeps a share of the records logged while handling each route
+# A route's rate is the one for the longest path prefix that matches it;
+# routes without one are not sampled
+# Records at or above always_level pass regardless
+# Sampling is deterministic: with a rate of 0.1 every tenth record passes
+# Records from different threads may race on the count, which only makes
+# the share kept approximate
+class RouteSampler(logging.Filter):
+    def __init__(self, rates: Dict[str, float],
+                 always_level: int = logging.WARNING):
+        super().__init__()
+        self.rates = dict(rates)
+        # Longest prefix first, so the most specific rate wins
+        self._prefixes = sorted(rates, key=len, reverse=True)
+        self.always_level = always_level
+        self._credit: Dict[str, float] = {}
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        route = getattr(record, "route", None) or current_route.get()
+        record.route = route
+        if record.levelno >= self.always_level:
+            return True
+        prefix = self._prefix(route)
+        if prefix is None or self.rates[prefix] >= 1:
+            return True
+        # Each record earns its rate as credit; a record passes when a whole
+        # one has built up
+        credit = self._credit.get(prefix, 0.0) + self.rates[prefix]
+        if credit >= 1:
+            self._credit[prefix] = credit - 1
+            return True
+        self._credit[prefix] = credit
+        return False
+
+    # Returns the sample rate for a route
+    def rate(self, route: str) -> float:
+        prefix = self._prefix(route)
+        return 1.0 if prefix is None else self.rates[prefix]
+
+    def _prefix(self, route: str) -> Optional[str]:
+        for prefix in self._prefixes:
+            if route.startswith(prefix):
+                return prefix
+        return None
+
+
+# Formats records as one JSON object per line, for log collectors
+class JsonFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "time": self.formatTime(record),
+            "level": record.levelname,
+            "logger": record.name,
+            "route": getattr(record, "route", "-"),
+            "message": record.getMessage()
+            }
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entry)
+
+
+TEXT_FORMAT = "%(asctime)s %(levelname)s %(name)s [%(route)s] %(message)s"
+
+# Sets up the application loggers
+# level is a logging level name, fmt is "text" or "json", and sample_rates
+# maps route prefixes to the share of their records kept
+# Records are queued by the caller and written to output (stderr by
+# default) on a background thread, which is flushed at exit
+# Calling it again replaces the previous configuration
+def configure_logging(level: str = "INFO", fmt: str = "text",
+                      sample_rates: Optional[Dict[str, float]] = None,
+                      output=None) -> logging.Logger:
+    stop_logging()
+
+    handler = logging.StreamHandler(output or sys.stderr)
+    handler.setFormatter(
+        JsonFormatter() if fmt == "json" else logging.Formatter(TEXT_FORMAT)
+        )
+    records: queue.SimpleQueue = queue.SimpleQueue()
+    queue_handler = QueueHandler(records)
+    # Sampled out records are dropped before they are formatted or queued
+    queue_handler.addFilter(RouteSampler(sample_rates or {}))
+
+    logger = logging.getLogger(ROOT_LOGGER)
+    for old_handler in list(logger.handlers):
+        logger.removeHandler(old_handler)
+    logger.addHandler(queue_handler)
+    logger.setLevel(level.upper())
+    logger.propagate = False
+
+    _Output.listener = QueueListener(records, handler)
+    _Output.listener.start()
+    return logger
+
+# Writes out any queued records and stops the background thread
+def stop_logging():
+    if _Output.listener is not None:
+        _Output.listener.stop()
+        _Output.listener = None
+
+atexit.register(stop_logging)
+
+
+# ASGI middleware recording the path of each request in current_route, so
+# records logged while handling it can be sampled and tagged by route
+class RouteContextMiddleware:
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        token = current_route.set(scope["path"])
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            current_route.reset(token)
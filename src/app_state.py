@@ -0,0 +1,308 @@
+# Shared state of the LMS application
+# The stores, caches and worker pools, and the helpers that keep them
+# in step, used by the routes in main and in the route modules
+
+# Standard library imports
+import os
+from datetime import date, timedelta
+from typing import List, Optional
+
+# FastAPI and related imports
+from fastapi import HTTPException, Request, status
+from fastapi.templating import Jinja2Templates
+
+# Third-party imports for JWT handling
+from jose import jwt, JWTError
+
+# Local imports
+from auth import ALGORITHM, get_user, SECRET_KEY, UserInDB
+from models import Lesson, LessonOccurrence, Timetable
+from analytics import RESOURCE_KINDS, OccupancyTensor
+from app_log import get_logger
+from conflicts import OccupancyGrid
+from ical_feed import FeedCache
+from lesson_store import LessonStore, OrderKey
+from login_throttle import LoginThrottle
+from password_policy import apply_bcrypt_rounds, calibrate_bcrypt_rounds
+from password_pool import PasswordPool
+from render_cache import RenderCache
+from session_cache import SessionCache
+from term_calendar import IntervalIndex, TermCalendar
+from timetable_store import TimetableStore
+from token_blacklist import is_blacklisted
+
+logger = get_logger("app")
+# Set up Jinja2 HTML templates
+templates = Jinja2Templates(directory="templates")
+
+# Initialise empty databases
+global_lessons_db = LessonStore() # Simulated database for lessons
+# When each teacher, classroom and year group is busy, for conflict checks
+lesson_grid = OccupancyGrid()
+# Lesson counts per teacher, classroom and year group, for admin analytics
+lesson_occupancy = OccupancyTensor()
+timetables_db = TimetableStore() # Simulated database for timetable
+# Terms, holidays and one-off lesson changes, which turn the weekly lessons
+# into dated occurrences
+term_calendar = TermCalendar()
+# Each resource's weekly lesson times, for date range queries
+lesson_intervals = IntervalIndex()
+
+# Lessons shown per page of the lesson list, and the most one page may hold
+LESSON_PAGE_SIZE = 50
+LESSON_PAGE_SIZE_MAX = 200
+
+# Longest date range lesson occurrences can be listed for in one request
+OCCURRENCE_RANGE_MAX_DAYS = 366
+
+# Throttles login attempts by username and client IP
+# Only failed logins count, per username and per IP
+LOGIN_USERNAME_LIMIT = int(os.environ.get("LOGIN_USERNAME_LIMIT", 5))
+LOGIN_IP_LIMIT = int(os.environ.get("LOGIN_IP_LIMIT", 100))
+LOGIN_WINDOW_SECONDS = int(os.environ.get("LOGIN_WINDOW_SECONDS", 300))
+login_throttle = LoginThrottle(
+    username_limit=LOGIN_USERNAME_LIMIT,
+    ip_limit=LOGIN_IP_LIMIT,
+    window_seconds=LOGIN_WINDOW_SECONDS
+    )
+
+# Cache of generated iCalendar feeds, one per user
+FEED_CACHE_SIZE = 10000
+feed_cache = FeedCache(max_size=FEED_CACHE_SIZE)
+
+# Cache of verified tokens, so repeat requests skip JWT decoding
+SESSION_CACHE_SIZE = 10000
+session_cache = SessionCache(max_size=SESSION_CACHE_SIZE)
+
+# Cache of rendered pages shared by everyone in a role scope, capped by the
+# memory the HTML takes
+RENDER_CACHE_MAX_BYTES = int(
+    os.environ.get("RENDER_CACHE_MAX_BYTES", 32 * 1024 * 1024)
+    )
+render_cache = RenderCache(templates.env, max_bytes=RENDER_CACHE_MAX_BYTES)
+
+# Pool that runs bcrypt off the event loop
+# PASSWORD_POOL_KIND is "thread" or "process"
+PASSWORD_POOL_KIND = os.environ.get("PASSWORD_POOL_KIND", "thread")
+PASSWORD_POOL_WORKERS = int(
+    os.environ.get("PASSWORD_POOL_WORKERS", os.cpu_count() or 2)
+    )
+PASSWORD_POOL_MAX_QUEUE = int(os.environ.get("PASSWORD_POOL_MAX_QUEUE", 100))
+password_pool = PasswordPool(
+    kind=PASSWORD_POOL_KIND,
+    workers=PASSWORD_POOL_WORKERS,
+    max_queue=PASSWORD_POOL_MAX_QUEUE
+    )
+
+# Target time for one password verification, used to pick the bcrypt cost
+# Calibration runs at startup only if BCRYPT_CALIBRATE_ON_STARTUP is set,
+# otherwise it can be run on demand from /admin/password-policy/calibrate
+BCRYPT_TARGET_MS = float(os.environ.get("BCRYPT_TARGET_MS", 250))
+BCRYPT_CALIBRATE_ON_STARTUP = (
+    os.environ.get("BCRYPT_CALIBRATE_ON_STARTUP", "") not in ("", "0")
+    )
+
+# Helper functions
+# Calibrates the bcrypt cost to BCRYPT_TARGET_MS and makes it the policy
+# Process workers are restarted so they pick up the new policy; logins
+# arriving meanwhile go to the new workers
+def apply_calibrated_password_policy() -> dict:
+    result = calibrate_bcrypt_rounds(BCRYPT_TARGET_MS)
+    apply_bcrypt_rounds(result["rounds"])
+    password_pool.restart()
+    logger.info("Password policy: bcrypt cost %s (%s ms per verification)",
+                result["rounds"], result["measured_ms"])
+    return result
+
+# Returns the lessons shown on a user's timetable, from the store's indexes
+# Admins see every lesson, teachers their own and students their year group's
+def audience_lessons(user: UserInDB) -> List[Lesson]:
+    if user.role == "admin":
+        return list(global_lessons_db)
+    if user.role == "teacher":
+        return global_lessons_db.by_teacher(user.username)
+    return global_lessons_db.by_year_group(user.year_group)
+
+# Returns the scope a user's pages are shared within: every admin sees the
+# same pages, a teacher their own lessons and a student their year group's
+def render_scope(user: UserInDB) -> tuple:
+    if user.role == "admin":
+        return ("admin",)
+    if user.role == "teacher":
+        return ("teacher", user.username)
+    return ("year_group", user.year_group)
+
+# Creates a timetable for the current week for a new user
+def create_user_timetable(user: UserInDB) -> Timetable:
+    new_timetable = Timetable(
+        id=timetables_db.next_id(),
+        user_id=user.id,
+        week_start=date.today() - timedelta(days=date.today().weekday()),
+        week_end=date.today() + timedelta(days=6),
+        lessons=audience_lessons(user)
+    )
+    return timetables_db.add(new_timetable, user)
+
+# Retrieves the current user based on the JWT token in the request cookies
+# Revoked tokens are rejected first, then tokens already verified are
+# answered from the session cache until they expire
+async def get_current_user(request: Request):
+    token = request.cookies.get("access_token")
+    if not token:
+        raise HTTPException(
+          status_code=status.HTTP_401_UNAUTHORIZED,
+          detail="Not authenticated"
+        )
+
+    scheme, _, param = token.partition(" ")
+    if scheme.lower() != "bearer":
+        raise HTTPException(
+          status_code=status.HTTP_401_UNAUTHORIZED,
+          detail="Invalid authentication scheme"
+        )
+
+    if is_blacklisted(param):
+        raise HTTPException(
+          status_code=status.HTTP_401_UNAUTHORIZED,
+          detail="Token has been revoked"
+        )
+
+    cached_user = session_cache.get(param)
+    if cached_user is not None:
+        return cached_user
+
+    try:
+        payload = jwt.decode(param, SECRET_KEY, algorithms=[ALGORITHM])
+        username: str = payload.get("sub")
+        if username is None:
+            raise HTTPException(
+                status_code=status.HTTP_401_UNAUTHORIZED,
+                detail="Invalid token"
+                )
+        user = get_user(username)
+        if user is None:
+            raise HTTPException(
+                status_code=status.HTTP_401_UNAUTHORIZED,
+                detail="User not found"
+                )
+        if payload.get("exp") is not None:
+            session_cache.put(param, user, payload["exp"])
+        return user
+    except JWTError as exc:
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            detail="Invalid token"
+            ) from exc
+
+# Builds the error for a lesson that clashes with the given resources
+def lesson_conflict_error(clashes) -> HTTPException:
+    resources = ", ".join(clash.replace("_", " ") for clash in clashes)
+    return HTTPException(
+        status_code=400,
+        detail=f"This lesson conflicts with an existing lesson "
+               f"for the same {resources}"
+        )
+
+# Returns the render cache key and context builder for a page of the
+# lesson list
+# role, teacher and year_group are the viewer's, after their role has been
+# applied to the filters; the page shows nothing else about the viewer, so
+# it is shared by everyone with the same scope and query
+def lesson_list_page(
+    request: Request,
+    role: str,
+    teacher: Optional[str] = None,
+    year_group: Optional[int] = None,
+    subject: Optional[str] = None,
+    day: Optional[str] = None,
+    classroom: Optional[str] = None,
+    after: Optional[OrderKey] = None,
+    limit: int = LESSON_PAGE_SIZE
+):
+    key = (
+        str(request.base_url), role, teacher, year_group, request.url.query,
+        global_lessons_db.version()
+        )
+
+    def context() -> dict:
+        lessons, next_cursor = [], None
+        if role in ['admin', 'teacher'] or year_group is not None:
+            lessons, next_cursor = global_lessons_db.page(
+                after,
+                limit=max(1, min(limit, LESSON_PAGE_SIZE_MAX)),
+                teacher=teacher or None,
+                year_group=year_group,
+                subject=subject or None,
+                day_of_week=day or None,
+                classroom=classroom or None
+                )
+        return {
+            "request": request,
+            "lessons": lessons,
+            "current_user": {"role": role},
+            "filters": {
+                "teacher": teacher or "",
+                "year_group": year_group or "",
+                "subject": subject or "",
+                "day": day or "",
+                "classroom": classroom or ""
+                },
+            "next_url": (
+                str(request.url.include_query_params(cursor=next_cursor))
+                if next_cursor else None
+                )
+            }
+    return key, context
+
+# Returns the render cache key and context builder for the lesson grid of a
+# user's timetable
+# Timetables hold their owner's audience lessons, so the grid only changes
+# with the user's scope and the lesson store
+def timetable_grid_page(user: UserInDB, timetable: Timetable):
+    key = (render_scope(user), global_lessons_db.version())
+
+    # Lessons grouped by day are cached by the store until they change
+    def context() -> dict:
+        return {"lessons_by_day": timetables_db.lessons_by_day(timetable.id)}
+    return key, context
+
+# Checks a date range is in order and not longer than
+# OCCURRENCE_RANGE_MAX_DAYS
+def check_occurrence_range(start: date, end: date):
+    if end < start or (end - start).days >= OCCURRENCE_RANGE_MAX_DAYS:
+        raise HTTPException(
+            status_code=400,
+            detail=("end must not be before start, and the range must be "
+                    f"shorter than {OCCURRENCE_RANGE_MAX_DAYS} days")
+            )
+
+# Converts occurrences for a response
+def occurrence_models(occurrences) -> List[LessonOccurrence]:
+    return [
+        LessonOccurrence(
+            date=occurrence.date,
+            start=occurrence.start,
+            end=occurrence.end,
+            lesson=occurrence.lesson
+            )
+        for occurrence in occurrences
+        ]
+
+# Checks the user is an admin
+def check_admin(current_user: UserInDB):
+    if current_user.role != "admin":
+        raise HTTPException(
+            status_code=403,
+            detail="Only administrators can access this page"
+            )
+
+# Reports are reductions over the lesson occupancy array, which is kept up
+# to date by every lesson write, so no lessons are read to answer them
+# Checks the user is an admin and the resource kind is one that is tracked
+def check_analytics_request(current_user: UserInDB, kind: str):
+    check_admin(current_user)
+    if kind not in RESOURCE_KINDS:
+        raise HTTPException(
+            status_code=400,
+            detail=f"kind must be one of: {', '.join(RESOURCE_KINDS)}"
+            )
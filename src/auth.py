@@ -1,4 +1,5 @@
 # Standard library imports
+import uuid
 from datetime import datetime, timedelta
 from typing import List, Optional
 
@@ -11,6 +12,9 @@ from jose import jwt, JWTError
 from passlib.context import CryptContext
 from pydantic import BaseModel, EmailStr
 
+# Local imports
+from user_repository import UserRepository
+
 # The secret key used for JWT encoding and decoding
 SECRET_KEY = "your-secret-key"  # Replace with a real secret key in production
 
@@ -27,6 +31,10 @@ oauth2_scheme = OAuth2PasswordBearer(tokenUrl="token")
 # Password hashing context using bcrypt
 pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
 
+# In-memory user repository, shared with the main module
+# In a production environment, this would be replaced with a proper database
+users_db = UserRepository()
+
 # Pydantic models
 # Pydantic model representing a user in the database
 class UserInDB(BaseModel):
@@ -55,6 +63,10 @@ class TokenData(BaseModel):
 def verify_password(plain_password, hashed_password):
     return pwd_context.verify(plain_password, hashed_password)
 
+# Generates a hash for the given password
+def get_password_hash(password):
+    return pwd_context.hash(password)
+
 # Authenticates a user based on username and password.
 # Returns the user if authentication is successful, False otherwise
 def authenticate_user(username: str, password: str):
@@ -66,13 +78,15 @@ def authenticate_user(username: str, password: str):
     return user
 
 # Creates a JWT access token with the given data and expiration time
+# Each token gets a unique jti, so two logins in the same second never
+# produce the same token and revoking one leaves the other valid
 def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
     to_encode = data.copy()
     if expires_delta:
         expire = datetime.utcnow() + expires_delta
     else:
         expire = datetime.utcnow() + timedelta(minutes=15)
-    to_encode.update({"exp": expire})
+    to_encode.update({"exp": expire, "jti": uuid.uuid4().hex})
     encoded_jwt = jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
     return encoded_jwt
 
@@ -97,11 +111,4 @@ def decode_access_token(token: str):
 # Retrieves a user from the database by username
 # Returns the user if found, None otherwise
 def get_user(username: str) -> Optional[UserInDB]:
-    for user in users_db:
-        if user.username == username:
-            return user
-    return None
-
-# In-memory user database
-# In a production environment, this would be replaced with a proper database
-users_db = []
+    return users_db.get_by_username(username)
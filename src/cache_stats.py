@@ -0,0 +1,33 @@
+# Lookup statistics shared by the LMS application's caches
+# The session, feed and render caches all report how many lookups they
+# answered and missed, for the admin stats page
+
+# Counts a cache's hits and misses
+# Caches inherit from it, call hit or miss on every lookup and add
+# lookup_stats to their own statistics
+class CacheStats:
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+
+    # Records a lookup answered from the cache
+    def hit(self):
+        self.hits += 1
+
+    # Records a lookup the cache could not answer
+    def miss(self):
+        self.misses += 1
+
+    # Sets the counters back to zero
+    def reset_lookups(self):
+        self.hits = 0
+        self.misses = 0
+
+    # Returns the counters and the share of lookups that were hits
+    def lookup_stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 3) if lookups else 0.0
+            }
@@ -0,0 +1,136 @@
+# Term calendar routes for the LMS application
+# Terms, holidays, one-off lesson changes and resource occurrences,
+# mounted on the app by main
+
+# Standard library imports
+from datetime import datetime
+from typing import List
+
+# FastAPI and related imports
+from fastapi import APIRouter, Depends, HTTPException
+
+# Local imports
+from auth import UserInDB
+from models import CalendarPeriod, LessonExceptionModel, LessonOccurrence
+from app_state import (
+    check_admin,
+    check_analytics_request,
+    check_occurrence_range,
+    get_current_user,
+    global_lessons_db,
+    lesson_conflict_error,
+    lesson_intervals,
+    occurrence_models,
+    term_calendar
+)
+from lesson_batch import validate_lesson
+from term_calendar import EXCEPTION_FIELDS, Holiday, Term
+
+router = APIRouter()
+
+# Term calendar routes
+# Returns the terms, holidays and one-off lesson changes
+@router.get("/admin/calendar")
+async def admin_calendar(current_user: UserInDB = Depends(get_current_user)):
+    check_admin(current_user)
+    return {
+        "terms": [term._asdict() for term in term_calendar.terms],
+        "holidays": [holiday._asdict() for holiday in term_calendar.holidays],
+        "exceptions": [
+            {"lesson_id": lesson_id, "date": day, "cancelled": changes is None,
+             "changes": changes}
+            for lesson_id, day, changes in term_calendar.exceptions()
+            ]
+        }
+
+# Adds a term to the calendar
+@router.post("/admin/calendar/terms")
+async def add_calendar_term(
+    term: CalendarPeriod,
+    current_user: UserInDB = Depends(get_current_user)
+    ):
+    check_admin(current_user)
+    try:
+        term_calendar.add_term(Term(term.name, term.start, term.end))
+    except ValueError as exc:
+        raise HTTPException(status_code=400, detail=str(exc)) from exc
+    return term
+
+# Adds a holiday to the calendar
+@router.post("/admin/calendar/holidays")
+async def add_calendar_holiday(
+    holiday: CalendarPeriod,
+    current_user: UserInDB = Depends(get_current_user)
+    ):
+    check_admin(current_user)
+    term_calendar.add_holiday(
+        Holiday(holiday.name, holiday.start, holiday.end)
+        )
+    return holiday
+
+# Cancels or changes one occurrence of a lesson
+# An exception with neither cancelled nor any changed field restores the
+# lesson to its weekly pattern for that date
+@router.post("/admin/calendar/exceptions")
+async def add_calendar_exception(
+    exception: LessonExceptionModel,
+    current_user: UserInDB = Depends(get_current_user)
+    ):
+    check_admin(current_user)
+    lesson = global_lessons_db.get(exception.lesson_id)
+    if lesson is None:
+        raise HTTPException(status_code=404, detail="Lesson not found")
+    if lesson.day_of_week != exception.date.strftime("%A"):
+        raise HTTPException(
+            status_code=400,
+            detail=f"The lesson is on {lesson.day_of_week}s"
+            )
+    changes = {
+        field: getattr(exception, field) for field in EXCEPTION_FIELDS
+        if getattr(exception, field) is not None
+        }
+    if exception.cancelled:
+        term_calendar.cancel(lesson.id, exception.date)
+        return exception
+
+    # The lesson as it would run that day must not clash with the lessons
+    # running then, including ones moved there by other exceptions
+    actual = lesson.copy(update=changes)
+    try:
+        validate_lesson(actual.dict(exclude={"id"}))
+    except ValueError as exc:
+        raise HTTPException(status_code=400, detail=str(exc)) from exc
+    clashes = lesson_intervals.clashes(term_calendar, actual, exception.date)
+    if clashes:
+        raise lesson_conflict_error(clashes)
+    if changes:
+        term_calendar.change(lesson.id, exception.date, **changes)
+    else:
+        term_calendar.restore(lesson.id, exception.date)
+    return exception
+
+# Lists the dated lessons of a teacher, classroom or year group that
+# overlap start to end, from the interval index
+@router.get("/admin/calendar/occurrences",
+         response_model=List[LessonOccurrence])
+async def resource_occurrences(
+    key: str,
+    start: datetime,
+    end: datetime,
+    kind: str = "classroom",
+    current_user: UserInDB = Depends(get_current_user)
+    ):
+    check_analytics_request(current_user, kind)
+    check_occurrence_range(start.date(), end.date())
+    resource_key = key
+    if kind == "year_group":
+        try:
+            resource_key = int(key)
+        except ValueError as exc:
+            raise HTTPException(
+                status_code=400,
+                detail="A year group must be a whole number"
+                ) from exc
+    return occurrence_models(lesson_intervals.occurrences(
+        term_calendar, kind, resource_key, start, end
+        ))
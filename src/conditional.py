@@ -0,0 +1,56 @@
+# Conditional GET support for the LMS application
+# A response's ETag is a digest of the data versions it is built from, such
+# as the lesson store's version, so a client repeating a request can be
+# answered 304 Not Modified straight away, before the data is read,
+# rendered or serialised again
+# The stores' versions change on every write, so an ETag goes stale exactly
+# when the data behind the response does
+
+# Standard library imports
+import hashlib
+import secrets
+from typing import Optional
+
+# Third-party imports
+from fastapi import Request, Response
+
+# Differs every time the server starts, so ETags from an earlier process,
+# whose stores and templates may have been different, never match
+BOOT_ID = secrets.token_hex(8)
+
+# Browsers may keep versioned responses, but must revalidate them each time
+CACHE_CONTROL = "private, no-cache"
+
+# Returns a strong ETag for a response built from the given parts
+# The parts should name the route and include every version and user
+# detail the response depends on
+def make_etag(*parts) -> str:
+    digest = hashlib.blake2b(
+        repr((BOOT_ID,) + parts).encode(), digest_size=12
+        ).hexdigest()
+    return f'"{digest}"'
+
+# True if an If-None-Match header lists the ETag, or is "*"
+# Weak validators (W/"...") match their strong form, as RFC 9110 requires
+# for If-None-Match
+def etag_matches(header: Optional[str], etag: str) -> bool:
+    if not header:
+        return False
+    for candidate in header.split(","):
+        candidate = candidate.strip()
+        if candidate.startswith("W/"):
+            candidate = candidate[2:]
+        if candidate in (etag, "*"):
+            return True
+    return False
+
+# Returns the caching headers sent with a versioned response
+def etag_headers(etag: str) -> dict:
+    return {"ETag": etag, "Cache-Control": CACHE_CONTROL}
+
+# Returns a 304 response if the client already has the version with this
+# ETag, otherwise None
+def not_modified(request: Request, etag: str) -> Optional[Response]:
+    if etag_matches(request.headers.get("if-none-match"), etag):
+        return Response(status_code=304, headers=etag_headers(etag))
+    return None
@@ -0,0 +1,171 @@
+# Lesson conflict detection for the LMS application
+# Tracks when every teacher, classroom and year group is busy as a bitset
+# over the week, one bit per hour of each day, so checking whether a slot
+# is free for all three is a handful of bit operations however many
+# lessons are scheduled
+
+# Standard library imports
+from datetime import time
+from typing import Dict, Hashable, List, Optional, Tuple
+
+# Local imports
+from models import Lesson
+
+# Position of each day in the week, and the bits used per day
+DAY_INDEX = {
+    "Monday": 0,
+    "Tuesday": 1,
+    "Wednesday": 2,
+    "Thursday": 3,
+    "Friday": 4,
+    "Saturday": 5,
+    "Sunday": 6
+    }
+HOURS_PER_DAY = 24
+
+# Returns the bitset of hours covered by a lesson on the given day
+# A lesson occupies every hour it overlaps, from its start up to its end
+# Days outside the week give an empty bitset
+def slot_mask(day_of_week: str, start_time: time, end_time: time) -> int:
+    day = DAY_INDEX.get(day_of_week)
+    if day is None:
+        return 0
+    first_hour = start_time.hour
+    last_hour = end_time.hour + (1 if end_time.minute else 0)
+    hours = max(1, last_hour - first_hour)
+    return ((1 << hours) - 1) << (day * HOURS_PER_DAY + first_hour)
+
+# Returns the bitset of hours covered by a lesson
+def lesson_mask(lesson) -> int:
+    return slot_mask(lesson.day_of_week, lesson.start_time, lesson.end_time)
+
+# Returns the (kind, key) of each resource a lesson occupies
+def lesson_resources(lesson) -> Tuple[Tuple[str, Hashable], ...]:
+    return (
+        ("teacher", lesson.teacher),
+        ("classroom", lesson.classroom),
+        ("year_group", lesson.year_group),
+        )
+
+# Returns the positions of the set bits in a bitset
+def _bits(mask: int):
+    while mask:
+        low_bit = mask & -mask
+        yield low_bit.bit_length() - 1
+        mask ^= low_bit
+
+
+# Occupancy of every teacher, classroom and year group through the week
+# Must be updated with add and remove whenever a lesson is written
+class OccupancyGrid:
+    def __init__(self):
+        # (kind, key) -> bitset of the hours that resource is busy
+        self._masks: Dict[Tuple[str, Hashable], int] = {}
+        # (kind, key, bit) -> number of lessons using that hour
+        # Only needed on removal, in case two stored lessons overlap
+        self._counts: Dict[Tuple[str, Hashable, int], int] = {}
+
+    # Checks if a resource is free for every hour in a bitset
+    def is_free(self, kind: str, key: Hashable, mask: int) -> bool:
+        return not self._masks.get((kind, key), 0) & mask
+
+    # Returns the kinds of resource ("teacher", "classroom", "year_group")
+    # that are already busy when the lesson would run
+    # ignore is a stored lesson to leave out, e.g. the lesson being edited
+    def conflicts(self, lesson, ignore: Optional[Lesson] = None) -> List[str]:
+        mask = lesson_mask(lesson)
+        ignored = dict(lesson_resources(ignore)) if ignore is not None else {}
+        clashes = []
+        for kind, key in lesson_resources(lesson):
+            busy = self._masks.get((kind, key), 0)
+            if busy & mask and kind in ignored and ignored[kind] == key:
+                busy &= ~self._sole_use(kind, key, ignore)
+            if busy & mask:
+                clashes.append(kind)
+        return clashes
+
+    # Marks the hours of a lesson as busy for its resources
+    def add(self, lesson):
+        mask = lesson_mask(lesson)
+        for kind, key in lesson_resources(lesson):
+            for bit in _bits(mask):
+                count_key = (kind, key, bit)
+                self._counts[count_key] = self._counts.get(count_key, 0) + 1
+            self._masks[(kind, key)] = self._masks.get((kind, key), 0) | mask
+
+    # Frees the hours of a lesson for its resources
+    # Hours still used by another lesson stay busy
+    def remove(self, lesson):
+        mask = lesson_mask(lesson)
+        for kind, key in lesson_resources(lesson):
+            freed = 0
+            for bit in _bits(mask):
+                count_key = (kind, key, bit)
+                count = self._counts.get(count_key, 0) - 1
+                if count > 0:
+                    self._counts[count_key] = count
+                else:
+                    self._counts.pop(count_key, None)
+                    freed |= 1 << bit
+            remaining = self._masks.get((kind, key), 0) & ~freed
+            if remaining:
+                self._masks[(kind, key)] = remaining
+            else:
+                self._masks.pop((kind, key), None)
+
+    # Returns how many lessons use a resource in the hour of a bit
+    def usage(self, kind: str, key: Hashable, bit: int) -> int:
+        return self._counts.get((kind, key, bit), 0)
+
+    # Removes every lesson from the grid
+    def clear(self):
+        self._masks.clear()
+        self._counts.clear()
+
+    # Returns the hours of a stored lesson that no other lesson shares
+    def _sole_use(self, kind: str, key: Hashable, lesson) -> int:
+        sole = 0
+        for bit in _bits(lesson_mask(lesson)):
+            if self._counts.get((kind, key, bit), 0) <= 1:
+                sole |= 1 << bit
+        return sole
+
+
+# Pending lesson writes layered over an OccupancyGrid
+# Used to check a batch of writes as a whole: each lesson added or removed
+# through the overlay counts towards the checks that follow it, while the
+# grid itself is left untouched until the batch is applied
+class GridOverlay:
+    def __init__(self, grid: OccupancyGrid):
+        self._grid = grid
+        # (kind, key, bit) -> lessons added minus lessons removed
+        self._deltas: Dict[Tuple[str, Hashable, int], int] = {}
+
+    # Returns the kinds of resource that are busy when the lesson would run,
+    # counting the grid and every pending write
+    def conflicts(self, lesson) -> List[str]:
+        mask = lesson_mask(lesson)
+        clashes = []
+        for kind, key in lesson_resources(lesson):
+            for bit in _bits(mask):
+                count_key = (kind, key, bit)
+                if (self._grid.usage(kind, key, bit) +
+                        self._deltas.get(count_key, 0)) > 0:
+                    clashes.append(kind)
+                    break
+        return clashes
+
+    # Records a pending lesson
+    def add(self, lesson):
+        self._shift(lesson, 1)
+
+    # Records a pending removal of a stored or pending lesson
+    def remove(self, lesson):
+        self._shift(lesson, -1)
+
+    def _shift(self, lesson, step: int):
+        mask = lesson_mask(lesson)
+        for kind, key in lesson_resources(lesson):
+            for bit in _bits(mask):
+                count_key = (kind, key, bit)
+                self._deltas[count_key] = self._deltas.get(count_key, 0) + step
@@ -0,0 +1,219 @@
+# iCalendar feeds of user timetables for the LMS application
+# Each lesson becomes a weekly recurring event, so calendar apps can sync
+# a user's timetable
+# The term calendar decides which weeks a lesson happens in: the series ends
+# with the last term, dates that are not school days or whose occurrence is
+# cancelled are excluded, and an occurrence changed for one date gets an
+# override event of its own
+# Calendar apps poll feeds every few minutes, so generated feeds are cached
+# per user and keyed by the versions of the user's timetables and of the
+# term calendar: a poll only rebuilds a feed after either has changed
+
+# Standard library imports
+import hashlib
+import hmac
+from collections import OrderedDict
+from datetime import date, datetime, timedelta
+from typing import Hashable, Iterable, List, Optional, Tuple
+
+# Local imports
+from cache_stats import CacheStats
+from conflicts import DAY_INDEX
+from models import Lesson
+from term_calendar import TermCalendar
+
+# Identifies this application in generated calendars and event UIDs
+PRODUCT_ID = "-//School LMS//Timetable//EN"
+UID_DOMAIN = "school-lms"
+
+# Longest content line allowed by RFC 5545, in octets
+MAX_LINE_OCTETS = 75
+
+# Local date-time format, as lessons carry no time zone
+DATETIME_FORMAT = "%Y%m%dT%H%M%S"
+ONE_WEEK = timedelta(weeks=1)
+
+# Escapes text for an iCalendar property value
+def escape_text(value) -> str:
+    return (
+        str(value)
+        .replace("\\", "\\\\")
+        .replace(";", "\\;")
+        .replace(",", "\\,")
+        .replace("\n", "\\n")
+        )
+
+# Folds a content line to at most 75 octets per line, as RFC 5545 requires
+# Continuation lines start with a space; UTF-8 sequences are kept whole
+def fold_line(line: str) -> str:
+    parts = []
+    current = ""
+    for char in line:
+        if len((current + char).encode("utf-8")) > MAX_LINE_OCTETS:
+            parts.append(current)
+            current = " "
+        current += char
+    parts.append(current)
+    return "\r\n".join(parts)
+
+# Returns the date of a lesson's first occurrence in a timetable's week
+def first_occurrence(week_start, day_of_week: str):
+    return week_start + timedelta(
+        days=(DAY_INDEX[day_of_week] - week_start.weekday()) % 7
+        )
+
+# Returns the lines of an event for a lesson starting on day
+# Extra lines, e.g. the recurrence rule, go before the lesson's details
+def event_lines(lesson: Lesson, day: date, stamp: str,
+                extra: Iterable[str] = ()) -> List[str]:
+    start = datetime.combine(day, lesson.start_time)
+    end = datetime.combine(day, lesson.end_time)
+    description = (
+        f"Teacher: {lesson.teacher}\nYear group: {lesson.year_group}"
+        )
+    return [
+        "BEGIN:VEVENT",
+        f"UID:lesson-{lesson.id}@{UID_DOMAIN}",
+        f"DTSTAMP:{stamp}",
+        f"DTSTART:{start.strftime(DATETIME_FORMAT)}",
+        f"DTEND:{end.strftime(DATETIME_FORMAT)}",
+        *extra,
+        f"SUMMARY:{escape_text(lesson.subject)}",
+        f"LOCATION:{escape_text(lesson.classroom)}",
+        f"DESCRIPTION:{escape_text(description)}",
+        "END:VEVENT",
+        ]
+
+# Returns the start of a weekly lesson's occurrence on a date as given by
+# its recurring event, which identifies the occurrence in EXDATE and
+# RECURRENCE-ID
+def occurrence_id(lesson: Lesson, day: date) -> str:
+    return datetime.combine(day, lesson.start_time).strftime(DATETIME_FORMAT)
+
+# Walks a weekly lesson's dates from first_day to last_day inclusive
+# Returns the dates it does not happen on, because they are not school days
+# or it is cancelled, and the (date, lesson as changed) of those it is
+# changed on
+def series_exceptions(
+    lesson: Lesson, first_day: date, last_day: date, calendar: TermCalendar
+    ) -> Tuple[List[date], List[Tuple[date, Lesson]]]:
+    excluded = []
+    overrides = []
+    day = first_day
+    while day <= last_day:
+        actual = (calendar.apply(lesson, day)
+                  if calendar.is_school_day(day) else None)
+        if actual is None:
+            excluded.append(day)
+        elif actual is not lesson:
+            overrides.append((day, actual))
+        day += ONE_WEEK
+    return excluded, overrides
+
+# Returns the lines of a weekly lesson's events from its first date: the
+# recurring event, then an override for each date the calendar changes it
+# Without terms the calendar says nothing about dates, so the lesson
+# repeats every week; otherwise the series ends with the last term, and is
+# left out if none of its dates is a school day
+def series_lines(lesson: Lesson, first_day: date,
+                 calendar: Optional[TermCalendar], stamp: str) -> List[str]:
+    terms = calendar.terms if calendar is not None else []
+    if not terms:
+        return event_lines(lesson, first_day, stamp, ["RRULE:FREQ=WEEKLY"])
+    last_day = terms[-1].end
+    excluded, overrides = series_exceptions(
+        lesson, first_day, last_day, calendar
+        )
+    weeks = max(0, (last_day - first_day).days // 7 + 1)
+    if len(excluded) == weeks:
+        return []
+    until = datetime.combine(last_day, datetime.max.time())
+    rules = [f"RRULE:FREQ=WEEKLY;UNTIL={until.strftime(DATETIME_FORMAT)}"]
+    if excluded:
+        rules.append("EXDATE:" + ",".join(
+            occurrence_id(lesson, day) for day in excluded
+            ))
+    lines = event_lines(lesson, first_day, stamp, rules)
+    for day, actual in overrides:
+        lines += event_lines(actual, day, stamp,
+                             [f"RECURRENCE-ID:{occurrence_id(lesson, day)}"])
+    return lines
+
+# Builds the iCalendar feed for a user's timetables
+# A lesson that appears in several of the user's timetables is only listed
+# once, starting from its earliest week
+def build_calendar(username: str, timetables: Iterable,
+                   generated_at: Optional[datetime] = None,
+                   calendar: Optional[TermCalendar] = None) -> bytes:
+    stamp = (generated_at or datetime.utcnow()).strftime("%Y%m%dT%H%M%SZ")
+    lines = [
+        "BEGIN:VCALENDAR",
+        "VERSION:2.0",
+        f"PRODID:{PRODUCT_ID}",
+        "CALSCALE:GREGORIAN",
+        f"X-WR-CALNAME:{escape_text(f'Timetable for {username}')}",
+        ]
+    seen = set()
+    for timetable in sorted(timetables, key=lambda t: t.week_start):
+        for lesson in list(timetable.lessons):
+            if lesson.id in seen or lesson.day_of_week not in DAY_INDEX:
+                continue
+            seen.add(lesson.id)
+            day = first_occurrence(timetable.week_start, lesson.day_of_week)
+            lines += series_lines(lesson, day, calendar, stamp)
+    lines.append("END:VCALENDAR")
+    return ("\r\n".join(fold_line(line) for line in lines) + "\r\n").encode()
+
+# Returns the secret token that lets calendar apps fetch a user's feed
+# without logging in; it is tied to the username and the signing key
+def feed_token(username: str, secret_key: str) -> str:
+    return hmac.new(
+        secret_key.encode(), f"ics:{username}".encode(), hashlib.sha256
+        ).hexdigest()[:32]
+
+# Checks a feed token in constant time
+def verify_feed_token(token: str, username: str, secret_key: str) -> bool:
+    return hmac.compare_digest(token, feed_token(username, secret_key))
+
+
+# Least recently used cache of generated feeds, one entry per user
+# An entry is only returned while its version key still matches
+class FeedCache(CacheStats):
+    def __init__(self, max_size: int = 10000):
+        super().__init__()
+        self.max_size = max_size
+        self._entries: "OrderedDict[Hashable, Tuple[Hashable, bytes]]" = (
+            OrderedDict()
+            )
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    # Returns the cached feed for a key, or None if missing or out of date
+    def get(self, key: Hashable, version: Hashable) -> Optional[bytes]:
+        entry = self._entries.get(key)
+        if entry is None or entry[0] != version:
+            self.miss()
+            return None
+        self._entries.move_to_end(key)
+        self.hit()
+        return entry[1]
+
+    # Caches a feed, evicting the least recently used entry if full
+    def put(self, key: Hashable, version: Hashable, body: bytes):
+        self._entries[key] = (version, body)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    # Removes every cached feed
+    def clear(self):
+        self._entries.clear()
+
+    # Returns cache statistics for monitoring
+    def stats(self) -> dict:
+        return {
+            "size": len(self._entries),
+            "max_size": self.max_size,
+            **self.lookup_stats()
+            }
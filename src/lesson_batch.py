@@ -0,0 +1,137 @@
+# Bulk lesson operations for the LMS application
+# A batch of create, update, reassign and delete operations is checked as
+# a whole: each operation is validated like a single lesson write and
+# conflict checked against the schedule and the operations before it, then
+# the batch is applied only if every operation succeeded
+
+# Standard library imports
+from typing import Dict, Iterator, List, Optional, Tuple
+
+# Third-party imports for data validation
+from pydantic import ValidationError
+
+# Local imports
+from conflicts import GridOverlay, OccupancyGrid
+from lesson_store import LessonStore
+from models import Lesson, LessonBulkOperation, LessonCreate
+
+# Operations a batch may contain
+BULK_ACTIONS = ("create", "update", "reassign", "delete")
+
+# Validates lesson fields with the same rules as a single lesson write
+# Returns the LessonCreate, raises ValueError with a message otherwise
+def validate_lesson(data: Optional[dict]) -> LessonCreate:
+    if data is None:
+        raise ValueError("lesson is required")
+    try:
+        return LessonCreate(**data)
+    except ValidationError as exc:
+        raise ValueError("; ".join(
+            f"{'.'.join(str(part) for part in error['loc'])}: {error['msg']}"
+            for error in exc.errors()
+            )) from exc
+
+
+# Stages the operations of a batch without changing the store or the grid
+# The staged lessons are tracked by id, so a lesson touched by several
+# operations ends up with a single write when the batch is applied
+class LessonBatch:
+    def __init__(self, store: LessonStore, grid: OccupancyGrid, user):
+        self._store = store
+        self._overlay = GridOverlay(grid)
+        self._user = user
+        # lesson id -> latest staged version, None once deleted
+        self._staged: Dict[int, Optional[Lesson]] = {}
+        self.results: List[dict] = []
+
+    # True if every operation staged so far succeeded
+    @property
+    def ok(self) -> bool:
+        return all(result["ok"] for result in self.results)
+
+    # Stages one operation and records its result
+    # A failed operation has no effect on the operations after it
+    def stage(self, operation: LessonBulkOperation) -> dict:
+        result = {
+            "index": len(self.results),
+            "action": operation.action,
+            "ok": True,
+            "lesson_id": operation.lesson_id
+            }
+        try:
+            lesson = self._stage(operation)
+        except ValueError as exc:
+            result.update(ok=False, error=str(exc))
+        else:
+            if lesson is not None:
+                result.update(lesson_id=lesson.id, lesson=lesson)
+        self.results.append(result)
+        return result
+
+    # Yields (previous, lesson) for each lesson the batch changes
+    # previous is None for a new lesson and lesson is None for a deletion
+    def changes(self) -> Iterator[Tuple[Optional[Lesson], Optional[Lesson]]]:
+        for lesson_id, lesson in self._staged.items():
+            previous = self._store.get(lesson_id)
+            if previous is not None or lesson is not None:
+                yield previous, lesson
+
+    # Returns the current version of a lesson, including staged changes
+    def _current(self, lesson_id: Optional[int]) -> Lesson:
+        if lesson_id in self._staged:
+            lesson = self._staged[lesson_id]
+        else:
+            lesson = self._store.get(lesson_id)
+        if lesson is None:
+            raise ValueError("Lesson not found")
+        return lesson
+
+    def _stage(self, operation: LessonBulkOperation) -> Optional[Lesson]:
+        if operation.action not in BULK_ACTIONS:
+            raise ValueError(f"Unknown action: {operation.action}")
+        user = self._user
+
+        if operation.action == "create":
+            lesson_data = validate_lesson(operation.lesson)
+            if user.role == "teacher" and lesson_data.teacher != user.username:
+                raise ValueError(
+                    "Teachers can only create lessons for themselves"
+                    )
+            lesson = Lesson(id=self._store.next_id(), **lesson_data.dict())
+            return self._place(None, lesson)
+
+        existing = self._current(operation.lesson_id)
+        if operation.action == "delete":
+            if user.role != "admin":
+                raise ValueError("Only administrators can delete lessons")
+            self._overlay.remove(existing)
+            self._staged[existing.id] = None
+            return None
+
+        if user.role == "teacher" and existing.teacher != user.username:
+            raise ValueError("Teachers can only update their own lessons")
+        if operation.action == "reassign":
+            if not operation.teacher:
+                raise ValueError("teacher is required")
+            lesson = existing.copy(update={"teacher": operation.teacher})
+        else:
+            lesson_data = validate_lesson(operation.lesson)
+            lesson = Lesson(id=existing.id, **lesson_data.dict())
+        return self._place(existing, lesson)
+
+    # Stages a lesson in place of its previous version, if it has no clashes
+    def _place(self, previous: Optional[Lesson], lesson: Lesson) -> Lesson:
+        if previous is not None:
+            self._overlay.remove(previous)
+        clashes = self._overlay.conflicts(lesson)
+        if clashes:
+            if previous is not None:
+                self._overlay.add(previous)
+            resources = ", ".join(clash.replace("_", " ") for clash in clashes)
+            raise ValueError(
+                f"This lesson conflicts with another lesson "
+                f"for the same {resources}"
+                )
+        self._overlay.add(lesson)
+        self._staged[lesson.id] = lesson
+        return lesson
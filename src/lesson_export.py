@@ -0,0 +1,92 @@
+# Streaming export of lessons and timetables for the LMS application
+# Rows are serialised one at a time as CSV or NDJSON, so an export of the
+# whole school is sent as it is produced and never held in memory
+
+# Standard library imports
+import csv
+import io
+import json
+from typing import Iterable, Iterator, Optional, Tuple
+
+# Export formats and their media types
+EXPORT_MEDIA_TYPES = {"csv": "text/csv", "ndjson": "application/x-ndjson"}
+
+# Columns of a lesson export
+LESSON_FIELDS = (
+    "id",
+    "subject",
+    "teacher",
+    "classroom",
+    "day_of_week",
+    "start_time",
+    "end_time",
+    "year_group"
+    )
+
+# Columns of a timetable export: one row per lesson in each timetable,
+# with the lesson columns prefixed by "lesson_"
+TIMETABLE_FIELDS = (
+    "timetable_id",
+    "user_id",
+    "username",
+    "week_start",
+    "week_end"
+    ) + tuple(f"lesson_{field}" for field in LESSON_FIELDS)
+
+# Returns the export row for a lesson
+def lesson_row(lesson, prefix: str = "") -> dict:
+    return {
+        f"{prefix}id": lesson.id,
+        f"{prefix}subject": lesson.subject,
+        f"{prefix}teacher": lesson.teacher,
+        f"{prefix}classroom": lesson.classroom,
+        f"{prefix}day_of_week": lesson.day_of_week,
+        f"{prefix}start_time": lesson.start_time.strftime("%H:%M"),
+        f"{prefix}end_time": lesson.end_time.strftime("%H:%M"),
+        f"{prefix}year_group": lesson.year_group
+        }
+
+# Yields the export rows for a timetable, one per lesson
+# A timetable without lessons still gets a row, with empty lesson columns
+def timetable_rows(timetable, username: Optional[str]) -> Iterator[dict]:
+    row = {
+        "timetable_id": timetable.id,
+        "user_id": timetable.user_id,
+        "username": username,
+        "week_start": timetable.week_start.isoformat(),
+        "week_end": timetable.week_end.isoformat()
+        }
+    if not timetable.lessons:
+        yield dict(row, **{field: None for field in TIMETABLE_FIELDS[5:]})
+    for lesson in list(timetable.lessons):
+        yield dict(row, **lesson_row(lesson, prefix="lesson_"))
+
+# Yields rows as CSV lines, starting with a header line
+# A single buffer is reused for every line
+def iter_csv(rows: Iterable[dict], fields: Tuple[str, ...]) -> Iterator[str]:
+    buffer = io.StringIO()
+    writer = csv.DictWriter(buffer, fieldnames=fields)
+    writer.writeheader()
+    yield _drain(buffer)
+    for row in rows:
+        writer.writerow(row)
+        yield _drain(buffer)
+
+# Yields rows as NDJSON lines, one JSON object per row
+def iter_ndjson(rows: Iterable[dict]) -> Iterator[str]:
+    for row in rows:
+        yield json.dumps(row) + "\n"
+
+# Yields rows serialised in the given format
+def iter_export(rows: Iterable[dict], fmt: str,
+                fields: Tuple[str, ...]) -> Iterator[str]:
+    if fmt == "csv":
+        return iter_csv(rows, fields)
+    return iter_ndjson(rows)
+
+# Returns what has been written to a buffer and empties it
+def _drain(buffer: io.StringIO) -> str:
+    chunk = buffer.getvalue()
+    buffer.seek(0)
+    buffer.truncate()
+    return chunk
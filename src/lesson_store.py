@@ -0,0 +1,253 @@
+# In-memory lesson store for the LMS application
+# Keeps lessons in a map by id plus secondary indexes by teacher, year
+# group, classroom and time slot, so lookups no longer scan every lesson
+# Every create, edit and delete must go through the store to keep the
+# indexes consistent
+# Lessons are also kept in timetable order, by day and start time, so a
+# page of lessons is found by bisection rather than by sorting them all
+# Each lesson, and the store as a whole, has a version that changes on
+# every write, so responses built from lessons can be cached until then
+
+# Standard library imports
+from bisect import bisect_left, bisect_right, insort
+from datetime import time
+from itertools import islice
+from typing import Dict, Hashable, Iterator, List, Optional, Tuple
+
+# Local imports
+from conflicts import DAY_INDEX
+from models import Lesson
+from versions import Versions
+
+# Position of a lesson in timetable order: (day, start time, lesson id)
+# The id breaks ties, so every lesson has a distinct position
+OrderKey = Tuple[int, time, int]
+
+# Returns a lesson's position in timetable order
+# Days outside the week sort after Sunday
+def order_key(lesson: Lesson) -> OrderKey:
+    return (
+        DAY_INDEX.get(lesson.day_of_week, len(DAY_INDEX)),
+        lesson.start_time,
+        lesson.id
+        )
+
+# Turns a position in timetable order into a cursor for the next page
+def encode_cursor(key: OrderKey) -> str:
+    day, start_time, lesson_id = key
+    return f"{day}-{start_time.strftime('%H%M')}-{lesson_id}"
+
+# Reads a cursor made by encode_cursor, raises ValueError if it is invalid
+def decode_cursor(cursor: str) -> OrderKey:
+    day, start_time, lesson_id = cursor.split("-")
+    return (
+        int(day),
+        time(int(start_time[:2]), int(start_time[2:])),
+        int(lesson_id)
+        )
+
+
+# Lesson fields with their own ordered index for paging
+ORDERED_FIELDS = ("teacher", "year_group", "classroom", "day_of_week")
+
+
+# Stores lessons and maintains the indexes used for lookups
+# Four lookup indexes next to the lessons, their order keys, the id counter
+# and the versions come to one attribute more than the lint limit
+class LessonStore: # pylint: disable=too-many-instance-attributes
+    def __init__(self):
+        self._by_id: Dict[int, Lesson] = {}
+        # Each secondary index maps a key to the lessons with that key,
+        # keyed by lesson id so a lesson can be unindexed in O(1)
+        self._by_teacher: Dict[str, Dict[int, Lesson]] = {}
+        self._by_year_group: Dict[int, Dict[int, Lesson]] = {}
+        self._by_classroom: Dict[str, Dict[int, Lesson]] = {}
+        self._by_slot: Dict[Tuple[str, time], Dict[int, Lesson]] = {}
+        # (field, value) -> order keys of the lessons with that value,
+        # kept sorted; (None, None) holds every lesson
+        self._ordered: Dict[Tuple[Optional[str], Hashable],
+                            List[OrderKey]] = {}
+        # Highest id ever handed out, so ids are never reused after a delete
+        self._last_id = 0
+        # Versions of each lesson and of the store as a whole
+        self._versions = Versions()
+
+    def __len__(self) -> int:
+        return len(self._by_id)
+
+    def __iter__(self) -> Iterator[Lesson]:
+        return iter(list(self._by_id.values()))
+
+    def __contains__(self, lesson_id: int) -> bool:
+        return lesson_id in self._by_id
+
+    # Returns a new lesson id that has never been used by this store
+    def next_id(self) -> int:
+        self._last_id += 1
+        return self._last_id
+
+    # Adds a lesson to the store and indexes it
+    # Raises ValueError if the id is already in use
+    def add(self, lesson: Lesson) -> Lesson:
+        if lesson.id in self._by_id:
+            raise ValueError(f"Lesson id already in use: {lesson.id}")
+        self._index(lesson)
+        self._last_id = max(self._last_id, lesson.id)
+        self._touch(lesson.id)
+        return lesson
+
+    # Replaces a stored lesson with a new version of it (same id)
+    # Returns the previous version, raises KeyError if there is none
+    def replace(self, lesson: Lesson) -> Lesson:
+        previous = self._by_id[lesson.id]
+        self._unindex(previous)
+        self._index(lesson)
+        self._touch(lesson.id)
+        return previous
+
+    # Removes a lesson by id
+    # Returns the removed lesson, or None if there was no such lesson
+    def remove(self, lesson_id: int) -> Optional[Lesson]:
+        lesson = self._by_id.get(lesson_id)
+        if lesson is not None:
+            self._unindex(lesson)
+            self._touch(lesson_id)
+        return lesson
+
+    # Retrieves a lesson by id, returns None if not found
+    def get(self, lesson_id: int) -> Optional[Lesson]:
+        return self._by_id.get(lesson_id)
+
+    # Returns the current version of a lesson, or of the whole store if no
+    # lesson id is given; 0 for a lesson that was never stored
+    def version(self, lesson_id: Optional[int] = None) -> int:
+        return self._versions.get(lesson_id)
+
+    # Returns the lessons taught by a teacher
+    def by_teacher(self, teacher: str) -> List[Lesson]:
+        return list(self._by_teacher.get(teacher, {}).values())
+
+    # Returns the lessons for a year group
+    def by_year_group(self, year_group: int) -> List[Lesson]:
+        return list(self._by_year_group.get(year_group, {}).values())
+
+    # Returns the lessons held in a classroom
+    def by_classroom(self, classroom: str) -> List[Lesson]:
+        return list(self._by_classroom.get(classroom, {}).values())
+
+    # Returns the lessons starting at a given day and time
+    def at_slot(self, day_of_week: str, start_time: time) -> List[Lesson]:
+        return list(self._by_slot.get((day_of_week, start_time), {}).values())
+
+    # Yields lessons in timetable order, starting after the cursor
+    # Lessons are filtered by any of the given fields; the most selective
+    # ordered index is walked, so the cost depends on the lessons yielded
+    # rather than on the number of lessons stored
+    # Each step bisects from the last position, so lessons written while
+    # iterating are neither skipped nor repeated
+    # Exports run this in a worker thread alongside writes, so each step
+    # reads the index with a single slice and skips a lesson deleted
+    # between the index and the lookup
+    def iter_ordered(
+        self,
+        cursor: Optional[OrderKey] = None,
+        **filters
+    ) -> Iterator[Lesson]:
+        filters = {
+            field: value for field, value in filters.items()
+            if value is not None
+            }
+        index_keys = [
+            (field, value) for field, value in filters.items()
+            if field in ORDERED_FIELDS
+            ] or [(None, None)]
+        index_key = min(
+            index_keys,
+            key=lambda key: len(self._ordered.get(key, []))
+            )
+
+        while True:
+            ordered = self._ordered.get(index_key, [])
+            position = bisect_right(ordered, cursor) if cursor else 0
+            following = ordered[position:position + 1]
+            if not following:
+                return
+            cursor = following[0]
+            lesson = self._by_id.get(cursor[2])
+            if lesson is not None and all(
+                getattr(lesson, field) == value
+                for field, value in filters.items()
+            ):
+                yield lesson
+
+    # Returns a page of lessons in timetable order and the cursor for the
+    # next page, which is None on the last page
+    def page(
+        self,
+        cursor: Optional[OrderKey] = None,
+        limit: int = 50,
+        **filters
+    ) -> Tuple[List[Lesson], Optional[str]]:
+        lessons = list(islice(self.iter_ordered(cursor, **filters), limit + 1))
+        if len(lessons) > limit:
+            next_cursor = encode_cursor(order_key(lessons[limit - 1]))
+            return lessons[:limit], next_cursor
+        return lessons, None
+
+    # Removes every lesson, ids keep counting from where they were
+    def clear(self):
+        self._by_id.clear()
+        self._by_teacher.clear()
+        self._by_year_group.clear()
+        self._by_classroom.clear()
+        self._by_slot.clear()
+        self._ordered.clear()
+        self._versions.reset()
+
+    # Gives a lesson, and so the store, a new version
+    def _touch(self, lesson_id: int):
+        self._versions.touch(lesson_id)
+
+    def _secondary_indexes(self, lesson: Lesson):
+        return (
+            (self._by_teacher, lesson.teacher),
+            (self._by_year_group, lesson.year_group),
+            (self._by_classroom, lesson.classroom),
+            (self._by_slot, (lesson.day_of_week, lesson.start_time)),
+            )
+
+    def _ordered_keys(self, lesson: Lesson):
+        yield None, None
+        for field in ORDERED_FIELDS:
+            yield field, getattr(lesson, field)
+
+    def _index(self, lesson: Lesson):
+        self._by_id[lesson.id] = lesson
+        for index, key in self._secondary_indexes(lesson):
+            index.setdefault(key, {})[lesson.id] = lesson
+        position = order_key(lesson)
+        for key in self._ordered_keys(lesson):
+            insort(self._ordered.setdefault(key, []), position)
+
+    def _unindex(self, lesson: Lesson):
+        del self._by_id[lesson.id]
+        for index, key in self._secondary_indexes(lesson):
+            _discard(index, key, lesson.id)
+        position = order_key(lesson)
+        for key in self._ordered_keys(lesson):
+            ordered = self._ordered[key]
+            del ordered[bisect_left(ordered, position)]
+            if not ordered:
+                del self._ordered[key]
+
+
+# Removes a lesson id from one key of a secondary index
+# Drops the key entirely once it has no lessons left
+def _discard(index: Dict[Hashable, Dict[int, Lesson]], key: Hashable,
+             lesson_id: int):
+    lessons = index.get(key)
+    if lessons is None:
+        return
+    lessons.pop(lesson_id, None)
+    if not lessons:
+        del index[key]
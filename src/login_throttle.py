@@ -0,0 +1,172 @@
+# Login throttling for the LMS application
+# Limits how often logins can be attempted per username and per client IP,
+# so brute force and credential stuffing attacks are turned away before any
+# password hashing is done
+
+# Standard library imports
+import time
+from typing import Dict, List, Optional
+
+
+# Sliding window rate limiter
+# Each key keeps the count for the current fixed window and the previous
+# one; the previous count is weighted by how much of it still overlaps the
+# sliding window. This needs a constant amount of memory per key, unlike a
+# log of every attempt
+# At most max_keys keys are tracked. When the table is full, keys whose
+# windows hold no attempts are dropped to make room; keys with attempts are
+# never dropped, since that would clear the count of a key under attack,
+# so new keys are turned away until room frees up
+class SlidingWindowLimiter:
+    def __init__(self, limit: int, window_seconds: float,
+                 max_keys: int = 100000):
+        self.limit = limit
+        self.window = window_seconds
+        self.max_keys = max_keys
+        # key -> [window start, count in this window, count in previous]
+        self._counters: Dict[str, List[float]] = {}
+        self._last_compaction = time.time()
+
+    def __len__(self) -> int:
+        return len(self._counters)
+
+    # Returns how many seconds the key must wait, 0 if it is allowed now
+    def retry_after(self, key: str, now: Optional[float] = None) -> float:
+        now = time.time() if now is None else now
+        counter = self._current(key, now)
+        if counter is None:
+            if self._has_room(now):
+                return 0
+            # Full of live keys; room frees up once their windows pass
+            return max(1, round(self.window))
+        window_start, count, previous = counter
+        overlap = 1 - (now - window_start) / self.window
+        if previous * overlap + count < self.limit:
+            return 0
+        # Once this window ends the previous count no longer applies
+        return max(1, round(window_start + self.window - now))
+
+    # Records an attempt for the key
+    # Returns False if the key is new and there is no room to track it
+    def hit(self, key: str, now: Optional[float] = None) -> bool:
+        now = time.time() if now is None else now
+        counter = self._current(key, now)
+        if counter is None:
+            if not self._has_room(now):
+                return False
+            counter = [now - now % self.window, 0, 0]
+            self._counters[key] = counter
+        counter[1] += 1
+        if now - self._last_compaction >= self.window:
+            self.compact(now)
+        return True
+
+    # Takes back one attempt recorded for the key, e.g. once it turns out
+    # to be one that should not count
+    def release(self, key: str, now: Optional[float] = None):
+        now = time.time() if now is None else now
+        counter = self._current(key, now)
+        if counter is None:
+            return
+        if counter[1] > 0:
+            counter[1] -= 1
+        elif counter[2] > 0:
+            counter[2] -= 1
+
+    # Forgets a key, e.g. after a successful login
+    def reset(self, key: str):
+        self._counters.pop(key, None)
+
+    # Removes keys whose windows no longer hold any attempts
+    def compact(self, now: Optional[float] = None):
+        now = time.time() if now is None else now
+        for key in [
+            key for key, counter in self._counters.items()
+            if self._is_empty(counter, now)
+        ]:
+            del self._counters[key]
+        self._last_compaction = now
+
+    # Checks whether a new key can be tracked, compacting a full table
+    # Compaction scans every key, so a full table is compacted at most once
+    # a second, however many new keys arrive
+    def _has_room(self, now: float) -> bool:
+        if (len(self._counters) >= self.max_keys
+                and now - self._last_compaction >= 1):
+            self.compact(now)
+        return len(self._counters) < self.max_keys
+
+    # Checks whether a counter holds no attempts in the sliding window
+    def _is_empty(self, counter: List[float], now: float) -> bool:
+        window_start = now - now % self.window
+        if counter[0] == window_start:
+            return not counter[1] and not counter[2]
+        if counter[0] == window_start - self.window:
+            # Its current count becomes the previous one
+            return not counter[1]
+        return True
+
+    # Returns the counter for a key, rolled forward to the current window
+    def _current(self, key: str, now: float) -> Optional[List[float]]:
+        counter = self._counters.get(key)
+        if counter is None:
+            return None
+        window_start = now - now % self.window
+        if counter[0] != window_start:
+            elapsed_windows = (window_start - counter[0]) / self.window
+            counter[2] = counter[1] if elapsed_windows == 1 else 0
+            counter[1] = 0
+            counter[0] = window_start
+        return counter
+
+
+# Throttles login attempts by username and by client IP
+# Only failed attempts count, so a whole school logging in from behind one
+# address is not turned away, and a successful login clears the username's
+# failures
+# An attempt counts as a failure from the moment it is let through until
+# its password turns out to be right, so concurrent guesses cannot all get
+# past the limit before the first failure is recorded
+class LoginThrottle:
+    def __init__(self, username_limit: int, ip_limit: int,
+                 window_seconds: float, max_keys: int = 100000):
+        self.usernames = SlidingWindowLimiter(
+            username_limit, window_seconds, max_keys
+            )
+        self.ips = SlidingWindowLimiter(ip_limit, window_seconds, max_keys)
+
+    # Returns how many seconds the client must wait, 0 if it may try now
+    def retry_after(self, username: str, ip: str) -> float:
+        return max(
+            self.usernames.retry_after(username),
+            self.ips.retry_after(ip)
+            )
+
+    # Lets a login attempt through unless the username or IP is over its
+    # limit, counting it as a failure until finish says otherwise
+    # Returns how many seconds the client must wait, 0 if it may try now
+    def begin(self, username: str, ip: str) -> float:
+        retry_after = self.retry_after(username, ip)
+        if not retry_after:
+            self.usernames.hit(username)
+            self.ips.hit(ip)
+        return retry_after
+
+    # Records the result of an attempt let through by begin
+    def finish(self, username: str, ip: str, success: bool):
+        if success:
+            self.usernames.reset(username)
+            self.ips.release(ip)
+
+    # Takes back an attempt let through by begin whose password was never
+    # checked, e.g. because the server was too busy
+    def cancel(self, username: str, ip: str):
+        self.usernames.release(username)
+        self.ips.release(ip)
+
+    # Returns the number of usernames and IPs being tracked
+    def stats(self) -> dict:
+        return {
+            "tracked_usernames": len(self.usernames),
+            "tracked_ips": len(self.ips),
+        }
@@ -2,12 +2,13 @@
 from __future__ import absolute_import
 
 # Standard library imports
-import random
-from datetime import date, datetime, time, timedelta
+import os
+from datetime import date, datetime, timedelta
 from typing import List, Optional
 
 # FastAPI and related imports
 from fastapi import (
+    BackgroundTasks,
     Depends,
     FastAPI,
     Form,
@@ -15,322 +16,163 @@ from fastapi import (
     Request,
     Response,
     status
-  )
-from fastapi.responses import RedirectResponse
+)
+from fastapi.responses import HTMLResponse, RedirectResponse
 from fastapi.security import OAuth2PasswordBearer, OAuth2PasswordRequestForm
 from fastapi.staticfiles import StaticFiles
-from fastapi.templating import Jinja2Templates
-
-# Third-party imports for JWT handling and password hashing
-from jose import jwt, JWTError
-from passlib.context import CryptContext
 
 # Local imports from auth and models modules
 from auth import (
     ACCESS_TOKEN_EXPIRE_MINUTES,
-    ALGORITHM,
     create_access_token,
-    get_user,
+    pwd_context,
     SECRET_KEY,
-    UserInDB
+    UserInDB,
+    users_db
 )
 from models import (
     Lesson,
+    LessonBulkRequest,
+    LessonBulkResponse,
     LessonCreate,
+    LessonOccurrence,
     Timetable,
     TimetableCreate,
-    RegisterModel
+    RegisterModel,
+    lesson_end_time
+)
+import admin_routes
+import analytics_routes
+from app_log import (
+    LazyArg,
+    RouteContextMiddleware,
+    configure_logging,
+    parse_sample_rates
 )
+from app_state import (
+    BCRYPT_CALIBRATE_ON_STARTUP,
+    LESSON_PAGE_SIZE,
+    apply_calibrated_password_policy,
+    audience_lessons,
+    check_occurrence_range,
+    create_user_timetable,
+    feed_cache,
+    get_current_user,
+    global_lessons_db,
+    lesson_conflict_error,
+    lesson_grid,
+    lesson_intervals,
+    lesson_list_page,
+    lesson_occupancy,
+    logger,
+    login_throttle,
+    occurrence_models,
+    password_pool,
+    render_cache,
+    session_cache,
+    templates,
+    term_calendar,
+    timetable_grid_page,
+    timetables_db
+)
+import calendar_routes
+from conditional import etag_headers, make_etag, not_modified
+from ical_feed import build_calendar, feed_token, verify_feed_token
+from lesson_batch import LessonBatch, validate_lesson
+from lesson_store import decode_cursor
+from mock_data import initialise_mock_data
+from token_blacklist import add_to_blacklist
+
+# Logging: LOG_LEVEL is a level name, LOG_FORMAT is "text" or "json", and
+# LOG_SAMPLE_RATES keeps a share of the routine records of busy routes,
+# e.g. "/login=0.01,/timetable=0.1"
+LOG_LEVEL = os.environ.get("LOG_LEVEL", "INFO")
+LOG_FORMAT = os.environ.get("LOG_FORMAT", "text")
+LOG_SAMPLE_RATES = parse_sample_rates(os.environ.get("LOG_SAMPLE_RATES", ""))
+configure_logging(LOG_LEVEL, LOG_FORMAT, LOG_SAMPLE_RATES)
 
 # Initialise FastAPI application
 app = FastAPI()
-# Set up Jinja2 HTML templates
-templates = Jinja2Templates(directory="templates")
+# Tag log records with the route being handled
+app.add_middleware(RouteContextMiddleware)
 # Mount a static files directory
 app.mount("/static", StaticFiles(directory="static"), name="static")
-# Set up password hashing context
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
 # Set up OAuth2 password flow for token URL
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="token")
 
-# Initialise empty databases
-users_db = [] # Simulated database for users
-lessons_db = [] # Simulated database for lessons
-global_lessons_db = []  # Initialise global_lessons_db as an empty list
-timetables_db: List[Timetable] = [] # Simulated database for timetable
-
-login_attempts = {} # track login attempts
-
-# Helper functions
-# Verifies a plain password against a hashed password
-def verify_password(plain_password, hashed_password):
-    print(f"Verifying password: {plain_password}")
-    print(f"Hashed password: {hashed_password}")
-    result = pwd_context.verify(plain_password, hashed_password)
-    print(f"Password verification result: {result}")
-    return result
-
-# Generates a hash for the given password
-def get_password_hash(password):
-    return pwd_context.hash(password)
+# Rehashes a user's password under the current policy
+# Runs in the background after a login whose stored hash needs updating
+# The stored hash is only replaced if it has not changed in the meantime
+async def rehash_password(username: str, old_hash: str, password: str):
+    try:
+        new_hash = await password_pool.hash(password)
+    except HTTPException:
+        return # pool is busy, the next login will try again
+    user = users_db.get_by_username(username)
+    if user is None or user.hashed_password != old_hash:
+        return
+    users_db.update(user.copy(update={"hashed_password": new_hash}))
+    session_cache.invalidate_user(username)
+
+# Lesson writes go through these helpers so the lesson store, the
+# occupancy grid and the timetables showing the lesson stay in step
+def add_lesson_record(lesson: Lesson):
+    global_lessons_db.add(lesson)
+    lesson_grid.add(lesson)
+    lesson_occupancy.add(lesson)
+    lesson_intervals.add(lesson)
+    timetables_db.add_lesson(lesson)
+
+def update_lesson_record(lesson: Lesson) -> Lesson:
+    previous = global_lessons_db.replace(lesson)
+    lesson_grid.remove(previous)
+    lesson_grid.add(lesson)
+    lesson_occupancy.remove(previous)
+    lesson_occupancy.add(lesson)
+    lesson_intervals.remove(previous)
+    lesson_intervals.add(lesson)
+    timetables_db.replace_lesson(previous, lesson)
+    return previous
+
+def remove_lesson_record(lesson_id: int) -> Optional[Lesson]:
+    lesson = global_lessons_db.remove(lesson_id)
+    if lesson is not None:
+        lesson_grid.remove(lesson)
+        lesson_occupancy.remove(lesson)
+        lesson_intervals.remove(lesson)
+        timetables_db.remove_lesson(lesson)
+    return lesson
 
 # Authenticates a user based on username and password
-def authenticate_user(username: str, password: str):
-    print(f"Attempting to authenticate user: {username}")
+# The bcrypt check runs on the password pool, not the event loop
+async def authenticate_user(username: str, password: str):
+    logger.debug("Attempting to authenticate user: %s", username)
     user = auth.get_user(username)
     if not user:
-        print(f"User not found: {username}")
+        logger.info("User not found: %s", username)
         return False
-    print(f"User found: {user}")
-    if not auth.verify_password(password, user.hashed_password):
-        print(f"Password verification failed for user: {username}")
+    if not await password_pool.verify(password, user.hashed_password):
+        logger.info("Password verification failed for user: %s", username)
         return False
-    print(f"Authentication successful for user: {username}")
     return user
 
-# Retrieves the current user based on the JWT token in the request cookies
-async def get_current_user(request: Request):
-    token = request.cookies.get("access_token")
-    if not token:
-        raise HTTPException(
-          status_code=status.HTTP_401_UNAUTHORIZED,
-          detail="Not authenticated"
-        )
+# Checks if a lesson clashes with any scheduled lesson for its teacher,
+# classroom or year group
+# existing_lesson is the stored version of a lesson being edited, which is
+# not counted as a clash with itself
+# Returns the clashing resources, e.g. ["teacher", "classroom"], or []
+def check_lesson_conflict(new_lesson, existing_lesson=None):
+    return lesson_grid.conflicts(new_lesson, ignore=existing_lesson)
 
-    scheme, _, param = token.partition(" ")
-    if scheme.lower() != "bearer":
-        raise HTTPException(
-          status_code=status.HTTP_401_UNAUTHORIZED,
-          detail="Invalid authentication scheme"
-        )
-
-    try:
-        payload = jwt.decode(param, SECRET_KEY, algorithms=[ALGORITHM])
-        username: str = payload.get("sub")
-        if username is None:
-            raise HTTPException(
-                status_code=status.HTTP_401_UNAUTHORIZED,
-                detail="Invalid token"
-                )
-        user = get_user(username)
-        if user is None:
-            raise HTTPException(
-                status_code=status.HTTP_401_UNAUTHORIZED,
-                detail="User not found"
-                )
-        return user
-    except JWTError as exc:
-        raise HTTPException(
-            status_code=status.HTTP_401_UNAUTHORIZED,
-            detail="Invalid token"
-            ) from exc
-
-# Checks if a new lesson conflicts with existing lessons for a user
-def check_lesson_conflict(new_lesson, user_id):
-    timetable = next((
-        t for t in timetables_db if t.user_id == user_id),
-        None
-        )
-    if timetable:
-        for lesson in timetable.lessons:
-            if (lesson.day_of_week == new_lesson.day_of_week and
-                lesson.start_time == new_lesson.start_time and
-                lesson.teacher == new_lesson.teacher):
-                return True
-    return False
-
-# Mock data creation functions
-# Creates test user accounts with predefined roles
-def create_test_accounts():
-    global users_db # pylint: disable=global-variable-not-assigned
-    test_accounts = [
-        {"username": "admin",
-        "password": "adminpass",
-        "role": "admin",
-        "email": "admin@school.com"
-        },
-        {"username": "teacher1",
-        "password": "teacherpass",
-        "role": "teacher",
-        "email": "teacher1@school.com"
-        },
-        {"username": "student1",
-        "password": "studentpass",
-        "role": "student",
-        "year_group": 9,
-        "email": "student1@school.com"
-        }
-    ]
-    for account in test_accounts:
-        if not any(user.username == account["username"] for user in users_db):
-            hashed_password = get_password_hash(account["password"])
-            new_user = UserInDB(
-                id=len(users_db) + 1,
-                username=account["username"],
-                email=account["email"],
-                hashed_password=hashed_password,
-                role=account["role"],
-                year_group=account.get("year_group")
-            )
-            users_db.append(new_user)
-            print("Created test account: " +
-            f"{account['username']} ({account['role']})")
-    print(f"Current users in db: {users_db}")
-
-# Creates mock teacher accounts with random subjects
-def create_mock_teachers():
-    subjects = [
-        "Math",
-        "English",
-        "Science",
-        "History",
-        "Geography",
-        "Art",
-        "Music",
-        "Physical Education"
-        ]
-    teachers = []
-    for i in range(5):  # Create 5 teachers
-        teacher_data = {
-            "id": i + 1,
-            "username": f"teacher{i+1}",
-            "email": f"teacher{i+1}@school.com",
-            "hashed_password": get_password_hash("password"),
-            "role": "teacher",
-            "subjects": random.sample(subjects, 2)
-        }
-        teacher = UserInDB(**teacher_data)
-        teachers.append(teacher)
-    return teachers
-
-# Creates mock student accounts with random year groups
-def create_mock_students():
-    students = []
-    for i in range(2):
-        student_data = {
-            "id": i + 3,
-            "username": f"student{i+1}",
-            "email": f"student{i+1}@school.com",
-            "hashed_password": get_password_hash("password"),
-            "role": "student",
-            "year_group": random.randint(7, 11)
-        }
-        student = UserInDB(**student_data)
-        students.append(student)
-    return students
-
-# Creates mock lessons for teachers and year groups
-def create_mock_lessons():
-    global global_lessons_db # pylint: disable=global-statement
-    teachers = create_mock_teachers()
-    subjects = [
-        "Math",
-        "English",
-        "Science",
-        "History",
-        "Geography",
-        "Art",
-        "Music",
-        "Physical Education"
-        ]
-    lesson_id = 1
-    lesson_slots = {
-    day: {
-        hour: {year: None for year in range(7, 12)}
-        for hour in range(9, 15)
-        }
-    for day in ["Monday", "Tuesday", "Wednesday", "Thursday", "Friday"]
-    }
-
-    global_lessons_db = []  # Reset global_lessons_db
-
-    for teacher in teachers:
-        for day in ["Monday", "Tuesday", "Wednesday", "Thursday", "Friday"]:
-            for hour in range(9, 15):
-                if random.random() < 0.7:  # 70% chance of creating a lesson
-                    subject = random.choice(subjects)
-                    available_years = [
-                        year for year,
-                        lesson in lesson_slots[day][hour].items()
-                        if lesson is None
-                        ]
-                    if not available_years:
-                        continue
-                    year_group = random.choice(available_years)
-                    new_lesson = Lesson(
-                        id=lesson_id,
-                        subject=subject,
-                        teacher=teacher.username,
-                        classroom=f"Room {random.randint(101, 120)}",
-                        day_of_week=day,
-                        start_time=time(hour=hour),
-                        end_time=time(hour=hour+1),
-                        year_group=year_group
-                    )
-                    global_lessons_db.append(new_lesson)
-                    lesson_slots[day][hour][year_group] = new_lesson
-                    lesson_id += 1
-
-                    # Print the newly created lesson
-                    print("Created lesson: " +
-                    f"{new_lesson.subject} on {new_lesson.day_of_week} at " +
-                    f"{new_lesson.start_time} " + 
-                    f"for Year {new_lesson.year_group} " +
-                    f"in {new_lesson.classroom} with {new_lesson.teacher}")
-
-    return global_lessons_db
-
-# Creates mock timetables for users based on their roles
-def create_mock_timetables():
-    global global_lessons_db # pylint: disable=global-statement
-    users = users_db
-    timetables = []
-
-    if global_lessons_db is None:
-        global_lessons_db = []  # Initialise if it's None
-
-    for user in users:
-        user_lessons = []
-        if user.role == "student":
-            user_lessons = [
-                lesson for lesson in global_lessons_db
-                if lesson.year_group == user.year_group
-                ]
-        elif user.role == "teacher":
-            user_lessons = [
-                lesson for lesson in global_lessons_db
-                if lesson.teacher == user.username
-                ]
-        else:  # admin sees all lessons
-            user_lessons = global_lessons_db.copy()
-
-        timetable = Timetable(
-            id=len(timetables) + 1,
-            user_id=user.id,
-            week_start=date.today() - timedelta(days=date.today().weekday()),
-            week_end=date.today() + timedelta(days=6),
-            lessons=user_lessons
-        )
-        timetables.append(timetable)
-
-    return timetables
+# Pick the bcrypt cost for this machine before any passwords are hashed
+if BCRYPT_CALIBRATE_ON_STARTUP:
+    apply_calibrated_password_policy()
 
 # Initialise mock data
-# Create predefined test accounts (admin, teacher, student)
-create_test_accounts()
+initialise_mock_data()
 
-# Add additional mock teachers and students to the users database
-users_db.extend(create_mock_teachers() + create_mock_students())
-
-# Generate mock lessons and store them in the global lessons database
-global_lessons_db = create_mock_lessons()
-
-# Create mock timetables
-timetables_db = create_mock_timetables()
-
-# Share the users_db with the auth module
+# The auth module's helpers are used directly by some handlers below
 import auth
-auth.users_db = users_db
 
 
 # Route definitions
@@ -357,7 +199,8 @@ async def register(
         role=role,
         year_group=year_group
     )
-    print(f"Received registration data: {register_data}")
+    logger.debug("Registration received for user: %s (%s)",
+                 register_data.username, register_data.role)
 
     if register_data.role not in ["admin", "teacher", "student"]:
         return templates.TemplateResponse(
@@ -365,7 +208,7 @@ async def register(
             {"request": request, "error": "Invalid role"}
         )
 
-    if any(user.username == register_data.username for user in users_db):
+    if register_data.username in users_db:
         return templates.TemplateResponse(
             "register.html",
             {"request": request, "error": "Username already registered"}
@@ -379,9 +222,15 @@ async def register(
             }
         )
 
-    hashed_password = get_password_hash(register_data.password)
+    hashed_password = await password_pool.hash(register_data.password)
+    # The username may have been taken while the password was being hashed
+    if register_data.username in users_db:
+        return templates.TemplateResponse(
+            "register.html",
+            {"request": request, "error": "Username already registered"}
+        )
     new_user = UserInDB(
-        id=len(users_db) + 1,
+        id=users_db.next_id(),
         username=register_data.username,
         email=register_data.email,
         hashed_password=hashed_password,
@@ -392,17 +241,10 @@ async def register(
         else None
         )
     )
-    users_db.append(new_user)
+    users_db.add(new_user)
 
     # Create a timetable for the new user
-    new_timetable = Timetable(
-        id=len(timetables_db) + 1,
-        user_id=new_user.id,
-        week_start=date.today() - timedelta(days=date.today().weekday()),
-        week_end=date.today() + timedelta(days=6),
-        lessons=[]
-    )
-    timetables_db.append(new_timetable)
+    create_user_timetable(new_user)
 
     return RedirectResponse(url="/", status_code=303)
 
@@ -414,11 +256,14 @@ async def register_form(request: Request):
 # Handles user login and sets JWT token in cookies
 @app.post("/login")
 async def login(
+    request: Request,
     response: Response,
+    background_tasks: BackgroundTasks,
     form_data: OAuth2PasswordRequestForm = Depends()
     ):
-    print(f"Login route called for user: {form_data.username}")
-    token_response = await login_for_access_token(form_data)
+    token_response = await login_for_access_token(
+        request, background_tasks, form_data
+        )
     response = RedirectResponse(url="/dashboard", status_code=303)
     response.set_cookie(
         key="access_token",
@@ -430,27 +275,60 @@ async def login(
     return response
 
 # Handles user logout by deleting the access token cookie
+# A valid token is also revoked until it expires and dropped from the
+# session cache; an invalid or expired one is already rejected
 @app.get("/logout")
-async def logout(request: Request): # pylint: disable=unused-argument
+async def logout(request: Request):
+    token = request.cookies.get("access_token")
+    if token:
+        param = token.partition(" ")[2]
+        add_to_blacklist(param)
+        session_cache.invalidate(param)
     response = RedirectResponse(url="/", status_code=303)
     response.delete_cookie("access_token")
     return response
 
 # Generates and returns a JWT access token for authenticated users
+# Throttled clients are turned away before any password hashing is done
+# Hashes made under an older password policy are rehashed in the background
 @app.post("/token")
 async def login_for_access_token(
+    request: Request,
+    background_tasks: BackgroundTasks,
     form_data: OAuth2PasswordRequestForm = Depends()
     ):
-    print(f"Login attempt for user: {form_data.username}")
-    user = authenticate_user(form_data.username, form_data.password)
+    logger.debug("Login attempt for user: %s", form_data.username)
+    client_ip = request.client.host if request.client else "unknown"
+    # The attempt counts as a failure while the password is being checked
+    retry_after = login_throttle.begin(form_data.username, client_ip)
+    if retry_after:
+        raise HTTPException(
+            status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+            detail="Too many login attempts, please try again later",
+            headers={"Retry-After": str(int(retry_after))},
+        )
+    try:
+        user = await authenticate_user(form_data.username, form_data.password)
+    except HTTPException:
+        login_throttle.cancel(form_data.username, client_ip)
+        raise
+    login_throttle.finish(form_data.username, client_ip, bool(user))
     if not user:
-        print(f"Authentication failed for user: {form_data.username}")
+        logger.info("Authentication failed for user: %s", form_data.username)
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail="Incorrect username or password",
             headers={"WWW-Authenticate": "Bearer"},
         )
-    print(f"Authentication successful for user: {form_data.username}")
+    logger.info("Authentication successful for user: %s",
+                form_data.username)
+    if pwd_context.needs_update(user.hashed_password):
+        background_tasks.add_task(
+            rehash_password,
+            user.username,
+            user.hashed_password,
+            form_data.password
+            )
     access_token_expires = timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
     access_token = create_access_token(
         data={"sub": user.username}, expires_delta=access_token_expires
@@ -475,61 +353,72 @@ async def dashboard(
 async def read_users_me(current_user: UserInDB = Depends(get_current_user)):
     return current_user
 
-
-# Lesson routes
-# Lists lessons based on the user's role
+# Lists lessons based on the user's role, a page at a time
+# Lessons come from the store in day and start time order and can be
+# filtered; teachers only see their own lessons and students their year
+# group's, whatever filters they pass
 @app.get("/lessons/")
 async def list_lessons(
     request: Request,
-    current_user: UserInDB = Depends(get_current_user)
+    current_user: UserInDB = Depends(get_current_user),
+    teacher: Optional[str] = None,
+    year_group: Optional[str] = None,
+    subject: Optional[str] = None,
+    day: Optional[str] = None,
+    classroom: Optional[str] = None,
+    cursor: Optional[str] = None,
+    limit: int = LESSON_PAGE_SIZE
     ):
-    if current_user.role == 'admin':
-        visible_lessons = global_lessons_db
-    elif current_user.role == 'teacher':
-        visible_lessons = [
-            lesson for lesson in global_lessons_db
-            if lesson.teacher == current_user.username
-            ]
-    else:
-        visible_lessons = [
-            lesson for lesson in global_lessons_db
-            if lesson.year_group == current_user.year_group
-            ]
+    # The filter form submits empty fields for filters that are not set
+    try:
+        year_group = int(year_group) if year_group else None
+        after = decode_cursor(cursor) if cursor else None
+    except ValueError as exc:
+        raise HTTPException(
+            status_code=400,
+            detail="Invalid year group or cursor"
+            ) from exc
 
-    # Sort lessons by day of week and start time
-    day_order = {
-        "Monday": 0,
-        "Tuesday": 1,
-        "Wednesday": 2,
-        "Thursday": 3,
-        "Friday": 4
-        }
-    sorted_lessons = sorted(
-        visible_lessons,
-        key=lambda x: (day_order[x.day_of_week], x.start_time)
+    if current_user.role == 'teacher':
+        teacher = current_user.username
+    elif current_user.role != 'admin':
+        year_group = current_user.year_group
+
+    # Any lesson write may change the page, so it is versioned by the store
+    etag = make_etag(
+        "lessons", global_lessons_db.version(), current_user.id,
+        current_user.role, teacher, year_group, request.url.query
         )
+    unchanged = not_modified(request, etag)
+    if unchanged is not None:
+        return unchanged
 
-    return templates.TemplateResponse(
-        "lesson_list.html",
-        {"request": request,
-        "lessons": sorted_lessons,
-        "current_user": current_user
-        }
-      )
+    key, context = lesson_list_page(
+        request, current_user.role, teacher, year_group, subject, day,
+        classroom, after, limit
+        )
+    return HTMLResponse(
+        render_cache.render("lesson_list.html", key, context),
+        headers=etag_headers(etag)
+        )
 
 # Retrieves a specific lesson by ID
+# Answers a request repeating the current version with a 304
 @app.get("/lessons/{lesson_id}", response_model=Lesson)
 async def get_lesson(
     lesson_id: int,
+    request: Request,
+    response: Response,
     # current_user: UserInDB = Depends(get_current_user)
     ):
-    lesson = next((
-        lesson for lesson in global_lessons_db
-        if lesson.id == lesson_id),
-        None
-        )
+    lesson = global_lessons_db.get(lesson_id)
     if lesson is None:
         raise HTTPException(status_code=404, detail="Lesson not found")
+    etag = make_etag("lesson", lesson_id, global_lessons_db.version(lesson_id))
+    unchanged = not_modified(request, etag)
+    if unchanged is not None:
+        return unchanged
+    response.headers.update(etag_headers(etag))
     return lesson
 
 # Creates a new lesson
@@ -552,23 +441,12 @@ async def create_lesson(
             detail="Teachers can only create lessons for themselves"
             )
 
-    if check_lesson_conflict(lesson, current_user.id):
-        raise HTTPException(
-            status_code=400,
-            detail="You already have a lesson scheduled at this time"
-            )
-
-    new_lesson = Lesson(id=len(global_lessons_db) + 1, **lesson.dict())
-    global_lessons_db.append(new_lesson)
+    clashes = check_lesson_conflict(lesson)
+    if clashes:
+        raise lesson_conflict_error(clashes)
 
-    # Update timetables
-    for timetable in timetables_db:
-        if (current_user.role == "admin" or
-            (current_user.role == "teacher" and
-            new_lesson.teacher == current_user.username) or
-            new_lesson.year_group == current_user.year_group
-            ):
-            timetable.lessons.append(new_lesson)
+    new_lesson = Lesson(id=global_lessons_db.next_id(), **lesson.dict())
+    add_lesson_record(new_lesson)
 
     return new_lesson
 
@@ -585,37 +463,26 @@ async def update_lesson(
             detail="Only administrators and teachers can update lessons"
             )
 
-    lesson_index = next(
-        (i for i, lesson in enumerate(lessons_db)
-        if lesson.id == lesson_id),
-        None
-        )
-    if lesson_index is None:
+    existing_lesson = global_lessons_db.get(lesson_id)
+    if existing_lesson is None:
         raise HTTPException(status_code=404, detail="Lesson not found")
 
     if (current_user.role == "teacher" and
-    lessons_db[lesson_index].teacher != current_user.username):
+    existing_lesson.teacher != current_user.username):
         raise HTTPException(status_code=403,
                             detail="Teachers can only update their own lessons"
                             )
 
-    if check_lesson_conflict(updated_lesson, current_user.id):
-        raise HTTPException(
-            status_code=400,
-            detail="This lesson conflicts with an existing lesson"
-            )
+    clashes = check_lesson_conflict(updated_lesson, existing_lesson)
+    if clashes:
+        raise lesson_conflict_error(clashes)
 
     updated_lesson_dict = updated_lesson.dict()
     updated_lesson_dict['id'] = lesson_id
-    lessons_db[lesson_index] = Lesson(**updated_lesson_dict)
-
-    # Update timetables
-    for timetable in timetables_db:
-        for i, lesson in enumerate(timetable.lessons):
-            if lesson.id == lesson_id:
-                timetable.lessons[i] = lessons_db[lesson_index]
+    new_lesson = Lesson(**updated_lesson_dict)
+    update_lesson_record(new_lesson)
 
-    return lessons_db[lesson_index]
+    return new_lesson
 
 # Deletes a lesson
 @app.delete("/lessons/{lesson_id}", status_code=status.HTTP_204_NO_CONTENT)
@@ -629,17 +496,40 @@ async def delete_lesson(
             detail="Only administrators can delete lessons"
             )
 
-    for i, lesson in enumerate(lessons_db):
-        if lesson.id == lesson_id:
-            lessons_db.pop(i)
-            # Remove lesson from timetables
-            for timetable in timetables_db:
-                timetable.lessons = [
-                    l for l in timetable.lessons
-                    if l.id != lesson_id
-                    ]
-            return
-    raise HTTPException(status_code=404, detail="Lesson not found")
+    if remove_lesson_record(lesson_id) is None:
+        raise HTTPException(status_code=404, detail="Lesson not found")
+
+# Applies a batch of lesson creates, updates, reassignments and deletes
+# The whole batch is validated and conflict checked first, including
+# against itself, and is applied only if every operation succeeded;
+# otherwise nothing changes and the response is a 400 with the results
+@app.post("/lessons/bulk", response_model=LessonBulkResponse)
+async def bulk_lessons(
+    batch: LessonBulkRequest,
+    response: Response,
+    current_user: UserInDB = Depends(get_current_user)
+    ):
+    if current_user.role not in ["admin", "teacher"]:
+        raise HTTPException(
+            status_code=403,
+            detail="Only administrators and teachers can change lessons"
+            )
+
+    plan = LessonBatch(global_lessons_db, lesson_grid, current_user)
+    for operation in batch.operations:
+        plan.stage(operation)
+    if not plan.ok:
+        response.status_code = 400
+        return {"applied": False, "results": plan.results}
+
+    for previous, lesson in list(plan.changes()):
+        if previous is None:
+            add_lesson_record(lesson)
+        elif lesson is None:
+            remove_lesson_record(previous.id)
+        else:
+            update_lesson_record(lesson)
+    return {"applied": True, "results": plan.results}
 
 # Renders the form for adding a new lesson
 @app.get("/lessons/add/")
@@ -664,6 +554,7 @@ async def lesson_add(
     day_of_week: str = Form(...),
     start_time: str = Form(...),
     year_group: int = Form(...),
+    duration: int = Form(1),
     current_user: UserInDB = Depends(get_current_user)
 ):
     if current_user.role not in ["admin", "teacher"]:
@@ -672,17 +563,19 @@ async def lesson_add(
             detail="Only administrators and teachers can add lessons"
         )
 
-    new_lesson = LessonCreate(
-        subject=subject,
-        teacher=teacher,
-        classroom=classroom,
-        day_of_week=day_of_week,
-        start_time=datetime.strptime(start_time, "%H:%M").time(),
-        end_time=(
-            datetime.strptime(start_time, "%H:%M") + timedelta(hours=1)
-            ).time(),
-        year_group=year_group
-    )
+    # Lessons last duration hours and must end by the end of the school day
+    try:
+        new_lesson = validate_lesson({
+            "subject": subject,
+            "teacher": teacher,
+            "classroom": classroom,
+            "day_of_week": day_of_week,
+            "start_time": datetime.strptime(start_time, "%H:%M").time(),
+            "end_time": lesson_end_time(start_time, duration),
+            "year_group": year_group
+            })
+    except ValueError as exc:
+        raise HTTPException(status_code=400, detail=str(exc)) from exc
 
     await create_lesson(new_lesson, current_user)
     return RedirectResponse(url="/lessons/", status_code=303)
@@ -700,10 +593,7 @@ async def lesson_edit_form(
             detail="Only administrators and teachers can edit lessons"
             )
 
-    lesson = next(
-        (lesson for lesson in global_lessons_db if lesson.id == lesson_id),
-        None
-    )
+    lesson = global_lessons_db.get(lesson_id)
     if lesson is None:
         raise HTTPException(status_code=404, detail="Lesson not found")
 
@@ -713,6 +603,7 @@ async def lesson_edit_form(
         )
 
 # Handles the submission of an edited lesson
+# Without a duration the lesson keeps its current length
 @app.post("/lessons/{lesson_id}/edit")
 async def lesson_edit(
     lesson_id: int,
@@ -723,6 +614,7 @@ async def lesson_edit(
     day_of_week: str = Form(...),
     start_time: str = Form(...),
     year_group: int = Form(...),
+    duration: Optional[int] = Form(None),
     current_user: UserInDB = Depends(get_current_user)
 ):
     if current_user.role not in ["admin", "teacher"]:
@@ -731,10 +623,7 @@ async def lesson_edit(
             detail="Only administrators and teachers can edit lessons"
         )
 
-    lesson = next(
-        (lesson for lesson in global_lessons_db if lesson.id == lesson_id),
-        None
-    )
+    lesson = global_lessons_db.get(lesson_id)
     if lesson is None:
         raise HTTPException(
             status_code=404,
@@ -748,24 +637,28 @@ async def lesson_edit(
             detail="Teachers can only update their own lessons"
         )
 
-    # Update the lesson
-    lesson.subject = subject
-    lesson.teacher = teacher
-    lesson.classroom = classroom
-    lesson.day_of_week = day_of_week
-    lesson.start_time = datetime.strptime(
-        start_time, "%H:%M"
-        ).time()
-    lesson.end_time = (datetime.strptime(
-        start_time, "%H:%M") + timedelta(hours=1)
-        ).time()
-    lesson.year_group = year_group
-
-    # Update the lesson in all timetables
-    for timetable in timetables_db:
-        for i, timetable_lesson in enumerate(timetable.lessons):
-            if timetable_lesson.id == lesson_id:
-                timetable.lessons[i] = lesson
+    if duration is None:
+        duration = lesson.end_time.hour - lesson.start_time.hour
+
+    # Update the lesson, through the store so its indexes stay current
+    existing_lesson = lesson
+    try:
+        lesson = lesson.copy(update={
+            "subject": subject,
+            "teacher": teacher,
+            "classroom": classroom,
+            "day_of_week": day_of_week,
+            "start_time": datetime.strptime(start_time, "%H:%M").time(),
+            "end_time": lesson_end_time(start_time, duration),
+            "year_group": year_group
+            })
+        validate_lesson(lesson.dict(exclude={"id"}))
+    except ValueError as exc:
+        raise HTTPException(status_code=400, detail=str(exc)) from exc
+    clashes = check_lesson_conflict(lesson, existing_lesson)
+    if clashes:
+        raise lesson_conflict_error(clashes)
+    update_lesson_record(lesson)
 
     return RedirectResponse(url="/lessons/", status_code=303)
 
@@ -781,81 +674,166 @@ async def lesson_delete(
             detail="Only administrators can delete lessons"
             )
 
-    lesson = next(
-        (lesson for lesson in global_lessons_db if lesson.id == lesson_id),
-        None
-    )
+    lesson = global_lessons_db.get(lesson_id)
     if lesson is None:
         raise HTTPException(status_code=404, detail="Lesson not found")
 
-    global_lessons_db.remove(lesson)
-
-    # Remove lesson from timetables
-    for timetable in timetables_db:
-        timetable.lessons = [l for l in timetable.lessons if l.id != lesson_id]
+    remove_lesson_record(lesson_id)
 
     return RedirectResponse(url="/lessons/", status_code=303)
 
-
-# Timetable routes
 # Renders the timetable view for the current user
 @app.get("/timetable/")
 async def view_timetable(
     request: Request,
     current_user: UserInDB = Depends(get_current_user)
     ):
-    timetable = next((
-        t for t in timetables_db
-        if t.user_id == current_user.id),
-        None
+    # The page only changes with the user's timetables
+    etag = make_etag(
+        "timetable", current_user.id, current_user.username,
+        current_user.role, timetables_db.user_versions(current_user.id)
         )
+    unchanged = not_modified(request, etag)
+    if unchanged is not None:
+        return unchanged
+
+    timetable = next(iter(timetables_db.for_user(current_user.id)), None)
 
     if not timetable:
         return templates.TemplateResponse("timetable_view.html", {
             "request": request,
             "current_user": current_user,
             "timetable": None
-        })
-
-    # Sort lessons by day of week and start time
-    day_order = {
-        "Monday": 0,
-        "Tuesday": 1,
-        "Wednesday": 2,
-        "Thursday": 3,
-        "Friday": 4
-        }
-    sorted_lessons = sorted(
-        timetable.lessons,
-        key=lambda x: (day_order[x.day_of_week], x.start_time))
-
-    # Group lessons by day
-    lessons_by_day = {
-        day: []
-        for day in ["Monday", "Tuesday", "Wednesday", "Thursday", "Friday"]
-        }
-    for lesson in sorted_lessons:
-        lessons_by_day[lesson.day_of_week].append(lesson)
+        }, headers=etag_headers(etag))
 
+    # The grid is shared by everyone in the user's scope; only the page
+    # around it, with the user's feed link, is rendered per request
+    key, context = timetable_grid_page(current_user, timetable)
     return templates.TemplateResponse("timetable_view.html", {
         "request": request,
         "current_user": current_user,
         "timetable": timetable,
-        "lessons_by_day": lessons_by_day
-    })
+        "timetable_grid": render_cache.render(
+            "timetable_grid.html", key, context
+            ),
+        "feed_url": (
+            request.url_for("timetable_feed", username=current_user.username)
+            + f"?token={feed_token(current_user.username, SECRET_KEY)}"
+            )
+    }, headers=etag_headers(etag))
+
+# Serves a user's timetable as an iCalendar feed for calendar apps
+# Calendar apps authenticate with the feed token from the timetable page;
+# logged in users can fetch their own feed and admins any feed
+# Feeds are cached until the user's timetables or the term calendar
+# change, and a poll with a matching If-None-Match gets a 304 without the
+# feed being read at all
+@app.get("/timetable/{username}.ics")
+async def timetable_feed(
+    username: str,
+    request: Request,
+    token: Optional[str] = None
+    ):
+    user = users_db.get_by_username(username)
+    if user is None:
+        raise HTTPException(status_code=404, detail="User not found")
+    if token is None or not verify_feed_token(token, username, SECRET_KEY):
+        current_user = await get_current_user(request)
+        if (current_user.username != username and
+            current_user.role != "admin"):
+            raise HTTPException(
+                status_code=403,
+                detail="You can only view your own timetable"
+                )
+
+    versions = timetables_db.user_versions(user.id)
+    etag = make_etag("feed", user.id, versions, term_calendar.version)
+    unchanged = not_modified(request, etag)
+    if unchanged is not None:
+        return unchanged
+
+    feed_version = (versions, term_calendar.version)
+    body = feed_cache.get(user.id, feed_version)
+    if body is None:
+        body = build_calendar(username, timetables_db.for_user(user.id),
+                              calendar=term_calendar)
+        feed_cache.put(user.id, feed_version, body)
+    return Response(
+        content=body,
+        media_type="text/calendar; charset=utf-8",
+        headers=etag_headers(etag)
+        )
+
+# Returns a user's timetable for the week containing week_start, holding
+# the lessons that happen that week according to the term calendar, or
+# None if the user has no timetable
+# Lessons are weekly patterns, so any week can be looked up; a timetable
+# made for that week is preferred if the user has several
+def timetable_for_week(user_id: int, week_start: date) -> Optional[Timetable]:
+    timetables = timetables_db.for_user(user_id)
+    if not timetables:
+        return None
+    monday = week_start - timedelta(days=week_start.weekday())
+    sunday = monday + timedelta(days=6)
+    timetable = next(
+        (t for t in timetables if t.week_start == monday), timetables[0]
+        )
+    return Timetable.construct(
+        id=timetable.id,
+        user_id=user_id,
+        week_start=monday,
+        week_end=sunday,
+        lessons=[
+            occurrence.lesson for occurrence in
+            term_calendar.occurrences(timetable.lessons, monday, sunday)
+            ]
+        )
+
+# Returns the ETag of a user's timetable for a week, which changes with the
+# user's timetables and the term calendar
+def timetable_week_etag(user_id: int, week_start: date) -> str:
+    return make_etag(
+        "timetable-week", user_id,
+        week_start - timedelta(days=week_start.weekday()),
+        timetables_db.user_versions(user_id), term_calendar.version
+        )
+
+# Lists the dated lessons on a user's timetable from start to end inclusive
+# Declared before the weekly timetable route, whose path would match it
+@app.get("/timetables/{user_id}/occurrences",
+         response_model=List[LessonOccurrence])
+async def timetable_occurrences(
+    user_id: int,
+    start: date,
+    end: date,
+    current_user: UserInDB = Depends(get_current_user)
+    ):
+    if (current_user.id != user_id and
+        current_user.role not in ["admin", "teacher"]):
+        raise HTTPException(
+            status_code=403,
+            detail="You can only view your own timetable"
+            )
+    check_occurrence_range(start, end)
+    timetable = next(iter(timetables_db.for_user(user_id)), None)
+    if timetable is None:
+        raise HTTPException(status_code=404, detail="Timetable not found")
+    return occurrence_models(
+        term_calendar.occurrences(timetable.lessons, start, end)
+        )
 
 # Retrieves a weekly timetable for a specific user and week
 @app.get("/timetables/{user_id}/{week_start}", response_model=Timetable)
 async def get_weekly_timetable(
     user_id: int,
     week_start: date,
+    request: Request,
+    response: Response,
     current_user: UserInDB = Depends(get_current_user)
     ):
-    print(
-        f"Searching for timetable: user_id={user_id}, "
-        f"week_start={week_start}"
-    )
-    print(f"Current timetables in db: {timetables_db}")
+    logger.debug("Searching for timetable: user_id=%s, week_start=%s "
+                 "among %s timetables", user_id, week_start,
+                 LazyArg(len, timetables_db))
 
     if current_user.role == "student" and current_user.id != user_id:
         raise HTTPException(
@@ -863,14 +841,16 @@ async def get_weekly_timetable(
             detail="Students can only view their own timetable"
             )
 
-    timetable = next((
-        t for t in timetables_db
-        if t.user_id == user_id and t.week_start == week_start),
-        None
-        )
+    etag = timetable_week_etag(user_id, week_start)
+    unchanged = not_modified(request, etag)
+    if unchanged is not None:
+        return unchanged
+
+    timetable = timetable_for_week(user_id, week_start)
     if not timetable:
         raise HTTPException(status_code=404, detail="Timetable not found")
 
+    response.headers.update(etag_headers(etag))
     return timetable
 
 # Retrieves a timetable for a specific user
@@ -878,6 +858,8 @@ async def get_weekly_timetable(
 async def get_timetable(
     user_id: int,
     week_start: date,
+    request: Request,
+    response: Response,
     current_user: UserInDB = Depends(get_current_user)):
     try:
         if (current_user.id != user_id and
@@ -887,14 +869,16 @@ async def get_timetable(
                 detail="You can only view your own timetable"
             )
 
-        timetable = next((
-            t for t in timetables_db
-            if t.user_id == user_id and t.week_start == week_start),
-            None
-            )
+        etag = timetable_week_etag(user_id, week_start)
+        unchanged = not_modified(request, etag)
+        if unchanged is not None:
+            return unchanged
+
+        timetable = timetable_for_week(user_id, week_start)
         if not timetable:
             raise HTTPException(status_code=404, detail="Timetable not found")
 
+        response.headers.update(etag_headers(etag))
         return timetable
     except ValueError as exc:
         raise HTTPException(
@@ -919,60 +903,21 @@ async def create_timetable(
             detail="Only administrators and teachers can create timetables"
             )
 
-    # Logic to create a timetable
+    # The timetable is subscribed to its owner's lessons, if the owner exists
+    owner = users_db.get_by_id(timetable.user_id)
     new_timetable = Timetable(
-        id=len(timetables_db) + 1,
+        id=timetables_db.next_id(),
         user_id=timetable.user_id,
         week_start=timetable.week_start,
         week_end=timetable.week_end,
-        lessons=[]
+        lessons=audience_lessons(owner) if owner is not None else []
     )
-    timetables_db.append(new_timetable)
-    return new_timetable
+    return timetables_db.add(new_timetable, owner)
 
-
-# Admin routes
-# Renders the admin view of all timetables with optional filtering
-@app.get("/admin/timetables")
-async def admin_timetables(
-    request: Request,
-    current_user: UserInDB = Depends(get_current_user),
-    teacher: Optional[str] = None,
-    year_group: Optional[int] = None
-):
-    if current_user.role != "admin":
-        raise HTTPException(
-            status_code=403,
-            detail="Only administrators can access this page"
-            )
-
-    filtered_timetables = timetables_db
-
-    if teacher:
-        filtered_timetables = [
-            t for t in filtered_timetables
-            if any(lesson.teacher == teacher for lesson in t.lessons)
-            ]
-
-    if year_group:
-        filtered_timetables = [
-            t for t in filtered_timetables
-            if any(lesson.year_group == year_group for lesson in t.lessons)
-            ]
-
-    return templates.TemplateResponse(
-        "admin_timetables.html",
-        {
-            "request": request,
-            "timetables": filtered_timetables,
-            "teachers": list(set(
-                lesson.teacher
-                for timetable in timetables_db
-                for lesson in timetable.lessons
-                )),
-            "year_groups": list(range(7, 12))
-        }
-    )
+# Admin, analytics and term calendar routes
+app.include_router(admin_routes.router)
+app.include_router(analytics_routes.router)
+app.include_router(calendar_routes.router)
 
 # A sample protected route that requires authentication
 @app.get("/protected")
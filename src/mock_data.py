@@ -0,0 +1,268 @@
+# Mock data for the LMS application
+# Seeds the stores with test accounts, a mock school of teachers and
+# students, a scheduled week of lessons, their timetables and the term
+# calendar
+
+# Standard library imports
+import os
+import random
+import time as timer
+from datetime import date, time, timedelta
+from typing import Iterable, Optional, Sequence
+
+# Local imports
+from auth import UserInDB, users_db
+from models import Lesson, Timetable
+from app_log import LazyArg
+from app_state import (
+    audience_lessons,
+    global_lessons_db,
+    lesson_grid,
+    lesson_intervals,
+    lesson_occupancy,
+    logger,
+    password_pool,
+    term_calendar,
+    timetables_db
+)
+from scheduler import CURRICULUM, SchedulingProblem, solve
+from seeding import SeedHashCache
+from term_calendar import Holiday, Term, TermCalendar
+
+# Size of the mock school created at startup
+# The same SEED_RANDOM_SEED always produces the same users and lessons
+SEED_TEACHERS = int(os.environ.get("SEED_TEACHERS", 5))
+SEED_STUDENTS = int(os.environ.get("SEED_STUDENTS", 2))
+SEED_MAX_LESSONS = int(os.environ.get("SEED_MAX_LESSONS", 0)) # 0 = no limit
+SEED_RANDOM_SEED = int(os.environ.get("SEED_RANDOM_SEED", 42))
+# Classrooms and year groups of the mock school
+SEED_CLASSROOMS = [f"Room {number}" for number in range(101, 121)]
+SEED_YEAR_GROUPS = range(7, 12)
+# Processes running scheduler restarts in parallel, 1 to run them in-process
+SEED_SCHEDULER_WORKERS = int(os.environ.get("SEED_SCHEDULER_WORKERS", 1))
+# File the seed password hashes are saved to, empty to keep them in memory
+SEED_HASH_CACHE = os.environ.get("SEED_HASH_CACHE", ".seed_hashes.json")
+seed_random = random.Random(SEED_RANDOM_SEED)
+seed_hash_cache = SeedHashCache(SEED_HASH_CACHE)
+seed_password_hashes = {} # password -> hash for the seed credentials
+
+# Mock data creation functions
+# Creates test user accounts with predefined roles
+def create_test_accounts():
+    test_accounts = [
+        {"username": "admin",
+        "password": "adminpass",
+        "role": "admin",
+        "email": "admin@school.com"
+        },
+        {"username": "teacher1",
+        "password": "teacherpass",
+        "role": "teacher",
+        "email": "teacher1@school.com"
+        },
+        {"username": "student1",
+        "password": "studentpass",
+        "role": "student",
+        "year_group": 9,
+        "email": "student1@school.com"
+        }
+    ]
+    for account in test_accounts:
+        if account["username"] not in users_db:
+            hashed_password = seed_password_hashes[account["password"]]
+            new_user = UserInDB(
+                id=users_db.next_id(),
+                username=account["username"],
+                email=account["email"],
+                hashed_password=hashed_password,
+                role=account["role"],
+                year_group=account.get("year_group")
+            )
+            users_db.add(new_user)
+            logger.info("Created test account: %s (%s)",
+                        account["username"], account["role"])
+    logger.debug("Users in db: %s", LazyArg(len, users_db))
+
+# Creates mock teacher accounts with random subjects
+# Usernames that are already registered (such as the teacher1 test account)
+# are skipped so every username stays unique
+# Generated data is trusted, so models are built without validation
+def create_mock_teachers(count: int = SEED_TEACHERS):
+    subjects = [
+        "Math",
+        "English",
+        "Science",
+        "History",
+        "Geography",
+        "Art",
+        "Music",
+        "Physical Education"
+        ]
+    teachers = []
+    for i in range(count):
+        if f"teacher{i+1}" in users_db:
+            continue
+        teacher_data = {
+            "id": users_db.next_id(),
+            "username": f"teacher{i+1}",
+            "email": f"teacher{i+1}@school.com",
+            "hashed_password": seed_password_hashes["password"],
+            "role": "teacher",
+            "year_group": None,
+            "subjects": seed_random.sample(subjects, 2)
+        }
+        teacher = UserInDB.construct(**teacher_data)
+        teachers.append(teacher)
+    return teachers
+
+# Creates mock student accounts with random year groups
+# Usernames that are already registered are skipped, as for teachers
+def create_mock_students(count: int = SEED_STUDENTS):
+    students = []
+    for i in range(count):
+        if f"student{i+1}" in users_db:
+            continue
+        student_data = {
+            "id": users_db.next_id(),
+            "username": f"student{i+1}",
+            "email": f"student{i+1}@school.com",
+            "hashed_password": seed_password_hashes["password"],
+            "role": "student",
+            "year_group": seed_random.randint(7, 11),
+            "subjects": None
+        }
+        student = UserInDB.construct(**student_data)
+        students.append(student)
+    return students
+
+# Creates mock lessons for teachers and year groups
+# The week is generated by the scheduler from each year group's curriculum,
+# so no teacher, classroom or year group is ever double-booked
+# Teachers without recorded subjects (such as teacher1) can teach any
+# subject; max_lessons limits how many lessons are kept, 0 for no limit
+def create_mock_lessons(
+    max_lessons: int = SEED_MAX_LESSONS,
+    year_groups: Iterable[int] = SEED_YEAR_GROUPS,
+    classrooms: Sequence[str] = tuple(SEED_CLASSROOMS)
+):
+    problem = SchedulingProblem(
+        teachers={
+            teacher.username: teacher.subjects or tuple(CURRICULUM)
+            for teacher in users_db.with_role("teacher")
+            },
+        classrooms=classrooms,
+        year_groups=year_groups
+        )
+    schedule = solve(
+        problem,
+        seed=seed_random.randrange(2 ** 32),
+        workers=SEED_SCHEDULER_WORKERS
+        )
+    placements = schedule.placements
+    if max_lessons:
+        placements = placements[:max_lessons]
+
+    global_lessons_db.clear()  # Reset global_lessons_db
+    lesson_grid.clear()
+    lesson_occupancy.clear()
+    lesson_intervals.clear()
+    for classroom in classrooms:
+        lesson_occupancy.register("classroom", classroom)
+    for placement in placements:
+        new_lesson = Lesson.construct(
+            id=global_lessons_db.next_id(),
+            subject=placement.subject,
+            teacher=placement.teacher,
+            classroom=placement.classroom,
+            day_of_week=placement.day_of_week,
+            start_time=time(hour=placement.hour),
+            end_time=time(hour=placement.hour + 1),
+            year_group=placement.year_group
+        )
+        global_lessons_db.add(new_lesson)
+        lesson_grid.add(new_lesson)
+        lesson_occupancy.add(new_lesson)
+        lesson_intervals.add(new_lesson)
+
+    logger.info(
+        "Scheduled %d lessons in %s s after %d attempt(s), "
+        "%d requirement(s) left unscheduled",
+        len(placements), schedule.seconds, schedule.attempts,
+        len(schedule.unplaced)
+        )
+    return global_lessons_db
+
+# Creates mock timetables for users based on their roles
+# Each user's lessons come from the lesson store's indexes
+def create_mock_timetables():
+    timetables_db.clear()
+
+    week_start = date.today() - timedelta(days=date.today().weekday())
+    week_end = date.today() + timedelta(days=6)
+    for user in users_db:
+        timetable = Timetable.construct(
+            id=timetables_db.next_id(),
+            user_id=user.id,
+            week_start=week_start,
+            week_end=week_end,
+            lessons=audience_lessons(user)
+        )
+        timetables_db.add(timetable, user)
+
+    return timetables_db
+
+# Creates the terms and half-term holidays of the school year containing
+# today, which starts in September
+def create_mock_term_calendar(today: Optional[date] = None) -> TermCalendar:
+    today = today or date.today()
+    year = today.year if today.month >= 9 else today.year - 1
+    term_calendar.clear()
+    for name, start, end in (
+        ("Autumn term", date(year, 9, 1), date(year, 12, 18)),
+        ("Spring term", date(year + 1, 1, 5), date(year + 1, 3, 26)),
+        ("Summer term", date(year + 1, 4, 13), date(year + 1, 7, 21))
+        ):
+        term_calendar.add_term(Term(name, start, end))
+    for name, start, end in (
+        ("Autumn half term", date(year, 10, 26), date(year, 10, 30)),
+        ("Spring half term", date(year + 1, 2, 15), date(year + 1, 2, 19)),
+        ("Summer half term", date(year + 1, 5, 24), date(year + 1, 5, 28))
+        ):
+        term_calendar.add_holiday(Holiday(name, start, end))
+    return term_calendar
+
+# Seeds the databases with test accounts, mock users, lessons and timetables
+# The seed passwords are hashed at most once, in parallel, and the hashes
+# are reused from the seed hash cache on later startups
+def initialise_mock_data(
+    teachers: int = SEED_TEACHERS,
+    students: int = SEED_STUDENTS,
+    max_lessons: int = SEED_MAX_LESSONS,
+    random_seed: int = SEED_RANDOM_SEED,
+    year_groups: Iterable[int] = SEED_YEAR_GROUPS,
+    classrooms: Sequence[str] = tuple(SEED_CLASSROOMS)
+):
+    started = timer.perf_counter()
+    seed_random.seed(random_seed)
+    seed_password_hashes.update(seed_hash_cache.get_many(
+        ["adminpass", "teacherpass", "studentpass", "password"],
+        password_pool.hash_many
+        ))
+
+    # Create predefined test accounts (admin, teacher, student)
+    create_test_accounts()
+
+    # Add additional mock teachers and students to the users database
+    for mock_user in (create_mock_teachers(teachers) +
+                      create_mock_students(students)):
+        users_db.add(mock_user)
+
+    # Generate mock lessons and store them in the global lessons database
+    create_mock_lessons(max_lessons, year_groups, classrooms)
+
+    # Create mock timetables and the term calendar they follow
+    create_mock_timetables()
+    create_mock_term_calendar()
+    logger.info("Seeded %d users and %d lessons in %.0f ms",
+                len(users_db), len(global_lessons_db),
+                (timer.perf_counter() - started) * 1000)
@@ -45,6 +45,10 @@ class Lesson(LessonBase):
     class Config:
         orm_mode = True
 
+# The school day lessons must fit in
+SCHOOL_DAY_START = time(hour=9)
+SCHOOL_DAY_END = time(hour=15)
+
 # Model for creating a new lesson.
 # Includes validators to ensure the start and end times are valid
 # pylint: disable=no-self-argument
@@ -52,27 +56,41 @@ class LessonCreate(LessonBase):
     # Validates start time is on the hour between 9:00 & 14:00
     @validator('start_time')
     def start_time_must_be_valid(cls, v):
-        valid_start_times = [time(hour=h) for h in range(9, 15)]
+        valid_start_times = [
+            time(hour=h)
+            for h in range(SCHOOL_DAY_START.hour, SCHOOL_DAY_END.hour)
+            ]
         if v not in valid_start_times:
             raise ValueError(
               'start time must be on the hour between 9:00 and 14:00'
             )
         return v
 
-    # Validates end time is exactly one hour after the start time
+    # Validates end time is on the hour, after the start time and by 15:00
+    # Lessons may run for one hour or several
     @validator('end_time')
-    def end_time_must_be_one_hour_after_start_time(cls, v, values):
-        if 'start_time' in values:
-            expected_end_time = (
-                datetime.combine(date.today(),
-                values['start_time']) + timedelta(hours=1)
-            ).time()
-            if v != expected_end_time:
-                raise ValueError(
-                  'end time must be exactly one hour after start time'
-                )
+    def end_time_must_be_after_start_time(cls, v, values):
+        if v.minute or v.second or v.microsecond:
+            raise ValueError('end time must be on the hour')
+        if 'start_time' in values and v <= values['start_time']:
+            raise ValueError('end time must be after start time')
+        if v > SCHOOL_DAY_END:
+            raise ValueError('end time must be no later than 15:00')
         return v
 
+# Returns the end time of a lesson starting at start_time ("HH:MM") and
+# lasting the given number of hours
+# Raises ValueError unless the lesson lasts an hour or more and ends by the
+# end of the school day, so a long or negative length cannot wrap past
+# midnight to a valid looking time
+def lesson_end_time(start_time: str, hours: int = 1) -> time:
+    start = datetime.strptime(start_time, "%H:%M")
+    if hours < 1:
+        raise ValueError('lesson must last at least one hour')
+    if hours > SCHOOL_DAY_END.hour - start.hour:
+        raise ValueError('end time must be no later than 15:00')
+    return (start + timedelta(hours=hours)).time()
+
 # Model for editing an existing lesson
 # Includes fields that can be modified when updating a lesson
 class LessonEditModel(BaseModel):
@@ -91,6 +109,35 @@ class LessonAddModel(BaseModel):
     start_time: str
     year_group: int
 
+# Model for one operation in a bulk lesson request
+# action is "create", "update", "reassign" or "delete"
+# create and update carry the lesson fields, which are validated as a
+# LessonCreate per operation; reassign carries only the new teacher
+class LessonBulkOperation(BaseModel):
+    action: str
+    lesson_id: Optional[int] = None
+    lesson: Optional[dict] = None
+    teacher: Optional[str] = None
+
+# Model for a bulk lesson request, applied all together or not at all
+class LessonBulkRequest(BaseModel):
+    operations: List[LessonBulkOperation]
+
+# Model for the outcome of one operation in a bulk lesson request
+class LessonBulkResult(BaseModel):
+    index: int
+    action: str
+    ok: bool
+    lesson_id: Optional[int] = None
+    lesson: Optional[Lesson] = None
+    error: Optional[str] = None
+
+# Model for the response to a bulk lesson request
+# applied is False if any operation failed, in which case none were applied
+class LessonBulkResponse(BaseModel):
+    applied: bool
+    results: List[LessonBulkResult]
+
 # Model representing a complete timetable
 # Includes a list of lessons and metadata about the timetable
 class Timetable(BaseModel):
@@ -109,3 +156,35 @@ class TimetableCreate(BaseModel):
     user_id: int
     week_start: date
     week_end: date
+
+# Model for a term or holiday in the term calendar, start to end inclusive
+class CalendarPeriod(BaseModel):
+    name: str
+    start: date
+    end: date
+
+    @validator('end')
+    def end_must_not_be_before_start(cls, v, values):
+        if 'start' in values and v < values['start']:
+            raise ValueError('end must not be before start')
+        return v
+
+# Model for a one-off change to a single occurrence of a lesson
+# With cancelled set the lesson does not happen that day; otherwise the
+# given fields replace the lesson's for that day only
+class LessonExceptionModel(BaseModel):
+    lesson_id: int
+    date: date
+    cancelled: bool = False
+    subject: Optional[str] = None
+    teacher: Optional[str] = None
+    classroom: Optional[str] = None
+    start_time: Optional[time] = None
+    end_time: Optional[time] = None
+
+# Model for one lesson on one date
+class LessonOccurrence(BaseModel):
+    date: date
+    start: datetime
+    end: datetime
+    lesson: Lesson
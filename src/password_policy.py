@@ -0,0 +1,61 @@
+# Password hashing policy for the LMS application
+# Picks the bcrypt work factor for this machine so that verifying a password
+# takes about a configured target time, and applies it to the single
+# password context in the auth module
+# Hashes made under an older policy are flagged by pwd_context.needs_update
+# and are rehashed the next time their user logs in
+
+# Standard library imports
+import math
+import time
+
+# Local imports
+from auth import pwd_context
+
+# Lowest and highest bcrypt cost the calibration will choose
+# Each extra round doubles the time taken to hash or verify a password
+BCRYPT_MIN_ROUNDS = 10
+BCRYPT_MAX_ROUNDS = 16
+
+# Returns the bcrypt cost currently used for new hashes
+def current_bcrypt_rounds() -> int:
+    return pwd_context.handler("bcrypt").default_rounds
+
+# Measures how long one bcrypt hash takes at the given cost, in milliseconds
+# Verification costs the same as hashing, so this is the login cost too
+def measure_bcrypt_ms(rounds: int, samples: int = 1) -> float:
+    handler = pwd_context.handler("bcrypt").using(rounds=rounds)
+    timings = []
+    for _ in range(samples):
+        started = time.perf_counter()
+        handler.hash("calibration password")
+        timings.append(time.perf_counter() - started)
+    return min(timings) * 1000
+
+# Picks the highest bcrypt cost whose verification stays within target_ms
+# The cheapest cost is measured once and the rest are extrapolated, since
+# each round doubles the work, then the choice is measured to confirm it
+def calibrate_bcrypt_rounds(
+    target_ms: float,
+    min_rounds: int = BCRYPT_MIN_ROUNDS,
+    max_rounds: int = BCRYPT_MAX_ROUNDS
+) -> dict:
+    base_ms = measure_bcrypt_ms(min_rounds, samples=2)
+    extra_rounds = (
+        math.floor(math.log2(target_ms / base_ms)) if target_ms > base_ms
+        else 0
+        )
+    rounds = min(max_rounds, min_rounds + extra_rounds)
+    measured_ms = base_ms * 2 ** (rounds - min_rounds)
+    if rounds > min_rounds:
+        measured_ms = measure_bcrypt_ms(rounds)
+        # Step back down if the estimate turned out to be optimistic
+        while measured_ms > target_ms and rounds > min_rounds:
+            rounds -= 1
+            measured_ms /= 2
+    return {"rounds": rounds, "measured_ms": round(measured_ms, 1)}
+
+# Makes the given bcrypt cost the policy for new hashes
+# Existing hashes with a different cost will report needs_update
+def apply_bcrypt_rounds(rounds: int):
+    pwd_context.update(bcrypt__rounds=rounds)
@@ -0,0 +1,160 @@
+# Worker pool for password hashing and verification
+# bcrypt is deliberately slow and CPU bound, so calling it directly from an
+# async route handler blocks the event loop for every other request
+# This pool runs those calls on worker threads or processes instead, with a
+# bound on how many calls may be waiting at any one time
+
+# Standard library imports
+import asyncio
+from concurrent.futures import (
+    Executor,
+    ProcessPoolExecutor,
+    ThreadPoolExecutor
+)
+from threading import Lock
+from typing import Iterable, List, Optional
+
+# FastAPI and related imports
+from fastapi import HTTPException, status
+
+# Local imports
+import auth
+
+
+# Runs password operations on a thread or process pool
+# kind: "thread" or "process"
+# workers: number of calls that run at the same time
+# max_queue: number of calls allowed to wait for a worker before new calls
+# are rejected with 503
+# Holds its configuration, load counters and the executor with its lock
+class PasswordPool: # pylint: disable=too-many-instance-attributes
+    def __init__(self, kind: str = "thread", workers: int = 4,
+                 max_queue: int = 100):
+        if kind not in ("thread", "process"):
+            raise ValueError(f"Unknown password pool kind: {kind}")
+        self.kind = kind
+        self.workers = workers
+        self.max_queue = max_queue
+        self.in_flight = 0
+        self.completed = 0
+        self.rejected = 0
+        # Guards swapping the executor against calls being submitted to it
+        self._lock = Lock()
+        self._executor: Optional[Executor] = None
+
+    # Number of calls submitted but still waiting for a free worker
+    @property
+    def queue_depth(self) -> int:
+        return max(0, self.in_flight - self.workers)
+
+    # Verifies a plain password against a hashed password on the pool
+    async def verify(self, plain_password: str, hashed_password: str) -> bool:
+        return await self._run(
+            auth.verify_password, plain_password, hashed_password
+            )
+
+    # Generates a hash for the given password on the pool
+    async def hash(self, password: str) -> str:
+        return await self._run(auth.get_password_hash, password)
+
+    # Hashes a batch of passwords on the pool, e.g. for a bulk import
+    # At most one job per worker is queued at a time, so logins arriving
+    # during a large batch wait behind a few hashes rather than all of them
+    # Each chunk is admitted like any other call, so a busy pool rejects
+    # the batch with 503 rather than queueing past max_queue
+    async def hash_batch(self, passwords: List[str]) -> List[str]:
+        hashes: List[str] = []
+        for start in range(0, len(passwords), self.workers):
+            chunk = passwords[start:start + self.workers]
+            self._admit(len(chunk))
+            try:
+                loop = asyncio.get_running_loop()
+                with self._lock:
+                    executor = self._get_executor()
+                    futures = [
+                        loop.run_in_executor(
+                            executor, auth.get_password_hash, password
+                            )
+                        for password in chunk
+                        ]
+                hashes.extend(await asyncio.gather(*futures))
+            finally:
+                self.in_flight -= len(chunk)
+                self.completed += len(chunk)
+        return hashes
+
+    # Hashes many passwords in parallel, blocking until all are done
+    # Used outside the event loop, e.g. when seeding data at startup
+    def hash_many(self, passwords: Iterable[str]) -> List[str]:
+        with self._lock:
+            results = self._get_executor().map(
+                auth.get_password_hash, passwords
+                )
+        return list(results)
+
+    # Replaces process workers, so they pick up a change to the password
+    # policy; thread workers share the policy with the app and are kept
+    # New calls go to the new workers straight away, while calls already
+    # running finish on the old ones
+    def restart(self):
+        if self.kind != "process":
+            return
+        with self._lock:
+            old, self._executor = self._executor, None
+        if old is not None:
+            old.shutdown(wait=False)
+
+    # Stops the workers, a new executor is created on next use
+    def shutdown(self):
+        with self._lock:
+            old, self._executor = self._executor, None
+        if old is not None:
+            old.shutdown(wait=True)
+
+    # Returns the pool configuration and load counters
+    def stats(self) -> dict:
+        return {
+            "kind": self.kind,
+            "workers": self.workers,
+            "max_queue": self.max_queue,
+            "in_flight": self.in_flight,
+            "queue_depth": self.queue_depth,
+            "completed": self.completed,
+            "rejected": self.rejected,
+        }
+
+    async def _run(self, func, *args):
+        self._admit(1)
+        try:
+            loop = asyncio.get_running_loop()
+            with self._lock:
+                future = loop.run_in_executor(
+                    self._get_executor(), func, *args
+                    )
+            return await future
+        finally:
+            self.in_flight -= 1
+            self.completed += 1
+
+    # Counts calls as in flight, or raises 503 if waiting for a worker would
+    # take the queue past max_queue
+    def _admit(self, calls: int):
+        if self.in_flight + calls > self.workers + self.max_queue:
+            self.rejected += calls
+            raise HTTPException(
+                status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                detail="Server is busy, please try again shortly",
+                headers={"Retry-After": "1"},
+            )
+        self.in_flight += calls
+
+    def _get_executor(self) -> Executor:
+        if self._executor is None:
+            if self.kind == "process":
+                self._executor = ProcessPoolExecutor(max_workers=self.workers)
+            else:
+                self._executor = ThreadPoolExecutor(
+                    max_workers=self.workers,
+                    thread_name_prefix="password"
+                    )
+        return self._executor
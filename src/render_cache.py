@@ -0,0 +1,113 @@
+# Render cache for the LMS application's Jinja2 pages
+# Many users see exactly the same page or page fragment: every student in a
+# year group gets the same lesson list, every admin the same timetables
+# Rendered HTML is kept under a key made of the template, the viewer's role
+# scope (year group, teacher or admin) and the version of the data it was
+# rendered from, so a repeat view is a dictionary lookup; a write moves the
+# version on, and the stale entries are never asked for again and age out
+# Entries are evicted least recently used first once the cache holds more
+# than max_bytes of HTML
+
+# Standard library imports
+import sys
+from collections import OrderedDict
+from threading import Lock
+from typing import Callable, Hashable, Iterable, Tuple
+
+# Third-party imports
+from jinja2 import Environment
+from markupsafe import Markup
+
+# Local imports
+from cache_stats import CacheStats
+
+# A page to pre-render: template name, key and a function building the
+# template context
+WarmJob = Tuple[str, Hashable, Callable[[], dict]]
+
+
+# LRU cache of rendered templates, capped by the memory the HTML takes
+class RenderCache(CacheStats):
+    def __init__(self, env: Environment, max_bytes: int):
+        super().__init__()
+        self.env = env
+        self.max_bytes = max_bytes
+        self._entries: "OrderedDict[Hashable, Markup]" = OrderedDict()
+        self._bytes = 0
+        self._lock = Lock()
+        self.evictions = 0
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def __contains__(self, key) -> bool:
+        with self._lock:
+            return key in self._entries
+
+    # Returns the template rendered for a key, rendering it on a miss
+    # context is only called on a miss, so the data for the page is not
+    # even fetched when it is cached
+    # The HTML is returned as Markup, so it can be placed inside another
+    # template without being escaped
+    def render(self, template_name: str, key: Hashable,
+               context: Callable[[], dict]) -> Markup:
+        cache_key = (template_name, key)
+        with self._lock:
+            html = self._entries.get(cache_key)
+            if html is not None:
+                self._entries.move_to_end(cache_key)
+                self.hit()
+                return html
+            self.miss()
+        html = Markup(self.env.get_template(template_name).render(context()))
+        self._store(cache_key, html)
+        return html
+
+    # Renders the pages that are not cached yet, e.g. after startup or a
+    # bulk change, so the first visitors get cached pages too
+    # Returns how many pages were rendered
+    def warm(self, jobs: Iterable[WarmJob]) -> int:
+        rendered = 0
+        for template_name, key, context in jobs:
+            cache_key = (template_name, key)
+            if cache_key in self:
+                continue
+            html = Markup(
+                self.env.get_template(template_name).render(context())
+                )
+            self._store(cache_key, html)
+            rendered += 1
+        return rendered
+
+    # Removes every entry; the statistics are kept
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    # Returns the cache size and hit rate
+    def stats(self) -> dict:
+        return {
+            "entries": len(self._entries),
+            "bytes": self._bytes,
+            "max_bytes": self.max_bytes,
+            "evictions": self.evictions,
+            **self.lookup_stats()
+        }
+
+    # Adds an entry and evicts the least recently used ones over the cap
+    # A page bigger than the whole cache is not kept
+    def _store(self, cache_key: Hashable, html: Markup):
+        size = sys.getsizeof(html)
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            previous = self._entries.pop(cache_key, None)
+            if previous is not None:
+                self._bytes -= sys.getsizeof(previous)
+            self._entries[cache_key] = html
+            self._bytes += size
+            while self._bytes > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self._bytes -= sys.getsizeof(evicted)
+                self.evictions += 1
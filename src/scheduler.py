@@ -0,0 +1,441 @@
+# Timetable generation for the LMS application
+# Builds a conflict-free week of lessons from the teachers, classrooms,
+# year groups and the weekly hours each subject needs
+# Each year group's subjects are first given a qualified teacher, then the
+# hours are placed one at a time by a backtracking search: the subject with
+# the least room to manoeuvre goes next, and a subject that no longer has
+# enough free hours for what it still needs is caught straight away
+# Busy hours are bitsets over the school week, one bit per teaching hour,
+# so the free hours of a subject are a few bit operations away, and the
+# subjects wait in a heap ordered by how constrained they are
+# A search that backtracks too much starts again with a different seed;
+# restarts can run in parallel in a process pool
+
+# Standard library imports
+import heapq
+import random
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from typing import (
+    Dict, Hashable, Iterable, List, NamedTuple, Optional, Sequence, Tuple
+)
+
+# Days and start hours lessons can be scheduled in
+SCHOOL_DAYS = ("Monday", "Tuesday", "Wednesday", "Thursday", "Friday")
+SCHOOL_HOURS = tuple(range(9, 15))
+HOURS_PER_DAY = len(SCHOOL_HOURS)
+SLOTS_PER_WEEK = len(SCHOOL_DAYS) * HOURS_PER_DAY
+ALL_SLOTS = (1 << SLOTS_PER_WEEK) - 1
+
+# Bitset of the slots on each school day
+DAY_MASKS = tuple(
+    ((1 << len(SCHOOL_HOURS)) - 1) << (day * len(SCHOOL_HOURS))
+    for day in range(len(SCHOOL_DAYS))
+    )
+
+# Weekly hours every year group needs of each subject
+CURRICULUM = {
+    "Math": 5,
+    "English": 5,
+    "Science": 4,
+    "History": 2,
+    "Geography": 2,
+    "Art": 2,
+    "Music": 2,
+    "Physical Education": 2
+    }
+
+# Backtracking steps a search may take before it restarts
+MAX_BACKTRACKS = 2000
+
+
+# One scheduled lesson
+class Placement(NamedTuple):
+    year_group: int
+    subject: str
+    teacher: str
+    classroom: str
+    day_of_week: str
+    hour: int
+
+
+# What to schedule: who teaches what, where, and how much of each subject
+# each year group needs
+class SchedulingProblem:
+    def __init__(
+        self,
+        teachers: Dict[str, Iterable[str]],
+        classrooms: Sequence[str],
+        year_groups: Iterable[int],
+        curriculum: Optional[Dict[str, int]] = None,
+        max_teacher_hours: int = SLOTS_PER_WEEK
+    ):
+        # teacher username -> subjects they can teach
+        self.teachers = {
+            teacher: tuple(subjects) for teacher, subjects in teachers.items()
+            }
+        self.classrooms = tuple(classrooms)
+        self.year_groups = tuple(year_groups)
+        self.curriculum = dict(curriculum or CURRICULUM)
+        self.max_teacher_hours = max_teacher_hours
+
+
+# The outcome of scheduling a problem
+# unplaced lists (year group, subject, hours) that could not be scheduled,
+# e.g. because no teacher teaches the subject
+class Schedule(NamedTuple):
+    placements: List[Placement]
+    unplaced: List[Tuple[int, str, int]]
+    complete: bool
+    attempts: int
+    backtracks: int
+    seconds: float
+
+
+# Returns the number of slots in a bitset
+def _count(mask: int) -> int:
+    return bin(mask).count("1")
+
+# Returns the slot numbers in a bitset
+def _slots(mask: int) -> List[int]:
+    slots = []
+    while mask:
+        low_bit = mask & -mask
+        slots.append(low_bit.bit_length() - 1)
+        mask ^= low_bit
+    return slots
+
+# Gives each year group's subjects a teacher qualified to teach them
+# Teachers are picked least loaded first, so hours are spread across staff,
+# and teachers with room under max_teacher_hours are preferred
+# Returns the classes as [year group, subject, teacher, hours] and the
+# requirements no teacher can take
+def assign_teachers(problem: SchedulingProblem, rng: random.Random):
+    qualified: Dict[str, List[str]] = {}
+    for teacher, subjects in problem.teachers.items():
+        for subject in subjects:
+            qualified.setdefault(subject, []).append(teacher)
+
+    load = {teacher: 0 for teacher in problem.teachers}
+    classes = []
+    unplaced = []
+    requirements = [
+        (year_group, subject, hours)
+        for year_group in problem.year_groups
+        for subject, hours in problem.curriculum.items()
+        if hours > 0
+        ]
+    # Subjects with the fewest teachers are staffed first
+    rng.shuffle(requirements)
+    requirements.sort(key=lambda req: len(qualified.get(req[1], ())))
+    for year_group, subject, hours in requirements:
+        candidates = qualified.get(subject)
+        if not candidates:
+            unplaced.append((year_group, subject, hours))
+            continue
+        teacher = min(candidates, key=lambda t, hours=hours: (
+            load[t] + hours > problem.max_teacher_hours, load[t], rng.random()
+            ))
+        load[teacher] += hours
+        classes.append([year_group, subject, teacher, hours])
+    return classes, unplaced
+
+# Returns whether a teacher or year group has more hours than the week has,
+# in which case the classes can never be scheduled in full
+def overloaded(classes: List[list]) -> bool:
+    load: Dict[Hashable, int] = {}
+    for year_group, _, teacher, hours in classes:
+        for resource in (("year_group", year_group), ("teacher", teacher)):
+            load[resource] = load.get(resource, 0) + hours
+    return any(hours > SLOTS_PER_WEEK for hours in load.values())
+
+
+# The hours placed so far in one search: the busy slots of each teacher
+# and year group, the classrooms left in each slot and the days each class
+# has lessons on
+class _Week:
+    def __init__(self, problem: SchedulingProblem, classes: List[list]):
+        self.classes = classes
+        # ("year_group", year group) or ("teacher", username) -> busy slots
+        self.busy: Dict[Hashable, int] = {}
+        for index in range(len(classes)):
+            for resource in self.resources(index):
+                self.busy[resource] = 0
+        # Hours each class has on each day, and the days it has any
+        self.day_hours = [[0] * len(SCHOOL_DAYS) for _ in classes]
+        self.class_days = [0] * len(classes)
+        self.free_rooms = [
+            list(problem.classrooms) for _ in range(SLOTS_PER_WEEK)
+            ]
+        self.rooms_full = 0 if problem.classrooms else ALL_SLOTS
+        self.placed: List[Tuple[int, int, str]] = []  # (class, slot, room)
+
+    # Returns the year group and teacher a class needs
+    def resources(self, index: int) -> Tuple[Hashable, Hashable]:
+        year_group, _, teacher, _ = self.classes[index]
+        return ("year_group", year_group), ("teacher", teacher)
+
+    # Returns the slots a class could have its next hour in
+    def free_slots(self, index: int) -> int:
+        year_group, teacher = self.resources(index)
+        return ALL_SLOTS & ~(
+            self.busy[year_group] | self.busy[teacher] | self.rooms_full
+            )
+
+    # Returns the free slots to try for a class, in the order they are
+    # popped; days the subject already has are tried last, to spread it out
+    def candidate_slots(self, index: int, free: int,
+                        rng: random.Random) -> List[int]:
+        fresh = _slots(free & ~self.class_days[index])
+        repeat = _slots(free & self.class_days[index])
+        rng.shuffle(fresh)
+        rng.shuffle(repeat)
+        return repeat + fresh
+
+    # Places an hour of a class in a slot
+    # Returns whether that used up the slot's last classroom
+    def place(self, index: int, slot: int) -> bool:
+        bit = 1 << slot
+        day = slot // HOURS_PER_DAY
+        for resource in self.resources(index):
+            self.busy[resource] |= bit
+        self.day_hours[index][day] += 1
+        self.class_days[index] |= DAY_MASKS[day]
+        classroom = self.free_rooms[slot].pop()
+        rooms_changed = not self.free_rooms[slot]
+        if rooms_changed:
+            self.rooms_full |= bit
+        self.classes[index][3] -= 1
+        self.placed.append((index, slot, classroom))
+        return rooms_changed
+
+    # Takes back the last hour placed
+    # Returns its class and whether that freed a classroom in a full slot
+    def unplace(self) -> Tuple[int, bool]:
+        index, slot, classroom = self.placed.pop()
+        bit = 1 << slot
+        day = slot // HOURS_PER_DAY
+        for resource in self.resources(index):
+            self.busy[resource] &= ~bit
+        self.day_hours[index][day] -= 1
+        if not self.day_hours[index][day]:
+            self.class_days[index] &= ~DAY_MASKS[day]
+        rooms_changed = not self.free_rooms[slot]
+        self.free_rooms[slot].append(classroom)
+        self.rooms_full &= ~bit
+        self.classes[index][3] += 1
+        return index, rooms_changed
+
+    # Returns the placed hours as lessons, in week order
+    def placements(self) -> List[Placement]:
+        placements = [
+            Placement(
+                year_group=self.classes[index][0],
+                subject=self.classes[index][1],
+                teacher=self.classes[index][2],
+                classroom=classroom,
+                day_of_week=SCHOOL_DAYS[slot // HOURS_PER_DAY],
+                hour=SCHOOL_HOURS[slot % HOURS_PER_DAY]
+                )
+            for index, slot, classroom in self.placed
+            ]
+        placements.sort(key=lambda p: (
+            SCHOOL_DAYS.index(p.day_of_week), p.hour, p.year_group
+            ))
+        return placements
+
+
+# Classes with hours still to place, most constrained first
+# Classes wait in a heap ordered by slack (free slots minus hours still
+# needed); placing an hour only changes the slack of classes sharing its
+# year group or teacher, so only those are re-queued, unless a slot ran out
+# of classrooms, which changes every class
+# An entry is stale once its class has been re-queued with a newer stamp
+class _SlackQueue:
+    def __init__(self, week: _Week, rng: random.Random):
+        self.week = week
+        # (slack, tie break, class, stamp)
+        self.heap: List[Tuple[int, float, int, int]] = []
+        self.stamps = [0] * len(week.classes)
+        self.tie_breaks = [rng.random() for _ in week.classes]
+        # Year group or teacher -> the classes that need it
+        self.sharing: Dict[Hashable, List[int]] = {}
+        for index in range(len(week.classes)):
+            for resource in week.resources(index):
+                self.sharing.setdefault(resource, []).append(index)
+        self.requeue(range(len(week.classes)))
+
+    # Queues classes again with their current slack
+    def requeue(self, indexes: Iterable[int]):
+        for index in indexes:
+            self.stamps[index] += 1
+            remaining = self.week.classes[index][3]
+            if remaining > 0:
+                heapq.heappush(self.heap, (
+                    _count(self.week.free_slots(index)) - remaining,
+                    self.tie_breaks[index], index, self.stamps[index]
+                    ))
+
+    # Queues again the classes whose slack an hour of a class changed
+    def requeue_affected(self, index: int, rooms_changed: bool):
+        if rooms_changed:
+            self.requeue(range(len(self.stamps)))
+            return
+        affected = set()
+        for resource in self.week.resources(index):
+            affected.update(self.sharing[resource])
+        self.requeue(affected)
+
+    # Returns (slack, class) for the most constrained class, or None once
+    # every hour is placed
+    def peek(self) -> Optional[Tuple[int, int]]:
+        heap = self.heap
+        while heap and heap[0][3] != self.stamps[heap[0][2]]:
+            heapq.heappop(heap)
+        if not heap:
+            return None
+        return heap[0][0], heap[0][2]
+
+    # Places an hour of a class and re-queues the classes it affects
+    def place(self, index: int, slot: int):
+        self.requeue_affected(index, self.week.place(index, slot))
+
+    # Takes back the last hour placed and re-queues the classes it affects
+    def unplace(self):
+        self.requeue_affected(*self.week.unplace())
+
+
+# Places every hour it can without backtracking; a class left without a
+# free slot has its remaining hours added to unplaced
+def _fill(queue: _SlackQueue, rng: random.Random, unplaced: list):
+    week = queue.week
+    while True:
+        head = queue.peek()
+        if head is None:
+            return
+        index = head[1]
+        free = week.free_slots(index)
+        if not free:
+            year_group, subject, _, remaining = week.classes[index]
+            unplaced.append((year_group, subject, remaining))
+            week.classes[index][3] = 0
+            queue.requeue([index])
+            continue
+        queue.place(index, week.candidate_slots(index, free, rng).pop())
+
+# Places every hour, undoing hours at a dead end until one has another
+# slot to try
+# Returns the number of backtracks, or None if it ran past max_backtracks
+def _backtrack(queue: _SlackQueue, rng: random.Random,
+               max_backtracks: int) -> Optional[int]:
+    week = queue.week
+    # Choice points: (class, untried slots) for each placed hour
+    stack: List[Tuple[int, List[int]]] = []
+    backtracks = 0
+    while True:
+        head = queue.peek()
+        if head is None:
+            return backtracks
+        slack, index = head
+        if slack >= 0:
+            candidates = week.candidate_slots(
+                index, week.free_slots(index), rng
+                )
+            queue.place(index, candidates.pop())
+            stack.append((index, candidates))
+            continue
+
+        while True:
+            if not stack or backtracks >= max_backtracks:
+                return None
+            backtracks += 1
+            index, candidates = stack[-1]
+            queue.unplace()
+            if candidates:
+                queue.place(index, candidates.pop())
+                break
+            stack.pop()
+
+# Runs one search for a schedule
+# Returns None if the search used up its backtracking budget, or if a
+# teacher or year group has more hours than fit in the week; with
+# best_effort it never backtracks and leaves out the hours it cannot place
+def search(problem: SchedulingProblem, seed: int,
+           max_backtracks: int = MAX_BACKTRACKS, best_effort: bool = False):
+    rng = random.Random(seed)
+    classes, unplaced = assign_teachers(problem, rng)
+    if not best_effort and overloaded(classes):
+        return None
+
+    week = _Week(problem, classes)
+    queue = _SlackQueue(week, rng)
+    backtracks: Optional[int] = 0
+    if best_effort:
+        _fill(queue, rng, unplaced)
+    else:
+        backtracks = _backtrack(queue, rng, max_backtracks)
+        if backtracks is None:
+            return None
+    return week.placements(), unplaced, backtracks
+
+# Runs searches for the seeds in a process pool until one succeeds
+# Returns the first result, or None, and the number of searches finished
+def _search_parallel(problem: SchedulingProblem, seeds: List[int],
+                     max_backtracks: int, workers: int):
+    attempts = 0
+    result = None
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        pending = {
+            executor.submit(search, problem, attempt_seed, max_backtracks)
+            for attempt_seed in seeds
+            }
+        while pending and result is None:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                attempts += 1
+                if result is None:
+                    result = future.result()
+        for future in pending:
+            future.cancel()
+    return result, attempts
+
+# Schedules a problem, restarting the search with a new seed until one
+# succeeds or the restarts run out
+# If none succeeds, a best-effort schedule is returned that is still
+# conflict-free but leaves out some hours
+# With workers > 1 the restarts run in parallel and the first success wins
+def solve(
+    problem: SchedulingProblem,
+    seed: int = 0,
+    restarts: int = 8,
+    max_backtracks: int = MAX_BACKTRACKS,
+    workers: int = 1
+) -> Schedule:
+    started = time.perf_counter()
+    seeds = [seed + attempt for attempt in range(restarts)]
+
+    if workers > 1:
+        result, attempts = _search_parallel(
+            problem, seeds, max_backtracks, workers
+            )
+    else:
+        result, attempts = None, 0
+        for attempt_seed in seeds:
+            attempts += 1
+            result = search(problem, attempt_seed, max_backtracks)
+            if result is not None:
+                break
+
+    complete = result is not None
+    if result is None:
+        attempts += 1
+        result = search(problem, seed, best_effort=True)
+    placements, unplaced, backtracks = result
+    return Schedule(
+        placements=placements,
+        unplaced=unplaced,
+        complete=complete and not unplaced,
+        attempts=attempts,
+        backtracks=backtracks,
+        seconds=round(time.perf_counter() - started, 3)
+        )
@@ -0,0 +1,59 @@
+# Helpers for seeding the in-memory databases with mock data at startup
+
+# Standard library imports
+import json
+import os
+from typing import Callable, Dict, Iterable, List
+
+# Local imports
+from auth import pwd_context
+
+# Persisted cache of password hashes for the seed credentials
+# Every mock account uses one of a handful of known passwords, so the bcrypt
+# work is done once per password and the hashes are saved to disk, making
+# later startups skip hashing entirely
+# In a production environment, seed credentials would not exist at all
+class SeedHashCache:
+    def __init__(self, path: str = ""):
+        # An empty path keeps the cache in memory only
+        self.path = path
+        self._hashes: Dict[str, str] = self._load()
+
+    # Returns a hash for each password, hashing only the ones not cached
+    # Missing passwords are passed to hash_many together so they can be
+    # hashed in parallel
+    def get_many(
+        self,
+        passwords: Iterable[str],
+        hash_many: Callable[[List[str]], List[str]]
+    ) -> Dict[str, str]:
+        wanted = list(dict.fromkeys(passwords))
+        missing = [p for p in wanted if p not in self._hashes]
+        if missing:
+            self._hashes.update(zip(missing, hash_many(missing)))
+            self._save()
+        return {p: self._hashes[p] for p in wanted}
+
+    def _load(self) -> Dict[str, str]:
+        if not self.path or not os.path.exists(self.path):
+            return {}
+        try:
+            with open(self.path, encoding="utf-8") as cache_file:
+                hashes = json.load(cache_file)
+        except (OSError, ValueError):
+            return {}
+        # Drop anything the password context would not accept as a hash
+        return {
+            password: hashed for password, hashed in hashes.items()
+            if isinstance(hashed, str) and pwd_context.identify(hashed)
+            }
+
+    def _save(self):
+        if not self.path:
+            return
+        try:
+            with open(self.path, "w", encoding="utf-8") as cache_file:
+                json.dump(self._hashes, cache_file)
+        except OSError:
+            # The cache is only an optimisation, seeding still works without it
+            pass
@@ -0,0 +1,86 @@
+# Cache of verified JWT sessions
+# Maps an access token to the user it was resolved to, so that repeat
+# requests carrying the same token skip the JWT signature check and the
+# user lookup until the token expires
+
+# Standard library imports
+import time
+from collections import OrderedDict
+from typing import Dict, Optional, Set
+
+# Local imports
+from cache_stats import CacheStats
+
+
+# Bounded LRU cache of token -> user entries that expire at the token's exp
+class SessionCache(CacheStats):
+    def __init__(self, max_size: int = 10000):
+        super().__init__()
+        self.max_size = max_size
+        # token -> (user, expiry as a unix timestamp), least recently used
+        # first
+        self._entries: "OrderedDict[str, tuple]" = OrderedDict()
+        # username -> tokens cached for that user, used for invalidation
+        self._tokens_by_user: Dict[str, Set[str]] = {}
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    # Returns the cached user for a token
+    # Returns None if the token is not cached or its entry has expired
+    def get(self, token: str, now: Optional[float] = None):
+        entry = self._entries.get(token)
+        if entry is None:
+            self.miss()
+            return None
+        user, expires_at = entry
+        if expires_at <= (time.time() if now is None else now):
+            self._discard(token)
+            self.miss()
+            return None
+        self._entries.move_to_end(token)
+        self.hit()
+        return user
+
+    # Caches the user a token resolved to until the token's expiry time
+    # Evicts the least recently used entries once the cache is full
+    def put(self, token: str, user, expires_at: float):
+        if token in self._entries:
+            self._discard(token)
+        self._entries[token] = (user, expires_at)
+        self._tokens_by_user.setdefault(user.username, set()).add(token)
+        while len(self._entries) > self.max_size:
+            oldest = next(iter(self._entries))
+            self._discard(oldest)
+
+    # Removes a single token, e.g. when it is logged out or blacklisted
+    def invalidate(self, token: str):
+        if token in self._entries:
+            self._discard(token)
+
+    # Removes every cached token for a user, e.g. when the user changes
+    def invalidate_user(self, username: str):
+        for token in self._tokens_by_user.pop(username, set()):
+            self._entries.pop(token, None)
+
+    # Removes every entry and resets the counters
+    def clear(self):
+        self._entries.clear()
+        self._tokens_by_user.clear()
+        self.reset_lookups()
+
+    # Returns the cache size and hit/miss counters
+    def stats(self) -> dict:
+        return {
+            "size": len(self._entries),
+            "max_size": self.max_size,
+            **self.lookup_stats()
+        }
+
+    def _discard(self, token: str):
+        user, _ = self._entries.pop(token)
+        tokens = self._tokens_by_user.get(user.username)
+        if tokens is not None:
+            tokens.discard(token)
+            if not tokens:
+                del self._tokens_by_user[user.username]
@@ -0,0 +1,388 @@
+# Term calendar for the LMS application
+# Lessons are weekly patterns; the calendar says on which dates they
+# actually happen: every date inside a term that is not a holiday, with
+# one-off exceptions that cancel or change a single occurrence
+# Occurrences are generated lazily, a day at a time, for whatever date
+# range is asked for, so nothing is ever stored per week
+# IntervalIndex keeps each teacher's, classroom's and year group's weekly
+# lesson times sorted, so a range query for one resource bisects straight
+# to the lessons it overlaps instead of scanning every lesson
+
+# Standard library imports
+from bisect import bisect_left, bisect_right, insort
+from datetime import date, datetime, time, timedelta
+from typing import (
+    Dict, Hashable, Iterable, Iterator, List, NamedTuple, Optional, Set, Tuple
+)
+
+# Local imports
+from conflicts import DAY_INDEX, lesson_resources
+from models import Lesson
+from versions import Versions
+
+# Day names by date.weekday()
+DAY_NAMES = tuple(sorted(DAY_INDEX, key=DAY_INDEX.get))
+MINUTES_PER_DAY = 24 * 60
+
+# Lesson fields a one-off exception may change
+EXCEPTION_FIELDS = (
+    "subject", "teacher", "classroom", "start_time", "end_time"
+    )
+
+ONE_DAY = timedelta(days=1)
+
+
+# A school term, from start to end inclusive
+class Term(NamedTuple):
+    name: str
+    start: date
+    end: date
+
+
+# A holiday inside or between terms, from start to end inclusive
+class Holiday(NamedTuple):
+    name: str
+    start: date
+    end: date
+
+
+# One lesson on one date, after any exception for that date is applied
+class Occurrence(NamedTuple):
+    lesson: Lesson
+    date: date
+
+    @property
+    def start(self) -> datetime:
+        return datetime.combine(self.date, self.lesson.start_time)
+
+    @property
+    def end(self) -> datetime:
+        return datetime.combine(self.date, self.lesson.end_time)
+
+
+# Returns a lesson's (start, end) in minutes from the start of the week,
+# or None if it is on a day outside the week
+def week_span(lesson) -> Optional[Tuple[int, int]]:
+    day = DAY_INDEX.get(lesson.day_of_week)
+    if day is None:
+        return None
+    base = day * MINUTES_PER_DAY
+    return (base + lesson.start_time.hour * 60 + lesson.start_time.minute,
+            base + lesson.end_time.hour * 60 + lesson.end_time.minute)
+
+# Merges date ranges into sorted ranges that neither overlap nor touch
+def _merge(ranges: Iterable[Tuple[date, date]]) -> List[Tuple[date, date]]:
+    merged: List[Tuple[date, date]] = []
+    for start, end in sorted(ranges):
+        if merged and start <= merged[-1][1] + ONE_DAY:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+        else:
+            merged.append((start, end))
+    return merged
+
+def _check_range(name: str, start: date, end: date):
+    if end < start:
+        raise ValueError(f"{name} ends before it starts")
+
+
+# Terms, holidays and one-off lesson exceptions
+# version changes on every change to the calendar, so occurrences can be
+# cached until it does
+# Holidays are kept both as given and merged into closed ranges, so the
+# calendar holds more attributes than pylint's default
+class TermCalendar: # pylint: disable=too-many-instance-attributes
+    def __init__(self):
+        self._versions = Versions()
+        # Sorted by start; terms never overlap
+        self._terms: List[Term] = []
+        self._term_starts: List[date] = []
+        self._holidays: List[Holiday] = []
+        # Holiday dates as sorted, non-overlapping (start, end) ranges
+        self._closed: List[Tuple[date, date]] = []
+        self._closed_starts: List[date] = []
+        # (lesson id, date) -> changed fields, or None if cancelled
+        self._exceptions: Dict[Tuple[int, date], Optional[dict]] = {}
+        # date -> ids of the lessons changed on that date
+        self._changed_on: Dict[date, Set[int]] = {}
+
+    @property
+    def version(self) -> int:
+        return self._versions.get()
+
+    @property
+    def terms(self) -> List[Term]:
+        return list(self._terms)
+
+    @property
+    def holidays(self) -> List[Holiday]:
+        return list(self._holidays)
+
+    # Returns the exceptions as (lesson id, date, changes), changes being
+    # None for a cancellation, in date order
+    def exceptions(self) -> List[Tuple[int, date, Optional[dict]]]:
+        return sorted(
+            ((lesson_id, day, changes)
+             for (lesson_id, day), changes in self._exceptions.items()),
+            key=lambda item: (item[1], item[0])
+            )
+
+    # Adds a term, raises ValueError if it overlaps another
+    def add_term(self, term: Term):
+        _check_range(term.name, term.start, term.end)
+        for other in self._terms:
+            if term.start <= other.end and other.start <= term.end:
+                raise ValueError(f"{term.name} overlaps {other.name}")
+        index = bisect_left(self._term_starts, term.start)
+        self._terms.insert(index, term)
+        self._term_starts.insert(index, term.start)
+        self._touch()
+
+    # Adds a holiday; holidays may overlap each other
+    def add_holiday(self, holiday: Holiday):
+        _check_range(holiday.name, holiday.start, holiday.end)
+        self._holidays.append(holiday)
+        self._holidays.sort(key=lambda h: (h.start, h.end))
+        self._closed = _merge((h.start, h.end) for h in self._holidays)
+        self._closed_starts = [start for start, _ in self._closed]
+        self._touch()
+
+    # Cancels one occurrence of a lesson
+    def cancel(self, lesson_id: int, on: date):
+        self._set_exception(lesson_id, on, None)
+
+    # Changes fields of one occurrence of a lesson, e.g. its classroom
+    # Raises ValueError for a field that cannot be changed
+    def change(self, lesson_id: int, on: date, **changes):
+        unknown = set(changes) - set(EXCEPTION_FIELDS)
+        if unknown:
+            raise ValueError(
+                f"Cannot change {', '.join(sorted(unknown))} for one date"
+                )
+        if not changes:
+            raise ValueError("No changes given")
+        self._set_exception(lesson_id, on, dict(changes))
+
+    # Removes the exception for one occurrence of a lesson, if there is one
+    def restore(self, lesson_id: int, on: date):
+        self._exceptions.pop((lesson_id, on), None)
+        self._changed_on.get(on, set()).discard(lesson_id)
+        self._touch()
+
+    # Removes every term, holiday and exception
+    def clear(self):
+        self._terms.clear()
+        self._term_starts.clear()
+        self._holidays.clear()
+        self._closed.clear()
+        self._closed_starts.clear()
+        self._exceptions.clear()
+        self._changed_on.clear()
+        self._touch()
+
+    def _touch(self):
+        self._versions.touch()
+
+    # Returns the term a date falls in, or None
+    def term_for(self, day: date) -> Optional[Term]:
+        index = bisect_right(self._term_starts, day) - 1
+        if index >= 0 and day <= self._terms[index].end:
+            return self._terms[index]
+        return None
+
+    # Returns the end of the holiday a date falls in, or None
+    def _closed_until(self, day: date) -> Optional[date]:
+        index = bisect_right(self._closed_starts, day) - 1
+        if index >= 0 and day <= self._closed[index][1]:
+            return self._closed[index][1]
+        return None
+
+    def is_holiday(self, day: date) -> bool:
+        return self._closed_until(day) is not None
+
+    # True if lessons happen on a date: it is in a term and not a holiday
+    def is_school_day(self, day: date) -> bool:
+        return self.term_for(day) is not None and not self.is_holiday(day)
+
+    # Yields the school days from start to end inclusive
+    # Gaps between terms and holidays are jumped over, not walked
+    def school_days(self, start: date, end: date) -> Iterator[date]:
+        first = max(0, bisect_right(self._term_starts, start) - 1)
+        for term in self._terms[first:]:
+            if term.start > end:
+                return
+            day = max(start, term.start)
+            last = min(end, term.end)
+            while day <= last:
+                closed_until = self._closed_until(day)
+                if closed_until is not None:
+                    day = closed_until + ONE_DAY
+                    continue
+                yield day
+                day += ONE_DAY
+
+    # Returns the ids of the lessons changed, not cancelled, on a date
+    def changed_on(self, day: date) -> Set[int]:
+        return self._changed_on.get(day, set())
+
+    # Returns a lesson as it happens on a date, None if it is cancelled
+    # Does not check the date is a school day
+    def apply(self, lesson: Lesson, day: date) -> Optional[Lesson]:
+        key = (lesson.id, day)
+        if key not in self._exceptions:
+            return lesson
+        changes = self._exceptions[key]
+        if changes is None:
+            return None
+        return lesson.copy(update=changes)
+
+    # Yields the occurrences of weekly lessons from start to end inclusive,
+    # in date and start time order
+    def occurrences(self, lessons: Iterable[Lesson], start: date,
+                    end: date) -> Iterator[Occurrence]:
+        by_weekday: Dict[int, List[Lesson]] = {}
+        for lesson in lessons:
+            weekday = DAY_INDEX.get(lesson.day_of_week)
+            if weekday is not None:
+                by_weekday.setdefault(weekday, []).append(lesson)
+        for weekday_lessons in by_weekday.values():
+            weekday_lessons.sort(key=lambda lesson: lesson.start_time)
+
+        for day in self.school_days(start, end):
+            found = []
+            for lesson in by_weekday.get(day.weekday(), ()):
+                actual = self.apply(lesson, day)
+                if actual is not None:
+                    found.append(Occurrence(actual, day))
+            if day in self._changed_on:
+                found.sort(key=lambda occurrence: occurrence.start)
+            yield from found
+
+    def _set_exception(self, lesson_id: int, on: date,
+                       changes: Optional[dict]):
+        self.restore(lesson_id, on)
+        self._exceptions[(lesson_id, on)] = changes
+        if changes is not None:
+            self._changed_on.setdefault(on, set()).add(lesson_id)
+        self._touch()
+
+
+# Each resource's weekly lesson times, sorted for range queries
+# Must be updated with add and remove whenever a lesson is written
+class IntervalIndex:
+    def __init__(self):
+        # (kind, key) -> sorted (start minute of week, end minute, lesson id)
+        self._intervals: Dict[Tuple[str, Hashable],
+                              List[Tuple[int, int, int]]] = {}
+        # (kind, key) -> longest lesson ever indexed there, in minutes; a
+        # query only has to look back this far for lessons still running
+        self._longest: Dict[Tuple[str, Hashable], int] = {}
+        self._lessons: Dict[int, Lesson] = {}
+
+    def add(self, lesson: Lesson):
+        self._lessons[lesson.id] = lesson
+        span = week_span(lesson)
+        if span is None:
+            return
+        entry = span + (lesson.id,)
+        for resource in lesson_resources(lesson):
+            insort(self._intervals.setdefault(resource, []), entry)
+            self._longest[resource] = max(
+                self._longest.get(resource, 0), span[1] - span[0]
+                )
+
+    def remove(self, lesson: Lesson):
+        self._lessons.pop(lesson.id, None)
+        span = week_span(lesson)
+        if span is None:
+            return
+        entry = span + (lesson.id,)
+        for resource in lesson_resources(lesson):
+            intervals = self._intervals.get(resource, [])
+            index = bisect_left(intervals, entry)
+            if index < len(intervals) and intervals[index] == entry:
+                del intervals[index]
+
+    def clear(self):
+        self._intervals.clear()
+        self._longest.clear()
+        self._lessons.clear()
+
+    # Yields a resource's lessons that overlap the minutes of the week
+    # from start up to end
+    def overlapping(self, kind: str, key: Hashable, start: int,
+                    end: int) -> Iterator[Lesson]:
+        resource = (kind, key)
+        intervals = self._intervals.get(resource, [])
+        index = bisect_left(intervals,
+                            (start - self._longest.get(resource, 0),))
+        while index < len(intervals) and intervals[index][0] < end:
+            _, lesson_end, lesson_id = intervals[index]
+            if lesson_end > start:
+                yield self._lessons[lesson_id]
+            index += 1
+
+    # Yields a resource's lesson occurrences that overlap start to end,
+    # in date and start time order, after the calendar's exceptions
+    # Lessons changed onto or away from the resource for one date are
+    # taken into account
+    def occurrences(self, calendar: TermCalendar, kind: str, key: Hashable,
+                    start: datetime, end: datetime) -> Iterator[Occurrence]:
+        resource = (kind, key)
+        for day in calendar.school_days(start.date(), end.date()):
+            day_start = datetime.combine(day, time())
+            window_start = max(start, day_start)
+            window_end = min(end, day_start + ONE_DAY)
+            found = []
+            for lesson in self._candidates(
+                    calendar, resource, day, window_start, window_end):
+                actual = calendar.apply(lesson, day)
+                if actual is None or resource not in lesson_resources(actual):
+                    continue
+                occurrence = Occurrence(actual, day)
+                if (occurrence.start < window_end and
+                        occurrence.end > window_start):
+                    found.append(occurrence)
+            found.sort(key=lambda occurrence: (occurrence.start,
+                                               occurrence.lesson.id))
+            yield from found
+
+    # Returns the resources ("teacher", "classroom" or "year_group") a
+    # lesson would share with another lesson if it ran on day as given,
+    # after the calendar's exceptions, e.g. before a one-off change is made
+    def clashes(self, calendar: TermCalendar, lesson: Lesson,
+                day: date) -> List[str]:
+        start = datetime.combine(day, lesson.start_time)
+        end = datetime.combine(day, lesson.end_time)
+        return [
+            kind for kind, key in lesson_resources(lesson)
+            if any(occurrence.lesson.id != lesson.id
+                   for occurrence in self.occurrences(
+                       calendar, kind, key, start, end
+                       ))
+            ]
+
+    # Returns the lessons that may run for a resource on day within the
+    # window: those indexed there at that time and those changed on day
+    def _candidates(self, calendar: TermCalendar,
+                    resource: Tuple[str, Hashable], day: date,
+                    window_start: datetime,
+                    window_end: datetime) -> Iterable[Lesson]:
+        day_start = datetime.combine(day, time())
+        base = day.weekday() * MINUTES_PER_DAY
+        candidates = {
+            lesson.id: lesson for lesson in self.overlapping(
+                resource[0], resource[1],
+                base + _minutes(window_start - day_start),
+                base + _minutes(window_end - day_start)
+                )
+            }
+        for lesson_id in calendar.changed_on(day):
+            lesson = self._lessons.get(lesson_id)
+            if (lesson is not None and
+                    lesson.day_of_week == DAY_NAMES[day.weekday()]):
+                candidates[lesson_id] = lesson
+        return candidates.values()
+
+
+def _minutes(delta: timedelta) -> int:
+    return delta.days * MINUTES_PER_DAY + delta.seconds // 60
@@ -0,0 +1,307 @@
+# In-memory timetable store for the LMS application
+# Besides looking timetables up by id and user, it keeps a reverse index
+# from a lesson's audience to the timetables that show it: a teacher's
+# timetables show their lessons, a student's show their year group's
+# lessons and an admin's show every lesson
+# A lesson write then only touches the timetables that contain the lesson,
+# instead of every timetable in the school
+
+# The admin view filters timetables by the teachers and year groups of the
+# lessons they contain and by their owner's role; counts of each teacher's
+# and year group's lessons per timetable are kept up to date by the lesson
+# writes, so those filters are index lookups rather than lesson scans
+
+# Every timetable also has a version that changes whenever its lessons do,
+# so anything derived from a timetable can be cached until it changes; the
+# timetable page's lessons grouped by day are cached here that way
+
+# Standard library imports
+import heapq
+from bisect import bisect_right, insort
+from itertools import islice
+from typing import Dict, Hashable, Iterator, List, Optional, Tuple
+
+# Local imports
+from conflicts import DAY_INDEX
+from models import Lesson, Timetable
+from versions import Versions
+
+# Days the timetable page always shows, even when they have no lessons
+WEEKDAYS = ("Monday", "Tuesday", "Wednesday", "Thursday", "Friday")
+
+
+# Stores timetables and the audience index used to fan out lesson writes
+# The audience, role and lesson count indexes, the paging ids, versions and
+# the grouped lessons cache all live here, well over the lint limit
+class TimetableStore: # pylint: disable=too-many-instance-attributes
+    def __init__(self):
+        self._by_id: Dict[int, Timetable] = {}
+        # user id -> that user's timetables, keyed by timetable id
+        self._by_user: Dict[int, Dict[int, Timetable]] = {}
+        # Audience index: who each timetable subscribes to
+        self._by_teacher: Dict[str, Dict[int, Timetable]] = {}
+        self._by_year_group: Dict[int, Dict[int, Timetable]] = {}
+        self._admin: Dict[int, Timetable] = {}
+        # Owner role -> timetables, for the admin view
+        self._by_role: Dict[str, Dict[int, Timetable]] = {}
+        # Lesson counts per timetable: teacher or year group -> timetable id
+        # -> how many of its lessons are theirs
+        self._teacher_lessons: Dict[str, Dict[int, int]] = {}
+        self._year_group_lessons: Dict[int, Dict[int, int]] = {}
+        # Timetable ids in order, for paging
+        self._ids: List[int] = []
+        # Versions of each timetable and of the store as a whole
+        self._versions = Versions()
+        # timetable id -> (version, lessons grouped by day) at that version
+        self._by_day: Dict[int, Tuple[int, Dict[str, List[Lesson]]]] = {}
+        # Highest id ever handed out, so ids are never reused
+        self._last_id = 0
+
+    def __len__(self) -> int:
+        return len(self._by_id)
+
+    def __iter__(self) -> Iterator[Timetable]:
+        return iter(list(self._by_id.values()))
+
+    # Returns a new timetable id that has never been used by this store
+    def next_id(self) -> int:
+        self._last_id += 1
+        return self._last_id
+
+    # Adds a timetable for a user and subscribes it to the user's lessons
+    # user may be None for a timetable whose owner is unknown, which is
+    # stored but never receives lessons
+    def add(self, timetable: Timetable, user=None) -> Timetable:
+        if timetable.id in self._by_id:
+            raise ValueError(f"Timetable id already in use: {timetable.id}")
+        self._by_id[timetable.id] = timetable
+        user_timetables = self._by_user.setdefault(timetable.user_id, {})
+        user_timetables[timetable.id] = timetable
+        insort(self._ids, timetable.id)
+        for lesson in timetable.lessons:
+            self._count(timetable.id, lesson, 1)
+        if user is not None:
+            self._by_role.setdefault(user.role, {})[timetable.id] = timetable
+            if user.role == "admin":
+                self._admin[timetable.id] = timetable
+            elif user.role == "teacher":
+                self._by_teacher.setdefault(
+                    user.username, {}
+                    )[timetable.id] = timetable
+            elif user.year_group is not None:
+                self._by_year_group.setdefault(
+                    user.year_group, {}
+                    )[timetable.id] = timetable
+        self._touch(timetable.id)
+        self._last_id = max(self._last_id, timetable.id)
+        return timetable
+
+    # Retrieves a timetable by id, returns None if not found
+    def get(self, timetable_id: int) -> Optional[Timetable]:
+        return self._by_id.get(timetable_id)
+
+    # Returns a user's timetables, oldest first
+    def for_user(self, user_id: int) -> List[Timetable]:
+        return list(self._by_user.get(user_id, {}).values())
+
+    # Returns the current version of a timetable, 0 if there is none, or of
+    # the whole store if no timetable id is given
+    def version(self, timetable_id: Optional[int] = None) -> int:
+        return self._versions.get(timetable_id)
+
+    # Returns a timetable's lessons grouped by day, in week order and by
+    # start time within each day, for the timetable page
+    # The grouping is rebuilt only when the timetable's version has moved
+    # on, so the result is shared and must not be modified
+    def lessons_by_day(self, timetable_id: int) -> Dict[str, List[Lesson]]:
+        version = self.version(timetable_id)
+        cached = self._by_day.get(timetable_id)
+        if cached is not None and cached[0] == version:
+            return cached[1]
+        grouped = group_by_day(self._by_id[timetable_id].lessons)
+        self._by_day[timetable_id] = (version, grouped)
+        return grouped
+
+    # Returns the teachers with lessons in any timetable, sorted
+    def teachers(self) -> List[str]:
+        return sorted(self._teacher_lessons)
+
+    # Returns the year groups with lessons in any timetable, sorted
+    def year_groups(self) -> List[int]:
+        return sorted(self._year_group_lessons)
+
+    # Returns up to limit timetables in id order, after the timetable id
+    # after if given, and the id to pass as after for the next page (None
+    # on the last page)
+    # Filters: teacher and year_group keep timetables holding any of their
+    # lessons, role keeps timetables whose owner has that role and user_id
+    # keeps one user's timetables
+    def page(self, after: Optional[int] = None, limit: int = 20,
+             **filters) -> Tuple[List[Timetable], Optional[int]]:
+        ids = list(islice(self._matching_ids(after, limit + 1, filters),
+                          limit + 1))
+        timetables = [
+            self._by_id[timetable_id] for timetable_id in ids[:limit]
+            if timetable_id in self._by_id
+            ]
+        next_after = ids[limit - 1] if len(ids) > limit else None
+        return timetables, next_after
+
+    # Yields the timetables matching the page filters, in id order
+    # Exports run this in a worker thread alongside writes, so a timetable
+    # removed after its id was read is skipped
+    def matching(self, **filters) -> Iterator[Timetable]:
+        for timetable_id in self._matching_ids(None, None, filters):
+            timetable = self._by_id.get(timetable_id)
+            if timetable is not None:
+                yield timetable
+
+    # Yields matching timetable ids after after, in order
+    # Unfiltered ids are read off the sorted id list one at a time, each
+    # step bisecting from the last id, so ids added or removed meanwhile
+    # are neither repeated nor skipped; filtered ones come from a snapshot
+    # of the smallest matching index, checked against the others
+    def _matching_ids(self, after: Optional[int], limit: Optional[int],
+                      filters: Dict[str, Hashable]) -> Iterator[int]:
+        indexes = {
+            "teacher": self._teacher_lessons,
+            "year_group": self._year_group_lessons,
+            "role": self._by_role,
+            "user_id": self._by_user
+            }
+        unknown = set(filters) - set(indexes)
+        if unknown:
+            raise ValueError(f"Unknown filters: {', '.join(sorted(unknown))}")
+        sets = [
+            indexes[name].get(value, {})
+            for name, value in filters.items() if value is not None
+            ]
+        if not sets:
+            while True:
+                start = 0 if after is None else bisect_right(self._ids, after)
+                following = self._ids[start:start + 1]
+                if not following:
+                    return
+                after = following[0]
+                yield after
+        sets.sort(key=len)
+        smallest, rest = list(sets[0]), sets[1:]
+        found = (
+            timetable_id for timetable_id in smallest
+            if (after is None or timetable_id > after)
+            and all(timetable_id in other for other in rest)
+            )
+        if limit is None:
+            yield from sorted(found)
+        else:
+            yield from heapq.nsmallest(limit, found)
+
+    # Returns (timetable id, version) for each of a user's timetables
+    # Changes whenever any of the user's timetables or their lessons change
+    def user_versions(self, user_id: int) -> Tuple[Tuple[int, int], ...]:
+        return tuple(
+            (timetable_id, self._versions.get(timetable_id))
+            for timetable_id in self._by_user.get(user_id, {})
+            )
+
+    # Returns the timetables that show a lesson
+    def subscribers(self, lesson: Lesson) -> Dict[int, Timetable]:
+        timetables = dict(self._by_teacher.get(lesson.teacher, {}))
+        timetables.update(self._by_year_group.get(lesson.year_group, {}))
+        timetables.update(self._admin)
+        return timetables
+
+    # Adds a new lesson to the timetables that show it
+    def add_lesson(self, lesson: Lesson):
+        for timetable in self.subscribers(lesson).values():
+            timetable.lessons.append(lesson)
+            self._count(timetable.id, lesson, 1)
+            self._touch(timetable.id)
+
+    # Updates the timetables for an edited lesson
+    # If its teacher or year group changed, the lesson moves between
+    # timetables; otherwise it is replaced where it is
+    def replace_lesson(self, previous: Lesson, lesson: Lesson):
+        before = self.subscribers(previous)
+        after = self.subscribers(lesson)
+        for timetable_id, timetable in before.items():
+            self._count(timetable_id, previous, -1)
+            if timetable_id in after:
+                _replace(timetable, lesson)
+                self._count(timetable_id, lesson, 1)
+            else:
+                _remove(timetable, lesson.id)
+            self._touch(timetable_id)
+        for timetable_id, timetable in after.items():
+            if timetable_id not in before:
+                timetable.lessons.append(lesson)
+                self._count(timetable_id, lesson, 1)
+                self._touch(timetable_id)
+
+    # Removes a deleted lesson from the timetables that show it
+    def remove_lesson(self, lesson: Lesson):
+        for timetable in self.subscribers(lesson).values():
+            _remove(timetable, lesson.id)
+            self._count(timetable.id, lesson, -1)
+            self._touch(timetable.id)
+
+    # Removes every timetable, ids keep counting from where they were
+    def clear(self):
+        self._by_id.clear()
+        self._by_user.clear()
+        self._by_teacher.clear()
+        self._by_year_group.clear()
+        self._admin.clear()
+        self._by_role.clear()
+        self._teacher_lessons.clear()
+        self._year_group_lessons.clear()
+        self._ids.clear()
+        self._by_day.clear()
+        self._versions.reset()
+
+    # Adjusts a timetable's lesson counts for its lesson's teacher and
+    # year group, dropping counts that reach zero
+    def _count(self, timetable_id: int, lesson: Lesson, step: int):
+        for index, key in ((self._teacher_lessons, lesson.teacher),
+                           (self._year_group_lessons, lesson.year_group)):
+            counts = index.setdefault(key, {})
+            total = counts.get(timetable_id, 0) + step
+            if total > 0:
+                counts[timetable_id] = total
+            else:
+                counts.pop(timetable_id, None)
+                if not counts:
+                    del index[key]
+
+    # Gives a timetable a new version
+    def _touch(self, timetable_id: int):
+        self._versions.touch(timetable_id)
+
+
+# Groups lessons by day, sorted by start time
+# Weekdays are always present; weekend days and any unknown day only
+# appear when they have lessons, after the days of the week
+def group_by_day(lessons: List[Lesson]) -> Dict[str, List[Lesson]]:
+    ordered = sorted(lessons, key=lambda lesson: (
+        DAY_INDEX.get(lesson.day_of_week, len(DAY_INDEX)),
+        lesson.day_of_week, lesson.start_time
+        ))
+    grouped: Dict[str, List[Lesson]] = {day: [] for day in WEEKDAYS}
+    for lesson in ordered:
+        grouped.setdefault(lesson.day_of_week, []).append(lesson)
+    return grouped
+
+# Replaces a lesson in a timetable's lessons with its new version
+def _replace(timetable: Timetable, lesson: Lesson):
+    for i, timetable_lesson in enumerate(timetable.lessons):
+        if timetable_lesson.id == lesson.id:
+            timetable.lessons[i] = lesson
+            return
+    timetable.lessons.append(lesson)
+
+# Removes a lesson from a timetable's lessons
+def _remove(timetable: Timetable, lesson_id: int):
+    for i, timetable_lesson in enumerate(timetable.lessons):
+        if timetable_lesson.id == lesson_id:
+            del timetable.lessons[i]
+            return
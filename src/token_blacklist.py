@@ -1,19 +1,71 @@
 # In-memory storage for blacklisted tokens
 
-# A set to store blacklisted tokens
-# Using a set for O(1) lookup time when checking if a token is blacklisted
+# Standard library imports
+import hashlib
+import heapq
+import time
+from typing import Dict, List, Optional, Tuple
+
+# Third-party imports for verifying the token and reading its expiry
+from jose import jwt, JWTError
+
+# Local imports
+from auth import ACCESS_TOKEN_EXPIRE_MINUTES, ALGORITHM, SECRET_KEY
+
+# A dict mapping a compact token id to the token's expiry timestamp
+# Using a dict for O(1) lookup time when checking if a token is blacklisted
 # In a production environment, replace with a database
-blacklisted_tokens = set()
+blacklisted_tokens: Dict[str, float] = {}
+
+# A min-heap of (expiry, token id) pairs
+# Entries are evicted in expiry order, since an expired token is rejected
+# by the JWT check anyway, so memory is bounded by the live revoked tokens
+expiry_heap: List[Tuple[float, str]] = []
+
+# Returns the compact id a token is stored under
+# A 128-bit digest of the token string, so full JWTs are never kept
+def token_id(token: str) -> str:
+    return hashlib.blake2b(token.encode(), digest_size=16).hexdigest()
+
+# Removes blacklist entries whose tokens have expired
+def purge_expired(now: Optional[float] = None):
+    now = time.time() if now is None else now
+    while expiry_heap and expiry_heap[0][0] <= now:
+        expires_at, tid = heapq.heappop(expiry_heap)
+        # The token may have been blacklisted again with a later expiry
+        if blacklisted_tokens.get(tid) == expires_at:
+            del blacklisted_tokens[tid]
 
 # Adds a token to blacklist
 # Args: token (str): The JWT token to be blacklisted
+#       expires_at (float): Unix time the token expires, read from the
+#       token's verified exp claim if not given
+# Returns: bool: False if the token was invalid or expired and so not added
 # Called when a user logs out or when a token needs to be invalidated
-def add_to_blacklist(token: str):
-    blacklisted_tokens.add(token)
+# No entry outlives the longest a token can be valid for, so a forged exp
+# claim cannot keep an entry around
+def add_to_blacklist(token: str, expires_at: Optional[float] = None) -> bool:
+    now = time.time()
+    if expires_at is None:
+        try:
+            payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
+            expires_at = float(payload["exp"])
+        except (JWTError, KeyError, TypeError, ValueError):
+            # The JWT check rejects the token anyway
+            return False
+    expires_at = min(expires_at, now + ACCESS_TOKEN_EXPIRE_MINUTES * 60)
+    purge_expired(now)
+    tid = token_id(token)
+    blacklisted_tokens[tid] = expires_at
+    heapq.heappush(expiry_heap, (expires_at, tid))
+    return True
 
 # Checks if a given token is blacklisted
 # Args: token (str): The JWT token to check
 # Returns: bool: True if the token is blacklisted, False otherwise
 # Called before processing a request to ensure the token is still valid
-def is_blacklisted(token: str) -> bool:
-    return token in blacklisted_tokens
+def is_blacklisted(token: str, now: Optional[float] = None) -> bool:
+    now = time.time() if now is None else now
+    purge_expired(now)
+    expires_at = blacklisted_tokens.get(token_id(token))
+    return expires_at is not None and expires_at > now
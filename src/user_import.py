@@ -0,0 +1,118 @@
+# Streaming bulk import of user accounts for the LMS application
+# Reads a CSV or NDJSON upload one row at a time, so an upload with
+# thousands of accounts is never held in memory as a whole
+
+# Standard library imports
+import csv
+import json
+from itertools import islice
+from typing import Container, Iterable, Iterator, List, Optional, Tuple
+
+# Third-party imports for data validation
+from pydantic import ValidationError
+
+# Local imports
+from models import RegisterModel
+
+# Number of rows validated, hashed and inserted together
+IMPORT_BATCH_SIZE = 500
+
+# Upload formats and the file extensions that imply them
+IMPORT_FORMATS = {".csv": "csv", ".ndjson": "ndjson", ".jsonl": "ndjson"}
+
+# A parsed upload row: (row number, row data, error message)
+# Exactly one of row data and error message is set
+ImportRow = Tuple[int, Optional[dict], Optional[str]]
+
+# Works out the upload format from an explicit format or the file name
+# Returns None if the format cannot be determined
+def detect_format(filename: str, requested: Optional[str] = None):
+    if requested:
+        requested = requested.lower()
+        return requested if requested in ("csv", "ndjson") else None
+    for extension, fmt in IMPORT_FORMATS.items():
+        if (filename or "").lower().endswith(extension):
+            return fmt
+    return None
+
+# Yields the rows of a CSV upload, numbered by line in the file
+# The first line must be a header naming the RegisterModel fields
+def iter_csv_rows(stream: Iterable[str]) -> Iterator[ImportRow]:
+    reader = csv.DictReader(stream)
+    for row in reader:
+        # Empty cells are treated as missing, e.g. no year group for staff
+        yield reader.line_num, {
+            key: value for key, value in row.items()
+            if key is not None and value not in ("", None)
+            }, None
+
+# Yields the rows of an NDJSON upload, one JSON object per line
+def iter_ndjson_rows(stream: Iterable[str]) -> Iterator[ImportRow]:
+    for line_number, line in enumerate(stream, 1):
+        if not line.strip():
+            continue
+        try:
+            data = json.loads(line)
+        except ValueError:
+            yield line_number, None, "Invalid JSON"
+            continue
+        if not isinstance(data, dict):
+            yield line_number, None, "Each line must be a JSON object"
+            continue
+        yield line_number, data, None
+
+# Yields the rows of an upload in the given format
+def iter_rows(stream: Iterable[str], fmt: str) -> Iterator[ImportRow]:
+    if fmt == "csv":
+        return iter_csv_rows(stream)
+    return iter_ndjson_rows(stream)
+
+# Groups rows into lists of at most size rows
+def iter_batches(rows: Iterator[ImportRow], size: int = IMPORT_BATCH_SIZE
+                 ) -> Iterator[List[ImportRow]]:
+    while True:
+        batch = list(islice(rows, size))
+        if not batch:
+            return
+        yield batch
+
+# Validates a row with the same rules as the registration form
+# Returns the RegisterModel, raises ValueError with a message otherwise
+def validate_row(data: dict) -> RegisterModel:
+    try:
+        register_data = RegisterModel(**data)
+    except ValidationError as exc:
+        raise ValueError("; ".join(
+            f"{'.'.join(str(part) for part in error['loc'])}: {error['msg']}"
+            for error in exc.errors()
+            )) from exc
+    if register_data.role not in ["admin", "teacher", "student"]:
+        raise ValueError("Invalid role")
+    if register_data.role == "student" and not register_data.year_group:
+        raise ValueError("Year group is required for students")
+    return register_data
+
+# Validates a batch of rows, rejecting usernames already in existing or
+# taken by an earlier row of the batch
+# Returns the (row number, RegisterModel) of each valid row and an error
+# for each rejected one
+def validate_batch(batch: List[ImportRow], existing: Container[str]
+                   ) -> Tuple[List[Tuple[int, RegisterModel]], List[dict]]:
+    valid_rows = []
+    errors = []
+    batch_usernames = set()
+    for row_number, data, error in batch:
+        if error is None:
+            try:
+                register_data = validate_row(data)
+                if (register_data.username in existing or
+                    register_data.username in batch_usernames):
+                    raise ValueError("Username already registered")
+            except ValueError as exc:
+                error = str(exc)
+        if error is not None:
+            errors.append({"row": row_number, "error": error})
+            continue
+        batch_usernames.add(register_data.username)
+        valid_rows.append((row_number, register_data))
+    return valid_rows, errors
@@ -0,0 +1,111 @@
+# In-memory user repository for the LMS application
+# Keeps hash indexes over the stored users so that lookups by username, id
+# or email are O(1) instead of a scan over every account
+
+# Standard library imports
+from typing import Dict, Iterator, List
+
+
+# Stores users and maintains the indexes used for lookups
+# A single instance is created in the auth module and shared with main
+class UserRepository:
+    def __init__(self):
+        self._by_id: Dict[int, object] = {}
+        self._by_username: Dict[str, object] = {}
+        # Emails are not required to be unique, so each email maps to the
+        # users registered with it, keyed by id in registration order
+        self._by_email: Dict[str, Dict[int, object]] = {}
+        # Highest id ever handed out, so ids are never reused after a delete
+        self._last_id = 0
+        # Changes on every write, so responses built from users can be
+        # cached until it does
+        self.version = 0
+
+    def __len__(self) -> int:
+        return len(self._by_id)
+
+    def __iter__(self) -> Iterator:
+        return iter(list(self._by_id.values()))
+
+    def __contains__(self, username: str) -> bool:
+        return username in self._by_username
+
+    # Returns a new user id that has never been used by this repository
+    def next_id(self) -> int:
+        self._last_id += 1
+        return self._last_id
+
+    # Adds a user to the repository and indexes it
+    # Raises ValueError if the username or id is already taken
+    def add(self, user):
+        if user.username in self._by_username:
+            raise ValueError(f"Username already registered: {user.username}")
+        if user.id in self._by_id:
+            raise ValueError(f"User id already in use: {user.id}")
+        self._index(user)
+        self._last_id = max(self._last_id, user.id)
+        return user
+
+    # Replaces a stored user with a new version of the same user (same id)
+    # Re-indexes the username and email if they have changed
+    def update(self, user):
+        existing = self._by_id.get(user.id)
+        if existing is None:
+            raise KeyError(user.id)
+        if (user.username != existing.username and
+            user.username in self._by_username):
+            raise ValueError(f"Username already registered: {user.username}")
+        self._unindex(existing)
+        self._index(user)
+        return user
+
+    # Removes a user by id
+    # Returns the removed user, or None if there was no such user
+    def delete(self, user_id: int):
+        user = self._by_id.get(user_id)
+        if user is not None:
+            self._unindex(user)
+        return user
+
+    # Retrieves a user by username, returns None if not found
+    def get_by_username(self, username: str):
+        return self._by_username.get(username)
+
+    # Retrieves a user by id, returns None if not found
+    def get_by_id(self, user_id: int):
+        return self._by_id.get(user_id)
+
+    # Retrieves the first user registered with an email address
+    # Returns None if not found
+    def get_by_email(self, email: str):
+        users = self._by_email.get(email.lower())
+        if not users:
+            return None
+        return next(iter(users.values()))
+
+    # Returns every user with the given role
+    def with_role(self, role: str) -> List:
+        return [user for user in self._by_id.values() if user.role == role]
+
+    # Removes every user, ids keep counting from where they were
+    def clear(self):
+        self._by_id.clear()
+        self._by_username.clear()
+        self._by_email.clear()
+        self.version += 1
+
+    def _index(self, user):
+        self.version += 1
+        self._by_id[user.id] = user
+        self._by_username[user.username] = user
+        self._by_email.setdefault(user.email.lower(), {})[user.id] = user
+
+    def _unindex(self, user):
+        self.version += 1
+        del self._by_id[user.id]
+        del self._by_username[user.username]
+        email_key = user.email.lower()
+        users = self._by_email.get(email_key, {})
+        users.pop(user.id, None)
+        if not users:
+            self._by_email.pop(email_key, None)
@@ -0,0 +1,39 @@
+# Version counters for the in-memory stores
+# Every change to a store, or to one item in it, takes the next number
+# from a counter shared by the whole store, so a version is never repeated,
+# even after the store is cleared; ETags and caches built from versions
+# can never mistake new data for old
+
+# Standard library imports
+from itertools import count
+from typing import Dict, Hashable, Optional
+
+
+# Versions of a store and of the items in it
+class Versions:
+    def __init__(self):
+        self._clock = count(1)
+        # item -> version, and the version of the whole store, the latest
+        # given to anything
+        self._items: Dict[Hashable, int] = {}
+        self.current = 0
+
+    # Returns the version of an item, 0 if it never changed, or of the
+    # whole store if no item is given
+    def get(self, item: Optional[Hashable] = None) -> int:
+        if item is None:
+            return self.current
+        return self._items.get(item, 0)
+
+    # Gives an item, and so the store, a new version; with no item only the
+    # store gets one
+    def touch(self, item: Optional[Hashable] = None):
+        self.current = next(self._clock)
+        if item is not None:
+            self._items[item] = self.current
+
+    # Forgets every item's version and gives the store a new one, for when
+    # the store is cleared
+    def reset(self):
+        self._items.clear()
+        self.touch()
@@ -12,9 +12,12 @@ from fastapi.encoders import jsonable_encoder
 from fastapi.testclient import TestClient
 
 # Local imports
-from main import app, create_access_token, get_password_hash # type: ignore
+from main import app, create_access_token # type: ignore
 from auth import verify_password, decode_access_token # type: ignore
+from auth import get_password_hash # type: ignore
 from models import form_body # type: ignore
+from user_repository import UserRepository # type: ignore
+from auth import UserInDB # type: ignore
 
 # Python testing framework for running the tests
 import pytest
@@ -220,14 +223,15 @@ def test_create_lesson():
     access_token = login_response.cookies.get("access_token")
 
     # Create a lesson
+    # Year 12 has no seeded lessons, so the year group is free at this time
     lesson_data = {
         "subject": "Math",
         "teacher": "teacheruser",
-        "classroom": "Room 101",
+        "classroom": "Room 201",
         "day_of_week": "Monday",
         "start_time": "09:00",
         "end_time": "10:00",
-        "year_group": 9
+        "year_group": 12
     }
     response = client.post("/lessons/", json=lesson_data, cookies={"access_token": access_token})
     assert response.status_code == 200
@@ -242,7 +246,7 @@ def test_add_lesson_as_teacher():
         "classroom": "Lab 1",
         "day_of_week": "Tuesday",
         "start_time": "10:00",
-        "year_group": "10"
+        "year_group": "12"
     }, cookies={"access_token": teacher_token})
     assert response.status_code == 303
     assert response.headers["location"] == "/lessons/"
@@ -297,6 +301,25 @@ def test_view_timetable():
     assert "<th>Monday</th>" in response.text  # Check if days of the week are present
     assert "<td>09:00</td>" in response.text  # Check if time slots are present
 
+# Checks the admin timetable view can be filtered by role and username and
+# is split into pages
+def test_admin_timetables_filters_and_pages():
+    admin_token = test_admin_login_success()
+    response = client.get("/admin/timetables?username=adminuser",
+                          cookies={"access_token": admin_token})
+    assert response.status_code == 200
+    assert "Timetable for adminuser" in response.text
+    assert response.text.count("<h2>") == 1
+
+    response = client.get("/admin/timetables?role=teacher&limit=1",
+                          cookies={"access_token": admin_token})
+    assert response.text.count("<h2>") == 1
+    assert "Next Page" in response.text
+
+    response = client.get("/admin/timetables?username=nobody",
+                          cookies={"access_token": admin_token})
+    assert "No timetables match these filters." in response.text
+
 # Verifies admin can view all timetables
 def test_view_admin_timetables():
     admin_token = test_admin_login_success()
@@ -340,3 +363,1241 @@ def test_password_hashing():
     hashed_password = get_password_hash(password)
     assert verify_password(password, hashed_password)
     assert not verify_password("wrongpassword", hashed_password)
+
+# User repository tests
+# Checks users can be found by username, id and email
+def test_user_repository_lookups():
+    repo = UserRepository()
+    user = repo.add(UserInDB(
+        id=repo.next_id(),
+        username="repouser",
+        email="Repo@Example.com",
+        hashed_password="x"
+    ))
+    assert repo.get_by_username("repouser") is user
+    assert repo.get_by_id(user.id) is user
+    assert repo.get_by_email("repo@example.com") is user
+    assert "repouser" in repo
+    with pytest.raises(ValueError):
+        repo.add(user.copy(update={"id": repo.next_id()}))
+
+# Ensures ids are never handed out twice, even after a delete
+def test_user_repository_ids_not_reused():
+    repo = UserRepository()
+    first = repo.add(UserInDB(
+        id=repo.next_id(), username="a", email="a@example.com",
+        hashed_password="x"
+    ))
+    repo.delete(first.id)
+    assert repo.get_by_username("a") is None
+    assert repo.next_id() != first.id
+
+# Session cache tests
+# Checks repeat requests with the same token are served from the cache
+def test_session_cache_hits_repeat_requests():
+    from main import session_cache # type: ignore
+    token = get_student_token()
+    client.get("/protected", cookies={"access_token": token})
+    hits = session_cache.hits
+    response = client.get("/protected", cookies={"access_token": token})
+    assert response.status_code == 200
+    assert session_cache.hits == hits + 1
+
+# Ensures cached sessions expire and can be invalidated per user
+def test_session_cache_expiry_and_invalidation():
+    from session_cache import SessionCache # type: ignore
+    cache = SessionCache(max_size=2)
+    user = UserInDB(
+        id=1, username="cached", email="c@example.com", hashed_password="x"
+    )
+    cache.put("a", user, expires_at=100)
+    assert cache.get("a", now=50) is user
+    assert cache.get("a", now=150) is None
+    cache.put("b", user, expires_at=100)
+    cache.put("c", user, expires_at=100)
+    cache.put("d", user, expires_at=100)
+    assert len(cache) == 2
+    cache.invalidate_user("cached")
+    assert cache.get("d", now=50) is None
+
+# Password pool tests
+# Checks hashing and verification run on the pool
+def test_password_pool_hash_and_verify():
+    import asyncio
+    from password_pool import PasswordPool # type: ignore
+    pool = PasswordPool(kind="thread", workers=2, max_queue=0)
+
+    async def round_trip():
+        hashed = await pool.hash("poolpass")
+        return await pool.verify("poolpass", hashed)
+
+    assert asyncio.run(round_trip())
+    assert pool.stats()["completed"] == 2
+    pool.shutdown()
+
+# Ensures calls beyond the queue bound are rejected instead of piling up
+def test_password_pool_rejects_when_saturated():
+    import asyncio
+    from fastapi import HTTPException
+    from password_pool import PasswordPool # type: ignore
+    pool = PasswordPool(kind="thread", workers=1, max_queue=0)
+
+    async def flood():
+        return await asyncio.gather(
+            pool.hash("one"), pool.hash("two"), return_exceptions=True
+            )
+
+    results = asyncio.run(flood())
+    assert any(isinstance(r, HTTPException) and r.status_code == 503
+               for r in results)
+    assert pool.stats()["rejected"] == 1
+
+    # Batches are admitted the same way
+    async def batch_while_busy():
+        return await asyncio.gather(
+            pool.hash("three"), pool.hash_batch(["four"]),
+            return_exceptions=True
+            )
+
+    results = asyncio.run(batch_while_busy())
+    assert isinstance(results[1], HTTPException)
+    assert results[1].status_code == 503
+    assert pool.stats()["rejected"] == 2
+    pool.shutdown()
+
+# Ensures calls keep being served while the workers are restarted
+def test_password_pool_restart_during_calls():
+    import asyncio
+    from password_pool import PasswordPool # type: ignore
+    threads = PasswordPool(kind="thread", workers=1)
+    processes = PasswordPool(kind="process", workers=1)
+
+    async def hash_while_restarting(pool):
+        running = asyncio.ensure_future(pool.hash("restartpass"))
+        await asyncio.sleep(0)
+        executor = pool._executor # pylint: disable=protected-access
+        pool.restart()
+        after = await pool.hash("restartpass")
+        return await running, after, executor
+
+    first, after, executor = asyncio.run(hash_while_restarting(threads))
+    assert first and after
+    assert threads._executor is executor # pylint: disable=protected-access
+    first, after, executor = asyncio.run(hash_while_restarting(processes))
+    assert first and after
+    assert processes._executor is not executor # pylint: disable=protected-access
+    threads.shutdown()
+    processes.shutdown()
+
+# Token blacklist tests
+# Ensures a token can no longer be used after logging out
+def test_logged_out_token_is_rejected():
+    token = get_student_token()
+    assert client.get(
+        "/protected", cookies={"access_token": token}
+        ).status_code == 200
+    client.get("/logout", cookies={"access_token": token})
+    response = client.get("/protected", cookies={"access_token": token})
+    assert response.status_code == 401
+
+# Checks blacklist entries are evicted once the token has expired
+def test_blacklist_evicts_expired_tokens():
+    import token_blacklist # type: ignore
+    token_blacklist.add_to_blacklist("expiring-token", expires_at=100)
+    assert token_blacklist.is_blacklisted("expiring-token", now=50)
+    assert not token_blacklist.is_blacklisted("expiring-token", now=150)
+    assert (token_blacklist.token_id("expiring-token")
+            not in token_blacklist.blacklisted_tokens)
+
+# Checks only verified tokens are blacklisted, for no longer than a token
+# can be valid
+def test_blacklist_verifies_tokens():
+    import time
+    import token_blacklist # type: ignore
+    from auth import ( # type: ignore
+        ACCESS_TOKEN_EXPIRE_MINUTES, create_access_token
+        )
+    from jose import jwt
+    forged = jwt.encode({"sub": "studentuser", "exp": 2 ** 40}, "wrong-key",
+                        algorithm="HS256")
+    assert not token_blacklist.add_to_blacklist(forged)
+    assert not token_blacklist.add_to_blacklist("not-a-token")
+    assert (token_blacklist.token_id(forged)
+            not in token_blacklist.blacklisted_tokens)
+
+    token = create_access_token({"sub": "studentuser"})
+    assert token_blacklist.add_to_blacklist(token)
+    assert token_blacklist.is_blacklisted(token)
+    token_blacklist.add_to_blacklist("long-lived", expires_at=2 ** 40)
+    expires_at = token_blacklist.blacklisted_tokens[
+        token_blacklist.token_id("long-lived")
+        ]
+    assert expires_at <= time.time() + ACCESS_TOKEN_EXPIRE_MINUTES * 60
+
+# Seeding tests
+# Checks seed password hashes are persisted and reused across startups
+def test_seed_hash_cache_reuses_persisted_hashes(tmp_path):
+    from seeding import SeedHashCache # type: ignore
+    cache_path = str(tmp_path / "seed_hashes.json")
+    hashed = []
+
+    def hash_many(passwords):
+        hashed.extend(passwords)
+        return [get_password_hash(p) for p in passwords]
+
+    first = SeedHashCache(cache_path).get_many(["seedpass"], hash_many)
+    second = SeedHashCache(cache_path).get_many(["seedpass"], hash_many)
+    assert hashed == ["seedpass"]
+    assert first == second
+    assert verify_password("seedpass", second["seedpass"])
+
+# Login throttling tests
+# Ensures repeated failed logins for a username are rejected before hashing
+def test_login_throttled_after_repeated_failures():
+    client.post("/register", data={
+        "username": "throttleduser",
+        "password": "rightpass",
+        "email": "throttled@example.com",
+        "role": "student",
+        "year_group": "9"
+    })
+    for _ in range(5):
+        response = client.post("/login", data={
+            "username": "throttleduser",
+            "password": "wrongpass"
+        })
+        assert response.status_code == 401
+    response = client.post("/login", data={
+        "username": "throttleduser",
+        "password": "rightpass"
+    })
+    assert response.status_code == 429
+    assert "retry-after" in response.headers
+
+# Checks the sliding window limiter frees up as old attempts age out
+def test_sliding_window_limiter():
+    from login_throttle import SlidingWindowLimiter # type: ignore
+    limiter = SlidingWindowLimiter(limit=2, window_seconds=60)
+    for now in range(3):
+        limiter.hit("key", now=now)
+    assert limiter.retry_after("key", now=3) > 0
+    assert limiter.retry_after("key", now=70) > 0 # most of the old window
+    assert limiter.retry_after("key", now=100) == 0
+    limiter.compact(now=500)
+    assert len(limiter) == 0
+
+# Checks a full limiter never drops a key that has attempts, and turns new
+# keys away until room frees up
+def test_sliding_window_limiter_fails_closed_when_full():
+    import time
+    from login_throttle import SlidingWindowLimiter # type: ignore
+    limiter = SlidingWindowLimiter(limit=2, window_seconds=60, max_keys=2)
+    start = (time.time() // 60 + 1) * 60
+    assert limiter.hit("attacked", now=start)
+    assert limiter.hit("other", now=start)
+    assert not limiter.hit("new", now=start + 1)
+    assert limiter.retry_after("new", now=start + 2) > 0
+    assert limiter.hit("attacked", now=start + 3)
+    assert limiter.retry_after("attacked", now=start + 3) > 0
+    # A key whose attempts were all taken back makes room
+    limiter.release("other", now=start + 4)
+    assert limiter.hit("new", now=start + 5)
+    assert limiter.retry_after("attacked", now=start + 5) > 0
+    # As do keys whose attempts have aged out
+    assert limiter.hit("later", now=start + 200)
+
+# Checks attempts count before their passwords are checked, and that only
+# failures count against the IP
+def test_login_throttle_reserves_attempts():
+    from login_throttle import LoginThrottle # type: ignore
+    throttle = LoginThrottle(username_limit=2, ip_limit=2,
+                             window_seconds=60)
+    # Two guesses still being checked hold back a third
+    assert throttle.begin("guessed", "10.0.0.1") == 0
+    assert throttle.begin("guessed", "10.0.0.2") == 0
+    assert throttle.begin("guessed", "10.0.0.3") > 0
+    throttle.cancel("guessed", "10.0.0.2")
+    assert throttle.begin("guessed", "10.0.0.3") == 0
+    # Any number of successful logins can share an address
+    for username in ("pupil1", "pupil2", "pupil3"):
+        assert throttle.begin(username, "10.0.0.9") == 0
+        throttle.finish(username, "10.0.0.9", True)
+    throttle.begin("pupil4", "10.0.0.9")
+    throttle.finish("pupil4", "10.0.0.9", False)
+    throttle.begin("pupil5", "10.0.0.9")
+    throttle.finish("pupil5", "10.0.0.9", False)
+    assert throttle.begin("pupil6", "10.0.0.9") > 0
+
+# Password policy tests
+# Checks calibration stays within the allowed range of costs
+def test_calibrate_bcrypt_rounds():
+    from password_policy import calibrate_bcrypt_rounds # type: ignore
+    result = calibrate_bcrypt_rounds(target_ms=1, min_rounds=4, max_rounds=6)
+    assert 4 <= result["rounds"] <= 6
+
+# Ensures a login rehashes a password made under an older policy
+def test_login_rehashes_password_after_policy_change():
+    from main import users_db # type: ignore
+    from password_policy import ( # type: ignore
+        apply_bcrypt_rounds,
+        current_bcrypt_rounds
+    )
+    client.post("/register", data={
+        "username": "rehashuser",
+        "password": "rehashpass",
+        "email": "rehash@example.com",
+        "role": "student",
+        "year_group": "9"
+    })
+    original_rounds = current_bcrypt_rounds()
+    apply_bcrypt_rounds(4)
+    try:
+        response = client.post("/login", data={
+            "username": "rehashuser",
+            "password": "rehashpass"
+        })
+        assert response.status_code == 303
+        user = users_db.get_by_username("rehashuser")
+        assert user.hashed_password.startswith("$2b$04$")
+        assert verify_password("rehashpass", user.hashed_password)
+    finally:
+        apply_bcrypt_rounds(original_rounds)
+
+# Bulk user import tests
+# Checks a CSV upload imports valid rows and reports the rejected ones
+def test_bulk_import_users_csv():
+    admin_token = test_admin_login_success()
+    upload = (
+        "username,password,email,role,year_group\n"
+        "importstudent,importpass,import@example.com,student,8\n"
+        "importstudent,importpass,import@example.com,student,8\n"
+        "importbadrole,importpass,bad@example.com,janitor,\n"
+    )
+    response = client.post(
+        "/admin/users/import",
+        files={"file": ("users.csv", upload, "text/csv")},
+        cookies={"access_token": admin_token}
+    )
+    assert response.status_code == 200
+    report = response.json()
+    assert report["imported"] == 1
+    assert [error["row"] for error in report["errors"]] == [3, 4]
+
+    login_response = client.post("/login", data={
+        "username": "importstudent",
+        "password": "importpass"
+    })
+    assert login_response.status_code == 303
+
+# Ensures NDJSON uploads are accepted and non-admins cannot import
+def test_bulk_import_users_ndjson():
+    upload = (
+        '{"username": "importteacher", "password": "p", '
+        '"email": "it@example.com", "role": "teacher"}\n'
+        "not json\n"
+    )
+    student_token = get_student_token()
+    response = client.post(
+        "/admin/users/import",
+        files={"file": ("users.ndjson", upload, "application/x-ndjson")},
+        cookies={"access_token": student_token}
+    )
+    assert response.status_code == 403
+
+    admin_token = test_admin_login_success()
+    response = client.post(
+        "/admin/users/import",
+        files={"file": ("users.ndjson", upload, "application/x-ndjson")},
+        cookies={"access_token": admin_token}
+    )
+    assert response.json() == {
+        "imported": 1,
+        "errors": [{"row": 2, "error": "Invalid JSON"}]
+    }
+
+# Lesson store tests
+# Checks the secondary indexes follow lessons through edits and deletes
+def test_lesson_store_indexes():
+    from datetime import time
+    from lesson_store import LessonStore # type: ignore
+    from models import Lesson # type: ignore
+    store = LessonStore()
+    lesson = store.add(Lesson(
+        id=store.next_id(), subject="Math", teacher="t1", classroom="R1",
+        day_of_week="Monday", start_time=time(9), end_time=time(10),
+        year_group=7
+    ))
+    assert store.by_teacher("t1") == [lesson]
+    assert store.at_slot("Monday", time(9)) == [lesson]
+
+    moved = lesson.copy(update={"teacher": "t2", "classroom": "R2"})
+    store.replace(moved)
+    assert store.by_teacher("t1") == []
+    assert store.by_classroom("R2") == [moved]
+    assert store.get(lesson.id) is moved
+
+    store.remove(lesson.id)
+    assert store.by_year_group(7) == []
+    assert store.next_id() != lesson.id
+
+# Checks an ordered walk, as used by exports, carries on past lessons
+# written or deleted while it runs
+def test_lesson_store_ordered_walk_survives_writes():
+    from datetime import time
+    from lesson_store import LessonStore # type: ignore
+    from models import Lesson # type: ignore
+    store = LessonStore()
+    for hour in (9, 10, 11, 12):
+        store.add(Lesson(
+            id=store.next_id(), subject="Math", teacher="t1", classroom="R1",
+            day_of_week="Monday", start_time=time(hour),
+            end_time=time(hour + 1), year_group=7
+        ))
+    walk = store.iter_ordered(teacher="t1")
+    first = next(walk)
+    assert first.start_time == time(9)
+    store.remove(first.id)
+    store.remove(store.at_slot("Monday", time(10))[0].id)
+    store.add(Lesson(
+        id=store.next_id(), subject="Art", teacher="t1", classroom="R1",
+        day_of_week="Monday", start_time=time(14), end_time=time(15),
+        year_group=7
+    ))
+    assert [lesson.start_time.hour for lesson in walk] == [11, 12, 14]
+
+# Conflict detection tests
+# Ensures classroom and year group double-bookings are rejected
+def test_create_lesson_rejects_classroom_and_year_group_clashes():
+    teacher_token = test_teacher_login_success()
+    lesson_data = {
+        "subject": "Chemistry",
+        "teacher": "teacheruser",
+        "classroom": "Lab 9",
+        "day_of_week": "Wednesday",
+        "start_time": "11:00",
+        "end_time": "12:00",
+        "year_group": 13
+    }
+    response = client.post("/lessons/", json=lesson_data,
+                           cookies={"access_token": teacher_token})
+    assert response.status_code == 200
+
+    admin_token = test_admin_login_success()
+    clash = dict(lesson_data, teacher="adminuser", year_group=14)
+    response = client.post("/lessons/", json=clash,
+                           cookies={"access_token": admin_token})
+    assert response.status_code == 400
+    assert "classroom" in response.json()["detail"]
+
+    clash = dict(lesson_data, teacher="adminuser", classroom="Lab 10")
+    response = client.post("/lessons/", json=clash,
+                           cookies={"access_token": admin_token})
+    assert response.status_code == 400
+    assert "year group" in response.json()["detail"]
+
+# Checks the grid frees hours on removal and ignores the lesson being edited
+def test_occupancy_grid():
+    from datetime import time
+    from conflicts import OccupancyGrid # type: ignore
+    from models import Lesson # type: ignore
+    grid = OccupancyGrid()
+    lesson = Lesson(
+        id=1, subject="Art", teacher="t1", classroom="R1",
+        day_of_week="Friday", start_time=time(9), end_time=time(11),
+        year_group=7
+    )
+    grid.add(lesson)
+    later = lesson.copy(update={"id": 2, "start_time": time(10),
+                                "end_time": time(11), "classroom": "R2",
+                                "year_group": 8})
+    assert grid.conflicts(later) == ["teacher"]
+    assert grid.conflicts(later.copy(update={"id": 1}), ignore=lesson) == []
+    grid.remove(lesson)
+    assert grid.conflicts(later) == []
+
+# Timetable reverse index tests
+# Ensures a new lesson reaches only the timetables of its audience
+def test_create_lesson_updates_audience_timetables():
+    from main import timetables_db, users_db # type: ignore
+    test_student_login_success()
+    admin_token = test_admin_login_success()
+    response = client.post("/lessons/", json={
+        "subject": "Latin",
+        "teacher": "adminuser",
+        "classroom": "Room 301",
+        "day_of_week": "Saturday",
+        "start_time": "14:00",
+        "end_time": "15:00",
+        "year_group": 9
+    }, cookies={"access_token": admin_token})
+    assert response.status_code == 200
+    lesson_id = response.json()["id"]
+
+    student = users_db.get_by_username("studentuser")
+    student_lessons = timetables_db.for_user(student.id)[0].lessons
+    assert lesson_id in [lesson.id for lesson in student_lessons]
+    other_teacher = next(u for u in users_db if u.role == "teacher")
+    for timetable in timetables_db.for_user(other_teacher.id):
+        assert lesson_id not in [lesson.id for lesson in timetable.lessons]
+
+    response = client.post(f"/lessons/{lesson_id}/delete",
+                           cookies={"access_token": admin_token})
+    assert response.status_code == 303
+    student_lessons = timetables_db.for_user(student.id)[0].lessons
+    assert lesson_id not in [lesson.id for lesson in student_lessons]
+
+# Checks an edited lesson moves between the timetables that show it
+def test_timetable_store_moves_edited_lesson():
+    from datetime import date, time
+    from models import Lesson, Timetable # type: ignore
+    from timetable_store import TimetableStore # type: ignore
+    store = TimetableStore()
+    year_7 = UserInDB(id=1, username="s7", email="s7@example.com",
+                      role="student", year_group=7, hashed_password="x")
+    year_8 = UserInDB(id=2, username="s8", email="s8@example.com",
+                      role="student", year_group=8, hashed_password="x")
+    for user in (year_7, year_8):
+        store.add(Timetable(
+            id=store.next_id(), user_id=user.id, week_start=date(2024, 1, 1),
+            week_end=date(2024, 1, 7), lessons=[]
+        ), user)
+    lesson = Lesson(
+        id=1, subject="Art", teacher="t1", classroom="R1",
+        day_of_week="Friday", start_time=time(9), end_time=time(10),
+        year_group=7
+    )
+    store.add_lesson(lesson)
+    moved = lesson.copy(update={"year_group": 8})
+    store.replace_lesson(lesson, moved)
+    assert store.for_user(1)[0].lessons == []
+    assert store.for_user(2)[0].lessons == [moved]
+    store.remove_lesson(moved)
+    assert store.for_user(2)[0].lessons == []
+
+# Checks the grouped lessons are reused until the timetable changes
+def test_timetable_store_caches_lessons_by_day():
+    from datetime import date, time
+    from models import Lesson, Timetable # type: ignore
+    from timetable_store import TimetableStore # type: ignore
+    store = TimetableStore()
+    student = UserInDB(id=1, username="s7", email="s7@example.com",
+                       role="student", year_group=7, hashed_password="x")
+    timetable = store.add(Timetable(
+        id=store.next_id(), user_id=1, week_start=date(2024, 1, 1),
+        week_end=date(2024, 1, 7), lessons=[]
+    ), student)
+    late = Lesson(
+        id=1, subject="Art", teacher="t1", classroom="R1",
+        day_of_week="Monday", start_time=time(11), end_time=time(12),
+        year_group=7
+    )
+    store.add_lesson(late)
+    grouped = store.lessons_by_day(timetable.id)
+    assert store.lessons_by_day(timetable.id) is grouped
+
+    early = late.copy(update={"id": 2, "start_time": time(9),
+                              "end_time": time(10)})
+    weekend = late.copy(update={"id": 3, "day_of_week": "Saturday"})
+    store.add_lesson(weekend)
+    store.add_lesson(early)
+    grouped = store.lessons_by_day(timetable.id)
+    assert list(grouped) == ["Monday", "Tuesday", "Wednesday", "Thursday",
+                             "Friday", "Saturday"]
+    assert grouped["Monday"] == [early, late]
+    assert grouped["Saturday"] == [weekend]
+
+# Checks the admin filters are answered from the store's indexes and
+# follow lessons as they are added, moved and removed
+def test_timetable_store_filtered_pages():
+    from datetime import date, time
+    from models import Lesson, Timetable # type: ignore
+    from timetable_store import TimetableStore # type: ignore
+    store = TimetableStore()
+    users = [
+        UserInDB(id=1, username="a", email="a@example.com", role="admin",
+                 hashed_password="x"),
+        UserInDB(id=2, username="t1", email="t1@example.com", role="teacher",
+                 hashed_password="x"),
+        UserInDB(id=3, username="s7", email="s7@example.com", role="student",
+                 year_group=7, hashed_password="x"),
+        UserInDB(id=4, username="s8", email="s8@example.com", role="student",
+                 year_group=8, hashed_password="x"),
+    ]
+    for user in users:
+        store.add(Timetable(
+            id=store.next_id(), user_id=user.id, week_start=date(2024, 1, 1),
+            week_end=date(2024, 1, 7), lessons=[]
+        ), user)
+    lesson = Lesson(
+        id=1, subject="Art", teacher="t1", classroom="R1",
+        day_of_week="Friday", start_time=time(9), end_time=time(10),
+        year_group=7
+    )
+    store.add_lesson(lesson)
+
+    def ids(**filters):
+        return [t.user_id for t in store.page(limit=10, **filters)[0]]
+
+    assert ids(teacher="t1") == [1, 2, 3]
+    assert ids(teacher="t1", role="student") == [3]
+    assert ids(year_group=8) == []
+    assert store.teachers() == ["t1"] and store.year_groups() == [7]
+
+    moved = lesson.copy(update={"year_group": 8})
+    store.replace_lesson(lesson, moved)
+    assert ids(teacher="t1") == [1, 2, 4]
+    store.remove_lesson(moved)
+    assert ids(teacher="t1") == [] and store.teachers() == []
+
+    first, after = store.page(limit=3)
+    second, last = store.page(after, limit=3)
+    assert [t.id for t in first + second] == [1, 2, 3, 4]
+    assert last is None
+
+# Bulk lesson operation tests
+# Ensures a valid batch is applied with one result per operation
+def test_bulk_lessons_applied():
+    admin_token = test_admin_login_success()
+    lesson = {
+        "subject": "Music",
+        "teacher": "adminuser",
+        "classroom": "Hall",
+        "day_of_week": "Sunday",
+        "start_time": "09:00",
+        "end_time": "10:00",
+        "year_group": 7
+    }
+    response = client.post("/lessons/bulk", json={"operations": [
+        {"action": "create", "lesson": lesson},
+        {"action": "create", "lesson": dict(lesson, start_time="10:00",
+                                            end_time="11:00")},
+    ]}, cookies={"access_token": admin_token})
+    assert response.status_code == 200
+    first, second = [r["lesson_id"] for r in response.json()["results"]]
+
+    # The freed slot can be reused later in the same batch
+    response = client.post("/lessons/bulk", json={"operations": [
+        {"action": "reassign", "lesson_id": first, "teacher": "teacheruser"},
+        {"action": "delete", "lesson_id": second},
+        {"action": "create", "lesson": dict(lesson, start_time="10:00",
+                                            end_time="11:00",
+                                            subject="Drama")},
+    ]}, cookies={"access_token": admin_token})
+    body = response.json()
+    assert response.status_code == 200
+    assert body["applied"] is True
+    assert body["results"][0]["lesson"]["teacher"] == "teacheruser"
+    assert client.get(f"/lessons/{second}").status_code == 404
+    assert client.get(f"/lessons/{first}").json()["teacher"] == "teacheruser"
+
+# Ensures a batch with any failing operation changes nothing
+def test_bulk_lessons_rejected_atomically():
+    admin_token = test_admin_login_success()
+    lesson = {
+        "subject": "Dance",
+        "teacher": "adminuser",
+        "classroom": "Studio",
+        "day_of_week": "Sunday",
+        "start_time": "13:00",
+        "end_time": "14:00",
+        "year_group": 8
+    }
+    response = client.post("/lessons/bulk", json={"operations": [
+        {"action": "create", "lesson": lesson},
+        {"action": "create", "lesson": dict(lesson, year_group=9)},
+        {"action": "create", "lesson": dict(lesson, end_time="15:30")},
+        {"action": "delete", "lesson_id": 999999},
+    ]}, cookies={"access_token": admin_token})
+    body = response.json()
+    assert response.status_code == 400
+    assert body["applied"] is False
+    assert [r["ok"] for r in body["results"]] == [True, False, False, False]
+    assert "classroom" in body["results"][1]["error"]
+    assert client.get(f"/lessons/{body['results'][0]['lesson_id']}"
+                      ).status_code == 404
+
+# Lesson list pagination tests
+# Ensures pages follow timetable order and filters use the ordered indexes
+def test_lesson_store_pages_in_timetable_order():
+    from datetime import time
+    from lesson_store import LessonStore, decode_cursor # type: ignore
+    from models import Lesson # type: ignore
+    store = LessonStore()
+    for day, hour, teacher in [("Friday", 9, "t1"), ("Monday", 11, "t2"),
+                               ("Monday", 9, "t1"), ("Tuesday", 10, "t1")]:
+        store.add(Lesson(
+            id=store.next_id(), subject="Math", teacher=teacher,
+            classroom="R1", day_of_week=day, start_time=time(hour),
+            end_time=time(hour + 1), year_group=7
+        ))
+    lessons, cursor = store.page(limit=3)
+    assert [(l.day_of_week, l.start_time.hour) for l in lessons] == [
+        ("Monday", 9), ("Monday", 11), ("Tuesday", 10)]
+    lessons, cursor = store.page(decode_cursor(cursor), limit=3)
+    assert [l.day_of_week for l in lessons] == ["Friday"]
+    assert cursor is None
+
+    lessons, _ = store.page(teacher="t1", day_of_week="Monday")
+    assert [l.start_time.hour for l in lessons] == [9]
+    store.remove(lessons[0].id)
+    assert store.page(teacher="t1", day_of_week="Monday") == ([], None)
+
+# Ensures the lesson list can be filtered and paged through
+def test_list_lessons_filtered_and_paged():
+    admin_token = test_admin_login_success()
+    response = client.get("/lessons/?limit=2&day=Monday",
+                          cookies={"access_token": admin_token})
+    assert response.status_code == 200
+    assert "Next Page" in response.text
+    assert "<td>Tuesday</td>" not in response.text
+
+    response = client.get("/lessons/?cursor=bad",
+                          cookies={"access_token": admin_token})
+    assert response.status_code == 400
+
+# Export tests
+# Ensures lessons stream as CSV with a header and honour the filters
+def test_export_lessons_csv():
+    admin_token = test_admin_login_success()
+    response = client.get("/admin/export/lessons?teacher=teacher1",
+                          cookies={"access_token": admin_token})
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("text/csv")
+    lines = response.text.strip().splitlines()
+    assert lines[0].startswith("id,subject,teacher")
+    assert len(lines) > 1
+    assert all(",teacher1," in line for line in lines[1:])
+
+# Ensures timetables stream as NDJSON, one object per timetable lesson
+def test_export_timetables_ndjson():
+    import json
+    admin_token = test_admin_login_success()
+    response = client.get("/admin/export/timetables?format=ndjson&year_group=9",
+                          cookies={"access_token": admin_token})
+    assert response.status_code == 200
+    rows = [json.loads(line) for line in response.text.splitlines()]
+    assert rows and all("lesson_subject" in row for row in rows)
+
+    student_token = test_student_login_success()
+    response = client.get("/admin/export/timetables",
+                          cookies={"access_token": student_token})
+    assert response.status_code == 403
+
+# iCalendar feed tests
+# Ensures the feed lists weekly events and polls are answered with 304s
+def test_timetable_feed_conditional_get():
+    from main import feed_cache # type: ignore
+    student_token = test_student_login_success()
+    response = client.get("/timetable/studentuser.ics",
+                          cookies={"access_token": student_token})
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("text/calendar")
+    assert "BEGIN:VCALENDAR" in response.text
+    assert "RRULE:FREQ=WEEKLY" in response.text
+    etag = response.headers["etag"]
+
+    hits = feed_cache.hits
+    response = client.get("/timetable/studentuser.ics",
+                          headers={"If-None-Match": etag},
+                          cookies={"access_token": student_token})
+    assert response.status_code == 304
+    response = client.get("/timetable/studentuser.ics",
+                          cookies={"access_token": student_token})
+    assert response.headers["etag"] == etag
+    assert feed_cache.hits == hits + 1
+
+    # A new lesson for the student's year group changes the feed
+    admin_token = test_admin_login_success()
+    client.post("/lessons/", json={
+        "subject": "Astronomy",
+        "teacher": "adminuser",
+        "classroom": "Observatory",
+        "day_of_week": "Saturday",
+        "start_time": "11:00",
+        "end_time": "12:00",
+        "year_group": 9
+    }, cookies={"access_token": admin_token})
+    response = client.get("/timetable/studentuser.ics",
+                          headers={"If-None-Match": etag},
+                          cookies={"access_token": student_token})
+    assert response.status_code == 200
+    assert "SUMMARY:Astronomy" in response.text
+
+    # So does a change to the term calendar
+    from datetime import date
+    from main import term_calendar # type: ignore
+    etag = response.headers["etag"]
+    term_calendar.cancel(999999, date(2000, 1, 3))
+    try:
+        response = client.get("/timetable/studentuser.ics",
+                              headers={"If-None-Match": etag},
+                              cookies={"access_token": student_token})
+        assert response.status_code == 200
+    finally:
+        term_calendar.restore(999999, date(2000, 1, 3))
+
+# Checks feed events end with the last term, exclude holidays, gaps
+# between terms and cancellations, and override changed occurrences
+def test_feed_follows_term_calendar():
+    from datetime import date, time
+    from types import SimpleNamespace
+    from ical_feed import build_calendar # type: ignore
+    from models import Lesson # type: ignore
+    from term_calendar import Holiday, Term, TermCalendar # type: ignore
+    calendar = TermCalendar()
+    calendar.add_term(Term("Autumn", date(2024, 9, 2), date(2024, 9, 27)))
+    calendar.add_term(Term("Spring", date(2024, 10, 7), date(2024, 10, 18)))
+    calendar.add_holiday(Holiday("Inset", date(2024, 9, 16), date(2024, 9, 16)))
+    lesson = Lesson(
+        id=1, subject="Science", teacher="t1", classroom="Lab",
+        day_of_week="Monday", start_time=time(9), end_time=time(10),
+        year_group=7
+    )
+    calendar.cancel(1, date(2024, 9, 23))
+    calendar.change(1, date(2024, 10, 7), classroom="Hall")
+    timetable = SimpleNamespace(week_start=date(2024, 9, 2),
+                                lessons=[lesson])
+
+    feed = build_calendar("t1", [timetable], calendar=calendar).decode()
+    lines = feed.replace("\r\n ", "").split("\r\n")
+    assert "RRULE:FREQ=WEEKLY;UNTIL=20241018T235959" in lines
+    assert ("EXDATE:20240916T090000,20240923T090000,20240930T090000"
+            in lines)
+    assert "RECURRENCE-ID:20241007T090000" in lines
+    assert lines.count("BEGIN:VEVENT") == 2
+    assert lines.index("LOCATION:Hall") > lines.index(
+        "RECURRENCE-ID:20241007T090000"
+        )
+
+    # A lesson whose dates are all outside the terms is left out
+    late = SimpleNamespace(week_start=date(2024, 10, 21), lessons=[lesson])
+    feed = build_calendar("t1", [late], calendar=calendar).decode()
+    assert "BEGIN:VEVENT" not in feed
+
+# Checks pages and API responses are answered with 304 until the data
+# behind them changes
+def test_conditional_get_follows_data_versions():
+    admin_token = test_admin_login_success()
+    cookies = {"access_token": admin_token}
+    response = client.post("/lessons/", json={
+        "subject": "Drama",
+        "teacher": "adminuser",
+        "classroom": "Studio",
+        "day_of_week": "Saturday",
+        "start_time": "09:00",
+        "end_time": "10:00",
+        "year_group": 12
+    }, cookies=cookies)
+    lesson = response.json()
+
+    for path in ("/lessons/", "/timetable/", f"/lessons/{lesson['id']}",
+                 "/admin/timetables"):
+        response = client.get(path, cookies=cookies)
+        etag = response.headers["etag"]
+        response = client.get(path, cookies=cookies,
+                              headers={"If-None-Match": etag})
+        assert response.status_code == 304, path
+        assert response.content == b""
+
+    response = client.get(f"/lessons/{lesson['id']}", cookies=cookies)
+    lesson_etag = response.headers["etag"]
+    list_etag = client.get("/lessons/", cookies=cookies).headers["etag"]
+    client.put(f"/lessons/{lesson['id']}",
+               json=dict(lesson, classroom="Theatre"), cookies=cookies)
+    response = client.get(f"/lessons/{lesson['id']}", cookies=cookies,
+                          headers={"If-None-Match": lesson_etag})
+    assert response.status_code == 200
+    assert response.json()["classroom"] == "Theatre"
+    response = client.get("/lessons/", cookies=cookies,
+                          headers={"If-None-Match": list_etag})
+    assert response.status_code == 200
+
+    client.post(f"/lessons/{lesson['id']}/delete", cookies=cookies)
+
+# Ensures rendered pages are reused and evicted least recently used first
+def test_render_cache_hits_and_evicts_by_size():
+    from jinja2 import DictLoader, Environment
+    from markupsafe import Markup
+    from render_cache import RenderCache # type: ignore
+    env = Environment(loader=DictLoader({"page.html": "<p>{{ text }}</p>"}))
+    page = {"text": "x" * 1000}
+    size = sys.getsizeof(Markup(env.get_template("page.html").render(page)))
+    cache = RenderCache(env, max_bytes=size * 2)
+    builds = []
+
+    def context(name):
+        def build():
+            builds.append(name)
+            return page
+        return build
+
+    html = cache.render("page.html", "a", context("a"))
+    assert html == "<p>" + "x" * 1000 + "</p>"
+    assert cache.render("page.html", "a", context("a")) is html
+    assert builds == ["a"]
+    cache.render("page.html", "b", context("b"))
+    cache.render("page.html", "a", context("a"))
+    cache.render("page.html", "c", context("c"))
+    # b was the least recently used
+    assert ("page.html", "b") not in cache
+    assert ("page.html", "a") in cache
+    assert cache.warm([("page.html", "a", context("a")),
+                       ("page.html", "b", context("b"))]) == 1
+    stats = cache.stats()
+    assert stats["entries"] == 2
+    assert stats["bytes"] <= stats["max_bytes"]
+    assert stats["hits"] == 2
+    assert stats["misses"] == 3
+    assert stats["evictions"] == 2
+
+# Ensures pages shared by a role scope come from the render cache and
+# change when the data does
+def test_render_cache_serves_scoped_pages():
+    from main import render_cache # type: ignore
+    admin_cookies = {"access_token": test_admin_login_success()}
+    student_cookies = {"access_token": test_student_login_success()}
+    response = client.post("/admin/render-cache/warm", cookies=admin_cookies)
+    assert response.status_code == 200
+    response = client.post("/admin/render-cache/warm", cookies=student_cookies)
+    assert response.status_code == 403
+
+    hits = render_cache.hits
+    for path in ("/lessons/", "/timetable/"):
+        response = client.get(path, cookies=student_cookies)
+        assert response.status_code == 200
+    response = client.get("/admin/timetables", cookies=admin_cookies)
+    assert response.status_code == 200
+    assert render_cache.hits == hits + 3
+
+    response = client.post("/lessons/", json={
+        "subject": "Robotics",
+        "teacher": "adminuser",
+        "classroom": "Workshop",
+        "day_of_week": "Saturday",
+        "start_time": "10:00",
+        "end_time": "11:00",
+        "year_group": 9
+    }, cookies=admin_cookies)
+    lesson = response.json()
+    for path in ("/lessons/", "/timetable/"):
+        response = client.get(path, cookies=student_cookies)
+        assert "Robotics" in response.text, path
+    client.post(f"/lessons/{lesson['id']}/delete", cookies=admin_cookies)
+    response = client.get("/lessons/", cookies=student_cookies)
+    assert "Robotics" not in response.text
+    response = client.get("/admin/stats", cookies=admin_cookies)
+    assert response.json()["render_cache"]["entries"] == len(render_cache)
+
+# Ensures calendar apps can use the feed token instead of a login
+def test_timetable_feed_token():
+    from auth import SECRET_KEY # type: ignore
+    from ical_feed import feed_token # type: ignore
+    test_teacher_login_success()
+    calendar_app = TestClient(app)
+    token = feed_token("teacheruser", SECRET_KEY)
+    response = calendar_app.get(f"/timetable/teacheruser.ics?token={token}")
+    assert response.status_code == 200
+    response = calendar_app.get("/timetable/teacheruser.ics?token=wrong")
+    assert response.status_code == 401
+
+# Scheduler tests
+# Ensures a generated week covers the curriculum without double-bookings
+def test_scheduler_conflict_free():
+    from scheduler import SchedulingProblem, solve # type: ignore
+    problem = SchedulingProblem(
+        teachers={"t1": ["Math", "Art"], "t2": ["Math", "English"],
+                  "t3": ["English", "Art"]},
+        classrooms=["R1", "R2"],
+        year_groups=[7, 8],
+        curriculum={"Math": 6, "English": 6, "Art": 4, "Latin": 1}
+        )
+    schedule = solve(problem, seed=3)
+    assert len(schedule.placements) == 32
+    assert sorted(schedule.unplaced) == [(7, "Latin", 1), (8, "Latin", 1)]
+    for field in ("teacher", "classroom", "year_group"):
+        slots = [(getattr(p, field), p.day_of_week, p.hour)
+                 for p in schedule.placements]
+        assert len(slots) == len(set(slots))
+    for placement in schedule.placements:
+        assert placement.subject in problem.teachers[placement.teacher]
+
+# Ensures impossible searches stop early, full teachers are passed over and
+# a tight week is still placed in full
+def test_scheduler_overload_and_teacher_hours():
+    import random
+    from scheduler import ( # type: ignore
+        SLOTS_PER_WEEK, SchedulingProblem, assign_teachers, search, solve
+        )
+    overloaded = SchedulingProblem(
+        teachers={"t1": ["Math"]}, classrooms=["R1"], year_groups=[7, 8],
+        curriculum={"Math": SLOTS_PER_WEEK // 2 + 1}
+        )
+    assert search(overloaded, seed=0) is None
+    schedule = solve(overloaded, restarts=1)
+    assert schedule.attempts == 2
+    assert not schedule.complete
+
+    capped = SchedulingProblem(
+        teachers={"t1": ["Math"], "t2": ["Math"]}, classrooms=["R1"],
+        year_groups=[7, 8, 9], curriculum={"Math": 10},
+        max_teacher_hours=20
+        )
+    classes, _ = assign_teachers(capped, random.Random(0))
+    hours = {}
+    for _, _, teacher, class_hours in classes:
+        hours[teacher] = hours.get(teacher, 0) + class_hours
+    assert sorted(hours.values()) == [10, 20]
+
+    full = SchedulingProblem(
+        teachers={"t1": ["Math", "Art"], "t2": ["Math", "Art"]},
+        classrooms=["R1", "R2"], year_groups=[7, 8],
+        curriculum={"Math": SLOTS_PER_WEEK // 2, "Art": SLOTS_PER_WEEK // 2}
+        )
+    schedule = solve(full, seed=1)
+    assert schedule.complete
+    assert len(schedule.placements) == 2 * SLOTS_PER_WEEK
+
+# Ensures the seeded lessons never clash
+def test_seeded_lessons_conflict_free():
+    from main import global_lessons_db # type: ignore
+    seeded = [lesson for lesson in global_lessons_db
+              if lesson.classroom.startswith("Room 1")]
+    assert seeded
+    for field in ("teacher", "classroom", "year_group"):
+        slots = [(getattr(l, field), l.day_of_week, l.start_time)
+                 for l in seeded]
+        assert len(slots) == len(set(slots))
+
+# Analytics tests
+# Checks the occupancy array reports follow lesson writes
+def test_occupancy_tensor_reports():
+    from datetime import time
+    from analytics import OccupancyTensor # type: ignore
+    from models import Lesson # type: ignore
+    tensor = OccupancyTensor()
+    for room in ("R1", "R2", "R3"):
+        tensor.register("classroom", room)
+    lesson = Lesson(
+        id=1, subject="Art", teacher="t1", classroom="R1",
+        day_of_week="Monday", start_time=time(9), end_time=time(11),
+        year_group=7
+    )
+    tensor.add(lesson)
+    tensor.add(lesson.copy(update={"id": 2, "classroom": "R2",
+                                   "teacher": "t2"}))
+    assert tensor.contact_hours("teacher") == {"t1": 2, "t2": 2}
+    assert tensor.utilization("classroom")["R1"] == round(200 / 30, 1)
+    assert tensor.idle("classroom") == ["R3"]
+    assert tensor.idle("classroom", "Monday", 10) == ["R3"]
+    assert tensor.peak_hours("classroom", 1) == [
+        {"day": "Monday", "hour": 9, "busy": 2, "percent": 66.7}]
+    tensor.remove(lesson)
+    assert tensor.idle("classroom", "Monday", 9) == ["R1", "R3"]
+    # Resources that were never registered go with their last lesson
+    assert tensor.contact_hours("teacher") == {"t2": 2}
+    moved = lesson.copy(update={"id": 3, "classroom": "R9"})
+    tensor.add(moved)
+    tensor.remove(moved)
+    assert tensor.idle("classroom") == ["R1", "R3"]
+    assert OccupancyTensor().utilization("year_group") == {}
+
+# Ensures the analytics endpoints are admin-only and track new lessons
+def test_analytics_endpoints():
+    admin_token = test_admin_login_success()
+    response = client.get("/admin/analytics/contact-hours",
+                          cookies={"access_token": admin_token})
+    assert response.status_code == 200
+    before = response.json()["contact_hours"].get("adminuser", 0)
+    client.post("/lessons/", json={
+        "subject": "Chess",
+        "teacher": "adminuser",
+        "classroom": "Room 120",
+        "day_of_week": "Saturday",
+        "start_time": "12:00",
+        "end_time": "13:00",
+        "year_group": 14
+    }, cookies={"access_token": admin_token})
+    response = client.get("/admin/analytics/contact-hours",
+                          cookies={"access_token": admin_token})
+    assert response.json()["contact_hours"]["adminuser"] == before + 1
+
+    response = client.get("/admin/analytics/idle-rooms?day=Monday&hour=9",
+                          cookies={"access_token": admin_token})
+    assert response.status_code == 200
+    response = client.get("/admin/analytics/utilization?kind=desk",
+                          cookies={"access_token": admin_token})
+    assert response.status_code == 400
+
+    student_token = test_student_login_success()
+    response = client.get("/admin/analytics/peak-hours",
+                          cookies={"access_token": student_token})
+    assert response.status_code == 403
+
+# Logging tests
+# Checks busy routes are sampled, warnings always kept and disabled records
+# never build their arguments
+def test_logging_sampling_and_lazy_arguments():
+    import io
+    from app_log import ( # type: ignore
+        LazyArg, configure_logging, current_route, get_logger, stop_logging
+    )
+    from main import LOG_FORMAT, LOG_LEVEL, LOG_SAMPLE_RATES # type: ignore
+    output = io.StringIO()
+    configure_logging("INFO", sample_rates={"/busy": 0.25}, output=output)
+    log = get_logger("test")
+    calls = []
+    token = current_route.set("/busy/route")
+    try:
+        for number in range(8):
+            log.info("sampled %d", number)
+        log.warning("always kept")
+        log.debug("never built %s", LazyArg(calls.append, "built"))
+    finally:
+        current_route.reset(token)
+    log.info("other route")
+    stop_logging()
+    configure_logging(LOG_LEVEL, LOG_FORMAT, LOG_SAMPLE_RATES)
+
+    lines = output.getvalue().splitlines()
+    assert len([line for line in lines if "sampled" in line]) == 2
+    assert any("[/busy/route] always kept" in line for line in lines)
+    assert any("[-] other route" in line for line in lines)
+    assert calls == []
+
+# Term calendar tests
+# Checks occurrences skip holidays and gaps between terms and follow
+# one-off exceptions, and the interval index finds them by resource
+def test_term_calendar_occurrences():
+    from datetime import date, datetime, time
+    from models import Lesson # type: ignore
+    from term_calendar import ( # type: ignore
+        Holiday, IntervalIndex, Term, TermCalendar
+    )
+    calendar = TermCalendar()
+    calendar.add_term(Term("Autumn", date(2024, 9, 2), date(2024, 10, 25)))
+    calendar.add_term(Term("Spring", date(2025, 1, 6), date(2025, 3, 28)))
+    calendar.add_holiday(Holiday("Inset", date(2024, 9, 16), date(2024, 9, 16)))
+    with pytest.raises(ValueError):
+        calendar.add_term(Term("Overlap", date(2024, 10, 1), date(2024, 11, 1)))
+
+    double = Lesson(
+        id=1, subject="Science", teacher="t1", classroom="Lab",
+        day_of_week="Monday", start_time=time(9), end_time=time(11),
+        year_group=7
+    )
+    friday = double.copy(update={"id": 2, "day_of_week": "Friday",
+                                 "start_time": time(13),
+                                 "end_time": time(14)})
+    calendar.cancel(1, date(2024, 9, 23))
+    calendar.change(2, date(2024, 9, 20), classroom="Hall")
+
+    occurrences = list(calendar.occurrences(
+        [double, friday], date(2024, 9, 9), date(2024, 9, 27)
+    ))
+    assert [(o.date.day, o.lesson.classroom) for o in occurrences] == [
+        (9, "Lab"), (13, "Lab"), (20, "Hall"), (27, "Lab")
+    ]
+    # The gap between terms is skipped
+    assert [o.date for o in calendar.occurrences(
+        [double], date(2024, 10, 20), date(2025, 1, 10)
+    )] == [date(2024, 10, 21), date(2025, 1, 6)]
+
+    index = IntervalIndex()
+    index.add(double)
+    index.add(friday)
+    in_lab = index.occurrences(calendar, "classroom", "Lab",
+                               datetime(2024, 9, 9, 10), datetime(2024, 9, 20))
+    assert [o.start for o in in_lab] == [
+        datetime(2024, 9, 9, 9), datetime(2024, 9, 13, 13)
+    ]
+    in_hall = index.occurrences(calendar, "classroom", "Hall",
+                                datetime(2024, 9, 1), datetime(2024, 9, 30))
+    assert [o.date for o in in_hall] == [date(2024, 9, 20)]
+
+# Ensures lessons can run for several hours but must end by 15:00, and the
+# timetable of any week lists the lessons happening that week
+def test_multi_hour_lesson_and_any_week_timetable():
+    from datetime import date, timedelta
+    from main import term_calendar # type: ignore
+    admin_token = test_admin_login_success()
+    lesson = {
+        "subject": "Design",
+        "teacher": "adminuser",
+        "classroom": "Workshop",
+        "day_of_week": "Sunday",
+        "start_time": "12:00",
+        "end_time": "14:00",
+        "year_group": 13
+    }
+    response = client.post("/lessons/", json=lesson,
+                           cookies={"access_token": admin_token})
+    assert response.status_code == 200
+    lesson_id = response.json()["id"]
+    response = client.post("/lessons/", json=dict(lesson, end_time="16:00"),
+                           cookies={"access_token": admin_token})
+    assert response.status_code == 422
+
+    admin_id = client.get("/users/me",
+                          cookies={"access_token": admin_token}).json()["id"]
+    term = term_calendar.terms[0]
+    sunday = term.start + timedelta(days=6 - term.start.weekday())
+    response = client.get(f"/timetables/{admin_id}/{sunday}",
+                          cookies={"access_token": admin_token})
+    assert response.status_code == 200
+    assert response.json()["week_start"] == str(sunday - timedelta(days=6))
+    assert lesson_id in [l["id"] for l in response.json()["lessons"]]
+    response = client.get(f"/timetables/{admin_id}/{date(1990, 1, 1)}",
+                          cookies={"access_token": admin_token})
+    assert response.status_code == 200
+    assert response.json()["lessons"] == []
+
+    response = client.post("/admin/calendar/exceptions", json={
+        "lesson_id": lesson_id, "date": str(sunday), "cancelled": True
+    }, cookies={"access_token": admin_token})
+    assert response.status_code == 200
+    response = client.get(
+        f"/timetables/{admin_id}/occurrences",
+        params={"start": str(sunday), "end": str(sunday + timedelta(days=7))},
+        cookies={"access_token": admin_token})
+    dates = [o["date"] for o in response.json() if o["lesson"]["id"] == lesson_id]
+    assert dates == [str(sunday + timedelta(days=7))]
+    response = client.get("/admin/calendar/occurrences", params={
+        "kind": "classroom", "key": "Workshop",
+        "start": f"{sunday}T13:00", "end": f"{sunday + timedelta(days=7)}T13:00"
+    }, cookies={"access_token": admin_token})
+    assert response.status_code == 200
+    assert [o["start"] for o in response.json()] == [
+        f"{sunday + timedelta(days=7)}T12:00:00"
+    ]
+
+    response = client.post(f"/lessons/{lesson_id}/edit", data=dict(
+        lesson, start_time="9am", duration=1
+    ), cookies={"access_token": admin_token})
+    assert response.status_code == 400
+    # Lengths that would wrap past midnight are rejected too
+    for duration in (28, -20, 0):
+        response = client.post(f"/lessons/{lesson_id}/edit", data=dict(
+            lesson, start_time="09:00", duration=duration
+        ), cookies={"access_token": admin_token})
+        assert response.status_code == 400, duration
+
+    # Moving another lesson into the Workshop at 12:00 double-books it
+    response = client.post("/lessons/", json=dict(
+        lesson, classroom="Studio", start_time="09:00", end_time="10:00"
+    ), cookies={"access_token": admin_token})
+    other_id = response.json()["id"]
+    moved = {"lesson_id": other_id, "date": str(sunday + timedelta(days=7)),
+             "classroom": "Workshop", "start_time": "12:00",
+             "end_time": "13:00"}
+    response = client.post("/admin/calendar/exceptions", json=moved,
+                           cookies={"access_token": admin_token})
+    assert response.status_code == 400
+    assert "classroom" in response.json()["detail"]
+    response = client.post("/admin/calendar/exceptions",
+                           json=dict(moved, date=str(sunday)),
+                           cookies={"access_token": admin_token})
+    assert response.status_code == 200
+
+    for removed in (lesson_id, other_id):
+        client.post(f"/lessons/{removed}/delete",
+                    cookies={"access_token": admin_token})